@@ -0,0 +1,83 @@
+"""
+Frames/s a server delivers when every session encodes, in process and with --encode-workers N.
+
+    poetry run python benchmarks/bench_encode_workers.py rick.webm --files 8 --max-workers 4
+
+Each case starts `xarxes2025 server` on its own port, with the frame cache
+disabled, and loads it with headless viewers from this process. The video
+is linked under --files names and each viewer watches its own, as with
+sessions on different videos, so the requests spread over the encoder
+workers. The frames go through the real pacing path: each session has its
+next frame encoded ahead of its deadline, so N workers have up to N encodes
+in flight. The frame rate is high enough for encoding to be the limit; the
+frames/s received, the share of what the viewers asked for and the CPU
+seconds of the server and its workers are printed.
+"""
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+from xarxes2025.loadclient import run_viewers
+
+from bench_workers import children_cpu, wait_listening
+
+
+async def watch(port, paths, duration):
+    return await asyncio.gather(*(run_viewers("127.0.0.1", port, path, 1, duration, 0, 0, 0, None, None)
+                                  for path in paths))
+
+
+def measure(name, paths, port, encode_workers, duration, frame_rate, engine):
+    command = [sys.executable, "-m", "xarxes2025", "server", "-p", str(port), "--cache-size", "0",
+               "--frame-rate", str(frame_rate), "--engine", engine, "--encode-workers", str(encode_workers)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    cpu = children_cpu()
+    try:
+        wait_listening(port)
+        start = time.monotonic()
+        clients = [client for clients in asyncio.run(watch(port, paths, duration)) for client in clients]
+        elapsed = time.monotonic() - start
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+    cpu = children_cpu() - cpu
+    frames_per_s = sum(client.stats.frames for client in clients) / elapsed
+    failed = sum(1 for client in clients if client.stats.error)
+    click.echo(f"{name:14} {frames_per_s:10,.1f} {frames_per_s / (len(paths) * frame_rate):7.0%} "
+               f"{failed:7} {cpu:8.1f}")
+
+
+@click.command()
+@click.argument("videofile", type=click.Path(exists=True))
+@click.option("--files", default=8, show_default=True, help="Sessions, each on its own file")
+@click.option("--duration", default=10, show_default=True, help="Seconds each case plays")
+@click.option("--frame-rate", default=100, show_default=True, help="Frames/s asked by each session")
+@click.option("--max-workers", default=os.cpu_count(), show_default=True)
+@click.option("--engine", default="threads", show_default=True, type=click.Choice(["threads", "asyncio"]))
+@click.option("--port", default=6500, show_default=True, help="Port of the first case, the next ones use the following ports")
+def main(videofile, files, duration, frame_rate, max_workers, engine, port):
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for n in range(files):
+            path = os.path.join(directory, f"{n}{os.path.splitext(videofile)[1]}")
+            os.symlink(os.path.abspath(videofile), path)
+            paths.append(path)
+
+        click.echo(f"{files} sessions at {frame_rate} fps, {os.cpu_count()} CPUs, {engine} engine")
+        click.echo(f"{'encoding':14} {'frames/s':>10} {'of asked':>7} {'failed':>7} {'CPU s':>8}")
+        measure("in process", paths, port, 0, duration, frame_rate, engine)
+        workers = 1
+        while workers <= max_workers:
+            port += 1
+            measure(f"{workers} workers", paths, port, workers, duration, frame_rate, engine)
+            workers *= 2
+
+
+if __name__ == "__main__":
+    main()
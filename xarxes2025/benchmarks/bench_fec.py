@@ -0,0 +1,126 @@
+"""
+Frames delivered through a lossy network with and without FEC, and what the parity packets cost.
+
+    poetry run python benchmarks/bench_fec.py --loss-rate 1 --loss-rate 3 --loss-rate 5 --k 5 --k 10
+
+A stream of random frames (--frame-size bytes, packets of --mtu bytes)
+goes through the network emulator of the server, on a virtual clock, once
+without FEC and once per --k, with the same seed. The receiver reassembles the frames with the parity packets
+rebuilding what they can; each rebuilt frame must be equal to the frame
+sent. For every loss rate it prints the packets lost, the ones recovered,
+the residual loss (media packets only), the complete frames and the overhead of the parity
+packets, then the time to add and use the parity packets per media packet.
+"""
+import os
+import time
+
+import click
+from loguru import logger
+
+from xarxes2025.fec import FEC_HEADER, FECDecoder, FECEncoder, is_parity
+from xarxes2025.netem import NetworkEmulator
+from xarxes2025.rtpjpeg import CLOCK_RATE, FrameReassembler
+from xarxes2025.udpdatagram import RTP_FIELDS, RTPPacketizer, UDPDatagram
+
+
+def run_stream(frames, k, mtu, loss_rate, loss_burst, seed):
+
+    """ Send the frames through an emulated path, returns the receiver's counters """
+
+    emulator = NetworkEmulator(None, loss_rate, loss_burst, seed=seed)
+    emulator.thread = False
+    path = emulator.path()
+    packetizer = RTPPacketizer(mtu - (FEC_HEADER.size if k else 0), ssrc=1)
+    encoder = FECEncoder(k, 1) if k else None
+    decoder = FECDecoder()
+    reassembler = FrameReassembler()
+    sent = {}
+    media = received_media = wire = complete = 0
+
+    for number, frame in enumerate(frames):
+        timestamp = number * CLOCK_RATE // 25
+        sent[timestamp] = frame
+        packets = packetizer.packetize(frame, timestamp)
+        media += len(packets)
+        if encoder is not None:
+            packets = encoder.protect(packets, timestamp)
+        wire += sum(len(header) + len(payload) for header, payload in packets)
+        delivered, _ = path.impair(packets, None, number / 25)
+
+        for header, payload in delivered:
+            data = bytes(header) + bytes(payload)
+            if is_parity(data):
+                received = decoder.add_parity(data)
+            else:
+                received_media += 1
+                received = [data] + decoder.add_media(RTP_FIELDS.unpack_from(data, 1)[1], data)
+            for data in received:
+                marker_pt, _, packet_ts, _ = RTP_FIELDS.unpack_from(data, 1)
+                frame_data = reassembler.add(packet_ts, data[UDPDatagram.HEADER_SIZE:], marker_pt >> 7)
+                if frame_data is not None:
+                    assert frame_data == sent[packet_ts], "rebuilt frame differs from the frame sent"
+                    complete += 1
+
+    return {
+        "media": media,
+        "lost": media - received_media,
+        "recovered": decoder.recovered,
+        "complete": complete,
+        "wire": wire,
+        "parity": encoder.parity_packets if encoder is not None else 0,
+    }
+
+
+@click.command()
+@click.option("--frames", default=2000, show_default=True)
+@click.option("--frame-size", default=20000, show_default=True, help="Bytes per frame")
+@click.option("--mtu", default=1400, show_default=True)
+@click.option("--loss-rate", "loss_rates", default=[1.0, 3.0, 5.0], multiple=True, show_default=True, help="%")
+@click.option("--loss-burst", default=1.0, show_default=True, help="Mean burst length, 1 for independent losses")
+@click.option("--k", "ks", default=[5, 10], multiple=True, show_default=True, help="Media packets per parity packet")
+@click.option("--seed", default=1, show_default=True)
+def main(frames, frame_size, mtu, loss_rates, loss_burst, ks, seed):
+    # Every incomplete frame is logged by the reassembler
+    logger.disable("xarxes2025")
+    stream = [os.urandom(frame_size) for _ in range(frames)]
+    click.echo(f"{frames} frames of {frame_size} bytes, MTU {mtu}, loss bursts of {loss_burst}, seed {seed}")
+    click.echo(f"{'loss %':>6} {'FEC':>6} {'lost':>6} {'recovered':>9} {'residual':>9} {'frames':>7} {'overhead':>9}")
+    for loss_rate in loss_rates:
+        base = None
+        for k in (0,) + tuple(ks):
+            result = run_stream(stream, k, mtu, loss_rate, loss_burst, seed)
+            if base is None:
+                base = result
+            residual = (result["lost"] - result["recovered"]) / result["media"]
+            overhead = result["wire"] / base["wire"] - 1
+            click.echo(f"{loss_rate:6.1f} {f'k={k}' if k else 'off':>6} {result['lost']:6} {result['recovered']:9} "
+                       f"{residual:9.2%} {result['complete'] / frames:7.1%} {overhead:9.1%}")
+
+    # Cost per media packet: the server adds the parity packets, the client
+    # keeps every media packet and rebuilds one per group
+    for k in ks:
+        packetizer = RTPPacketizer(mtu - FEC_HEADER.size, ssrc=1)
+        encoder = FECEncoder(k, 1)
+        start = time.perf_counter()
+        protected = [encoder.protect(packetizer.packetize(frame, 0), 0) for frame in stream]
+        encode = time.perf_counter() - start
+        count = sum(len(packets) for packets in protected) - encoder.parity_packets
+
+        decoder = FECDecoder()
+        datagrams = [[bytes(header) + bytes(payload) for header, payload in packets] for packets in protected]
+        start = time.perf_counter()
+        for packets in datagrams:
+            # The first packet of each group is lost
+            for n, data in enumerate(packets):
+                if n % (k + 1):
+                    if is_parity(data):
+                        decoder.add_parity(data)
+                    else:
+                        decoder.add_media(RTP_FIELDS.unpack_from(data, 1)[1], data)
+        decode = time.perf_counter() - start
+        click.echo(f"k={k:<3} encode {encode / count * 1e6:6.2f} us/packet, "
+                   f"decode {decode / count * 1e6:6.2f} us/packet, {decoder.recovered} rebuilt")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+ms/frame and bytes/frame of each JPEG encoder backend on the same frames.
+
+    poetry run python benchmarks/bench_jpeg_encoders.py rick.webm --frames 100 --quality 80
+
+The frames are decoded and resized once, then every available backend
+encodes all of them with each chroma subsampling, plus optimized Huffman
+tables and progressive at 420. The PSNR against the source frames tells
+what the smaller frames cost in quality. Backends that are not installed
+(turbojpeg needs PyTurboJPEG) are listed and skipped.
+"""
+import statistics
+import time
+
+import click
+import cv2
+import numpy
+
+from xarxes2025.encoders import ENCODERS, SUBSAMPLINGS, available_encoders, make_encoder
+
+
+def read_frames(videofile, count, size):
+    cap = cv2.VideoCapture(videofile)
+    frames = []
+    while len(frames) < count:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(cv2.resize(frame, size) if size else frame)
+    cap.release()
+    return frames
+
+
+def measure(jpeg, frames, quality):
+    times = []
+    sizes = []
+    psnr = []
+    for frame in frames:
+        start = time.perf_counter()
+        data = jpeg.encode(frame, quality)
+        times.append((time.perf_counter() - start) * 1000)
+        sizes.append(len(data))
+        decoded = cv2.imdecode(numpy.frombuffer(data, numpy.uint8), cv2.IMREAD_COLOR)
+        psnr.append(cv2.PSNR(frame, decoded))
+    click.echo(f"{str(jpeg):32} {statistics.median(times):8.3f} {statistics.fmean(times):8.3f} "
+               f"{statistics.fmean(sizes):11,.0f} {statistics.fmean(psnr):8.2f}")
+
+
+@click.command()
+@click.argument("videofile", type=click.Path(exists=True))
+@click.option("--frames", default=100, show_default=True, help="Frames encoded by each backend")
+@click.option("--quality", default=80, show_default=True, type=click.IntRange(0, 100))
+@click.option("--resolution", default="500x380", show_default=True, help="WIDTHxHEIGHT or 'source'")
+def main(videofile, frames, quality, resolution):
+    size = None if resolution == "source" else tuple(int(n) for n in resolution.split("x"))
+    frames = read_frames(videofile, frames, size)
+    height, width = frames[0].shape[:2]
+    click.echo(f"{len(frames)} frames {width}x{height}, quality {quality}")
+
+    names = available_encoders()
+    for name in ENCODERS:
+        if name not in names:
+            click.echo(f"{name}: not available")
+
+    click.echo(f"{'encoder':32} {'p50 ms':>8} {'mean ms':>8} {'bytes/frame':>11} {'PSNR dB':>8}")
+    for name in names:
+        for subsampling in SUBSAMPLINGS:
+            measure(make_encoder(name, subsampling), frames, quality)
+        measure(make_encoder(name, "420", optimize=True), frames, quality)
+        measure(make_encoder(name, "420", progressive=True), frames, quality)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Cost of the metrics instrumentation, disabled and enabled.
+
+    poetry run python benchmarks/bench_metrics.py
+
+Times a bare loop, a stage timer and a counter in both states, then the
+packetize + send path of a frame as the server runs it, to compare the
+instrumentation with the work it measures.
+"""
+import os
+import socket
+import time
+
+import click
+
+from xarxes2025.metrics import METRICS, stage_timer
+from xarxes2025.sender import BatchSender
+from xarxes2025.udpdatagram import RTPPacketizer
+
+
+TIMER = stage_timer("bench")
+COUNTER = METRICS.counter("xarxes_bench_total", "Benchmark counter")
+
+
+def per_op(function, count):
+    start = time.perf_counter()
+    function(count)
+    return (time.perf_counter() - start) / count * 1e9
+
+
+def bare(count):
+    for _ in range(count):
+        pass
+
+
+def timed(count):
+    for _ in range(count):
+        with TIMER.time():
+            pass
+
+
+def counted(count):
+    for _ in range(count):
+        COUNTER.inc()
+
+
+def frame_path(frame, frames):
+
+    """ What a session does per frame: packetize, queue and flush through the shared socket """
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    sender = BatchSender("127.0.0.1")
+    packetizer = RTPPacketizer(1400)
+    packetize_time = stage_timer("packetize")
+
+    def run(count):
+        for n in range(count):
+            with packetize_time.time():
+                packets = packetizer.packetize(frame, n)
+            sender.queue(packets, sink.getsockname())
+            sender.flush()
+    return run
+
+
+@click.command()
+@click.option("--count", default=1000000, show_default=True, help="Operations per micro benchmark")
+@click.option("--frames", default=5000, show_default=True, help="Frames through the send path")
+@click.option("--frame-size", default=30000, show_default=True, help="Bytes per frame")
+def main(count, frames, frame_size):
+    base = per_op(bare, count)
+    run_frame = frame_path(os.urandom(frame_size), frames)
+    for enabled in (False, True):
+        METRICS.enabled = enabled
+        state = "enabled" if enabled else "disabled"
+        click.echo(f"{state:9} timer   {per_op(timed, count) - base:8.1f} ns/op")
+        click.echo(f"{state:9} counter {per_op(counted, count) - base:8.1f} ns/op")
+        click.echo(f"{state:9} frame   {per_op(run_frame, frames) / 1000:8.1f} us/frame")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Impairments measured through the network emulator, and what it costs per packet.
+
+    poetry run python benchmarks/bench_netem.py --loss-rate 5 --loss-burst 4 --delay 40 --jitter 10 --seed 1
+
+A stream of frames (packets of --mtu bytes, --packets per frame at
+--frame-rate) goes through one emulated path, on a virtual clock, with
+the same settings as `xarxes2025 server`. The loss rate, mean loss burst,
+delay, reordering and link rate measured on the output are printed next to
+the settings, with a digest of every decision: running it again with the
+same seed must print the same digest. The last line is the time per packet
+of the emulator in the send path.
+"""
+import hashlib
+import heapq
+import statistics
+import time
+
+import click
+
+from xarxes2025.netem import NetworkEmulator
+
+
+class Recorder(object):
+
+    """ Output of the delay line, here the delayed packets are only recorded """
+
+    def __init__(self):
+        self.packets = []
+
+    def __call__(self, packets, address):
+        self.packets.extend(packets)
+
+
+def run_stream(emulator, frames, packets_per_frame, mtu, frame_rate):
+
+    """ Send the stream through a path, returns [(sequence, departure)] of the output and the path counters """
+
+    # No delay line thread, the delayed packets are taken from its heap
+    emulator.thread = False
+    path = emulator.path()
+    output = []
+    for frame in range(frames):
+        now = frame / frame_rate
+        packets = [((frame * packets_per_frame + n).to_bytes(12, "big"), bytes(mtu))
+                   for n in range(packets_per_frame)]
+        immediate, _ = path.impair(packets, None, now)
+        output += [(int.from_bytes(header, "big"), now) for header, _ in immediate]
+
+        # The delay line is emptied by hand on the virtual clock
+        while emulator.heap:
+            due, _, (header, _), _ = heapq.heappop(emulator.heap)
+            output.append((int.from_bytes(header, "big"), due))
+    output.sort(key=lambda item: item[1])
+    return output, path.snapshot()
+
+
+def loss_bursts(received, total):
+
+    """ Lengths of the runs of consecutive lost sequence numbers """
+
+    bursts = []
+    run = 0
+    for sequence in range(total):
+        if sequence in received:
+            if run:
+                bursts.append(run)
+            run = 0
+        else:
+            run += 1
+    if run:
+        bursts.append(run)
+    return bursts
+
+
+@click.command()
+@click.option("--frames", default=5000, show_default=True)
+@click.option("--packets", "packets_per_frame", default=20, show_default=True, help="Packets per frame")
+@click.option("--mtu", default=1400, show_default=True)
+@click.option("--frame-rate", default=25, show_default=True)
+@click.option("--loss-rate", default=5.0, show_default=True)
+@click.option("--loss-burst", default=4.0, show_default=True)
+@click.option("--error", default=0.0, show_default=True, help="Corrupted packets (%)")
+@click.option("--duplicate", default=1.0, show_default=True)
+@click.option("--delay", default=40.0, show_default=True, help="ms")
+@click.option("--jitter", default=10.0, show_default=True, help="+- ms")
+@click.option("--reorder", default=1.0, show_default=True)
+@click.option("--link-rate", default=0.0, show_default=True, help="Mbit/s")
+@click.option("--link-burst", default=64.0, show_default=True, help="KB")
+@click.option("--seed", default=1, show_default=True)
+def main(frames, packets_per_frame, mtu, frame_rate, loss_rate, loss_burst, error, duplicate, delay, jitter,
+         reorder, link_rate, link_burst, seed):
+    recorder = Recorder()
+    emulator = NetworkEmulator(recorder, loss_rate, loss_burst, error, duplicate, delay, jitter, reorder,
+                               link_rate, link_burst, seed)
+    total = frames * packets_per_frame
+    output, counters = run_stream(emulator, frames, packets_per_frame, mtu, frame_rate)
+
+    digest = hashlib.sha256(repr(output).encode()).hexdigest()[:16]
+    received = {sequence for sequence, _ in output}
+    bursts = loss_bursts(received, total)
+    delays = [departure - (sequence // packets_per_frame) / frame_rate for sequence, departure in output]
+    inversions = sum(1 for (a, _), (b, _) in zip(output, output[1:]) if b < a)
+    duration = max(departure for _, departure in output) if output else 0
+    rate = len(output) * (mtu + 12) * 8 / duration / 1e6 if duration else 0
+
+    click.echo(f"{total} packets, seed {seed}, digest {digest}")
+    click.echo(f"loss       {1 - len(received) / total:8.2%}   (set {loss_rate}%, queue drops {counters['queue_drops']})")
+    click.echo(f"burst      {statistics.fmean(bursts) if bursts else 0:8.2f}   (set {loss_burst} packets)")
+    click.echo(f"delay      {statistics.fmean(delays) * 1000:8.2f} ms (set {delay} +- {jitter} ms, "
+               f"p99 {statistics.quantiles(delays, n=100)[98] * 1000:.2f} ms)")
+    click.echo(f"reordered  {inversions / max(len(output), 1):8.2%}   (set {reorder}%, plus the jitter)")
+    click.echo(f"duplicated {counters['duplicated'] / total:8.2%}   (set {duplicate}%)")
+    click.echo(f"corrupted  {counters['corrupted'] / total:8.2%}   (set {error}%)")
+    click.echo(f"rate       {rate:8.2f} Mbit/s (link {link_rate or 'unlimited'})")
+
+    # Cost in the send path, delayed packets are only queued
+    emulator = NetworkEmulator(recorder, loss_rate, loss_burst, error, duplicate, delay, jitter, reorder,
+                               link_rate, link_burst, seed)
+    emulator.thread = False
+    path = emulator.path()
+    packets = [(bytes(12), memoryview(bytes(mtu)))] * packets_per_frame
+    start = time.perf_counter()
+    for frame in range(frames):
+        path.impair(packets, None, frame / frame_rate)
+        emulator.heap.clear()
+    elapsed = time.perf_counter() - start
+    click.echo(f"emulator   {elapsed / total * 1e9:8.0f} ns/packet")
+
+
+if __name__ == "__main__":
+    main()
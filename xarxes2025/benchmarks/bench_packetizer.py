@@ -0,0 +1,72 @@
+"""
+Packets/s of the RTP send path: UDPDatagram per packet against RTPPacketizer.
+
+    poetry run python benchmarks/bench_packetizer.py --frame-size 60000
+
+Packets are sent to a local UDP socket that is never read, so the kernel
+drops them once its buffer is full, which is fine for measuring the sender.
+"""
+import os
+import socket
+import time
+
+import click
+
+from xarxes2025.rtpjpeg import max_fragment_size, pack_jpeg_header
+from xarxes2025.udpdatagram import UDPDatagram, RTPPacketizer, send_packet
+
+
+def run_udpdatagram(sock, address, frame, mtu, frames):
+    chunk = max_fragment_size(mtu)
+    seqnum = 0
+    packets = 0
+    for n in range(frames):
+        for offset in range(0, len(frame), chunk):
+            payload = pack_jpeg_header(offset, 0, 0, 0) + frame[offset:offset + chunk]
+            last = offset + chunk >= len(frame)
+            datagram = UDPDatagram(seqnum, payload, n, int(last)).get_datagram()
+            if sock:
+                sock.sendto(datagram, address)
+            seqnum = (seqnum + 1) & 0xFFFF
+            packets += 1
+    return packets
+
+
+def run_packetizer(sock, address, frame, mtu, frames):
+    packetizer = RTPPacketizer(mtu)
+    packets = 0
+    for n in range(frames):
+        for packet in packetizer.packetize(frame, n):
+            if sock:
+                send_packet(sock, packet, address)
+            packets += 1
+    return packets
+
+
+def measure(name, function, sock, address, frame, mtu, frames):
+    start = time.perf_counter()
+    packets = function(sock, address, frame, mtu, frames)
+    elapsed = time.perf_counter() - start
+    mode = "build+send" if sock else "build only"
+    click.echo(f"{name:14} {mode:10} {packets / elapsed:12,.0f} packets/s  {frames / elapsed:10,.0f} frames/s")
+
+
+@click.command()
+@click.option("--frame-size", default=60000, show_default=True, help="Bytes per frame")
+@click.option("--mtu", default=1400, show_default=True)
+@click.option("--frames", default=2000, show_default=True, help="Frames per run")
+def main(frame_size, mtu, frames):
+    frame = os.urandom(frame_size)
+
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    address = sink.getsockname()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    for send in (None, sock):
+        measure("UDPDatagram", run_udpdatagram, send, address, frame, mtu, frames)
+        measure("RTPPacketizer", run_packetizer, send, address, frame, mtu, frames)
+
+
+if __name__ == "__main__":
+    main()
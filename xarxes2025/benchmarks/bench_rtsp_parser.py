@@ -0,0 +1,65 @@
+"""
+Requests/s of the RTSP parser against splitting the whole request for each field.
+
+    poetry run python benchmarks/bench_rtsp_parser.py --requests 100000
+
+The same pipelined stream of requests is fed whole, in reads of 1024
+bytes and byte by byte. The framing itself is checked by tests/test_rtsp.py.
+"""
+import time
+
+import click
+
+from xarxes2025.rtsp import RTSPParser, parse_transport
+
+
+def parse_split(data):
+
+    """ What the sessions did before RTSPParser: split the whole string for each field """
+
+    text = data.decode()
+    method = text.split(" ")[0]
+    uri = text.split(" ")[1].strip()
+    cseq = "0"
+    for line in text.split("\n"):
+        if line.startswith("CSeq"):
+            cseq = line.split(":")[1].strip()
+    for line in text.split("\n"):
+        if "Transport" in line:
+            for part in line.split(";"):
+                if "client_port" in part:
+                    int(part.split("=")[1])
+    return method, uri, cseq
+
+
+def measure(name, requests, elapsed):
+    click.echo(f"{name:14} {requests / elapsed:12,.0f} requests/s")
+
+
+@click.command()
+@click.option("--requests", default=100000, show_default=True, help="Requests per run")
+def main(requests):
+    request = (b"SETUP rick.webm RTSP/1.0\r\nCSeq: 1\r\n"
+               b"Transport: RTP/UDP; client_port= 25000\r\n\r\n")
+    stream = request * requests
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        parse_split(request)
+    measure("split", requests, time.perf_counter() - start)
+
+    for name, size in (("whole", len(stream)), ("1024 B reads", 1024), ("byte by byte", 1)):
+        count = requests if size > 1 else requests // 100
+        data = stream[:count * len(request)]
+        parser = RTSPParser()
+        parsed = 0
+        start = time.perf_counter()
+        for pos in range(0, len(data), size):
+            for r in parser.feed(data[pos:pos + size]):
+                parse_transport(r.header("Transport", ""))
+                parsed += 1
+        measure(name, parsed, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
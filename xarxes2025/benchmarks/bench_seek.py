@@ -0,0 +1,64 @@
+"""
+Latency of PLAY Range seeks and of the catch-up skips, with and without the frame index.
+
+    poetry run python benchmarks/bench_seek.py rick.webm --seeks 50
+
+Random seeks cost one seek and at most a GOP of decoding either way. The
+index pays off on short forward skips (a late sender, sessions sharing the
+frame cache): without a keyframe in between it decodes forward instead of
+seeking back to the previous keyframe. The index is built (or loaded from
+VIDEOFILE.xix) first and its build time reported.
+"""
+import random
+import time
+
+import click
+
+from xarxes2025.framecache import FrameCache
+from xarxes2025.frameindex import FrameIndex, INDEXES, load_index
+from xarxes2025.loadclient import percentiles
+from xarxes2025.videoprocessor import VideoProcessor
+
+
+def measure(name, video, jumps):
+    times = []
+    for target in jumps:
+        start = time.perf_counter()
+        video.seek(target)
+        if video.next_frame() is None:
+            break
+        times.append((time.perf_counter() - start) * 1000)
+    click.echo(f"{name:28} {percentiles(times)} ms")
+
+
+@click.command()
+@click.argument("videofile", type=click.Path(exists=True))
+@click.option("--seeks", default=50, show_default=True, help="Random seeks")
+@click.option("--skip", default=3, show_default=True, help="Frames skipped forward by each catch-up")
+@click.option("--seed", default=1, show_default=True)
+def main(videofile, seeks, skip, seed):
+    INDEXES.clear()
+    start = time.perf_counter()
+    index = load_index(videofile)
+    click.echo(f"index: {index.frame_count} frames, {len(index.keyframes)} keyframes, "
+               f"{index.duration:.1f} s, loaded in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    rng = random.Random(seed)
+    last = max(index.frame_count - 1, 1)
+    random_jumps = [rng.randrange(last) for _ in range(seeks)]
+    skips = list(range(0, min(last, seeks * (skip + 1)), skip + 1))
+
+    # The frame cache would hide the decoding
+    video = VideoProcessor(videofile, cache=FrameCache(0))
+    measure("random seeks, index", video, random_jumps)
+    measure(f"skips of {skip}, index", video, skips)
+
+    # Same video with every frame a keyframe: always cap.set, as before the index
+    video = VideoProcessor(videofile, cache=FrameCache(0))
+    video.index = FrameIndex(index.timestamps, list(range(index.frame_count)), index.fps)
+    measure("random seeks, no index", video, random_jumps)
+    measure(f"skips of {skip}, no index", video, skips)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Datagrams/s and syscalls of the batched sender against one send per datagram.
+
+    poetry run python benchmarks/bench_sender.py --sessions 200
+
+Simulates one scheduler tick after another where every session queues the
+packets of a frame, then the tick is flushed.
+"""
+import os
+import socket
+import time
+
+import click
+
+from xarxes2025.sender import BatchSender
+from xarxes2025.udpdatagram import RTPPacketizer
+
+
+def run(sender, sessions, frame, mtu, ticks, address):
+    packetizers = [RTPPacketizer(mtu, ssrc=n) for n in range(sessions)]
+    start = time.perf_counter()
+    for tick in range(ticks):
+        for packetizer in packetizers:
+            sender.queue(packetizer.packetize(frame, tick), address)
+        sender.flush()
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option("--sessions", default=200, show_default=True)
+@click.option("--frame-size", default=8000, show_default=True, help="Bytes per frame")
+@click.option("--mtu", default=1400, show_default=True)
+@click.option("--ticks", default=50, show_default=True)
+def main(sessions, frame_size, mtu, ticks):
+    frame = os.urandom(frame_size)
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(("127.0.0.1", 0))
+    address = sink.getsockname()
+
+    for batched in (False, True):
+        sender = BatchSender("127.0.0.1")
+        if not batched:
+            sender.sendmmsg = None
+        elapsed = run(sender, sessions, frame, mtu, ticks, address)
+        stats = sender.stats()
+        click.echo(f"{stats['mode']:9} {stats['datagrams'] / elapsed:12,.0f} datagrams/s "
+                   f"{stats['syscalls'] / elapsed:12,.0f} syscalls/s")
+        sender.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Check that the session timeout expires idle sessions only.
+
+    poetry run python benchmarks/bench_session_timeout.py rick.webm --session-timeout 3
+
+Starts `xarxes2025 server --session-timeout T` and, for --periods x T seconds:
+
+- headless viewers watch the live channel of the video: their receiver
+  reports about the channel's stream must keep every one of them playing;
+- a session in READY sends a GET_PARAMETER every T / 2, as the Tk client
+  does: it must still answer at the end;
+- a session in READY sends nothing: the server must have closed it.
+
+Fails with an AssertionError on the first check that doesn't hold.
+"""
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import click
+
+from xarxes2025.loadclient import run_bench
+
+from bench_workers import wait_listening
+
+
+def rtsp(connection, method, filename, cseq, headers=""):
+
+    """ Send a request, return the status code of its response or None if the connection closed """
+
+    connection.sendall(f"{method} {filename} RTSP/1.0\r\nCSeq: {cseq}\r\n{headers}\r\n".encode())
+    try:
+        response = connection.recv(4096)
+    except OSError:
+        return None
+    return int(response.split()[1]) if response else None
+
+
+def setup(port, filename, client_port):
+    connection = socket.create_connection(("127.0.0.1", port))
+    connection.settimeout(5)
+    status = rtsp(connection, "SETUP", filename, 1, f"Transport: RTP/UDP; client_port= {client_port}\r\n")
+    assert status == 200, f"SETUP answered {status}"
+    return connection
+
+
+@click.command()
+@click.argument("videofile", type=click.Path(exists=True))
+@click.option("--session-timeout", default=3, show_default=True, help="Seconds, of the server")
+@click.option("--periods", default=3, show_default=True, help="Timeouts each check lasts")
+@click.option("--viewers", default=4, show_default=True)
+@click.option("--frame-rate", default=25, show_default=True)
+@click.option("--engine", default="threads", show_default=True, type=click.Choice(["threads", "asyncio"]))
+@click.option("--port", default=6600, show_default=True)
+def main(videofile, session_timeout, periods, viewers, frame_rate, engine, port):
+    command = [sys.executable, "-m", "xarxes2025", "server", "-p", str(port), "--engine", engine,
+               "--frame-rate", str(frame_rate), "--session-timeout", str(session_timeout)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    duration = session_timeout * periods
+    try:
+        wait_listening(port)
+
+        result = run_bench("127.0.0.1", port, f"channel/{videofile}", viewers, duration)
+        assert result["failed"] == 0, f"{result['failed']} channel viewers failed"
+        for session in result["sessions"]:
+            assert session["frames"] >= 0.8 * duration * frame_rate, \
+                f"channel viewer got {session['frames']} frames in {duration} s"
+        click.echo(f"{viewers} channel viewers played {duration} s, {result['frames_per_s']:.1f} frames/s: ok")
+
+        kept = setup(port, videofile, 40000)
+        idle = setup(port, videofile, 40002)
+        cseq = 2
+        end = time.monotonic() + duration
+        while time.monotonic() < end:
+            time.sleep(session_timeout / 2)
+            assert rtsp(kept, "GET_PARAMETER", videofile, cseq) == 200, "session with keepalives expired"
+            cseq += 1
+        assert rtsp(kept, "OPTIONS", videofile, cseq) == 200, "session with keepalives expired"
+        click.echo(f"session in READY with GET_PARAMETER every {session_timeout / 2} s alive after {duration} s: ok")
+        assert rtsp(idle, "OPTIONS", videofile, 2) is None, "idle session not expired"
+        click.echo(f"idle session in READY closed after the {session_timeout} s timeout: ok")
+        kept.close()
+        idle.close()
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
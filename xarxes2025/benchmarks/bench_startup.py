@@ -0,0 +1,104 @@
+"""
+Startup time and memory of each subcommand, and the heavy modules it loads.
+
+    poetry run python benchmarks/bench_startup.py --runs 5
+
+Every case runs in a fresh interpreter with -X importtime: it imports the
+CLI and then what the subcommand imports before doing any work. The wall
+time, the import time of all the modules, of the xarxes2025 ones and of
+the heaviest other package, the maximum RSS and the heavy modules loaded
+are reported. The "eager" case imports every subcommand at once, as cli.py did before
+the imports were moved into the subcommands. Exits with 1 if a server
+loads tkinter or PIL, or a client loads cv2.
+"""
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+
+HEAVY = ("cv2", "numpy", "tkinter", "PIL")
+
+CASES = {
+    "help": [],
+    "server": ["xarxes2025.server"],
+    "server asyncio": ["xarxes2025.aioserver"],
+    "client": ["xarxes2025.client"],
+    "pack": ["xarxes2025.packedvideo"],
+    "bench": ["xarxes2025.loadclient"],
+    "eager": ["xarxes2025.server", "xarxes2025.aioserver", "xarxes2025.client",
+              "xarxes2025.packedvideo", "xarxes2025.loadclient"],
+}
+
+# Heavy modules a subcommand must not load
+FORBIDDEN = {
+    "server": ("tkinter", "PIL"),
+    "server asyncio": ("tkinter", "PIL"),
+    "client": ("cv2",),
+}
+
+PROBE = """
+import resource, sys
+import xarxes2025.cli
+{imports}
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+print(" ".join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+def parse_importtime(stderr):
+
+    """ Import time in ms of each top level package, from the self times of the -X importtime lines """
+
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        own, _, name = line[len("import time:"):].split("|")
+        if not own.strip().isdigit():
+            continue
+        package = name.strip().split(".")[0]
+        times[package] = times.get(package, 0) + int(own) / 1000
+    return times
+
+
+def run_case(modules):
+
+    """ Start an interpreter importing modules, returns wall ms, import times, RSS in MB and heavy modules """
+
+    code = PROBE.format(imports="\n".join(f"import {module}" for module in modules), heavy=HEAVY)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            capture_output=True, text=True, check=True)
+    wall = (time.perf_counter() - start) * 1000
+    rss, heavy = result.stdout.splitlines()[-2:]
+    return wall, parse_importtime(result.stderr), int(rss) / 1024, heavy.split()
+
+
+@click.command()
+@click.option("--runs", default=5, show_default=True, help="Interpreters started per case, the median is reported")
+def main(runs):
+    failed = False
+    click.echo(f"{'case':16} {'wall ms':>8} {'import ms':>9} {'xarxes ms':>10} {'RSS MB':>7}  "
+               f"heaviest package, heavy modules")
+    for name, modules in CASES.items():
+        samples = [run_case(modules) for _ in range(runs)]
+        wall = statistics.median(sample[0] for sample in samples)
+        rss = statistics.median(sample[2] for sample in samples)
+        times = samples[-1][1]
+        heavy = samples[-1][3]
+        others = {package: ms for package, ms in times.items() if package != "xarxes2025"}
+        heaviest = max(others, key=others.get) if others else "-"
+        click.echo(f"{name:16} {wall:8.1f} {sum(times.values()):9.1f} {times.get('xarxes2025', 0):10.1f} {rss:7.1f}  "
+                   f"{heaviest} {others.get(heaviest, 0):.1f} ms, {' '.join(heavy) or 'none'}")
+        forbidden = [module for module in FORBIDDEN.get(name, ()) if module in heavy]
+        if forbidden:
+            click.echo(f"  {name} loads {' '.join(forbidden)}")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
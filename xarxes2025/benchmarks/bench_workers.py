@@ -0,0 +1,80 @@
+"""
+Frames/s delivered to many viewers by a single server process and by --workers N.
+
+    poetry run python benchmarks/bench_workers.py rick.webm --viewers 32 --max-workers 4
+
+Each case starts `xarxes2025 server` on its own port, with the frame cache
+disabled so every session encodes its frames, and loads it with headless
+viewers from this process for --duration seconds. The frames/s received
+are compared with what the viewers asked for (viewers x frame rate), and
+the CPU seconds of the server and its workers are reported. With enough
+cores the delivered frames/s grow about linearly with the workers until
+every viewer gets its full frame rate.
+"""
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import click
+
+from xarxes2025.loadclient import run_bench
+
+
+def wait_listening(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise IOError(f"server not listening on port {port}")
+
+
+def children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(name, videofile, port, workers, viewers, duration, frame_rate, engine):
+    command = [sys.executable, "-m", "xarxes2025", "server", "-p", str(port), "--cache-size", "0",
+               "--frame-rate", str(frame_rate), "--engine", engine, "--workers", str(workers)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    cpu = children_cpu()
+    try:
+        wait_listening(port)
+        result = run_bench("127.0.0.1", port, videofile, viewers, duration)
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+    cpu = children_cpu() - cpu
+    wanted = viewers * frame_rate
+    click.echo(f"{name:12} {result['frames_per_s']:10,.1f} {result['frames_per_s'] / wanted:7.0%} "
+               f"{result['failed']:7} {cpu:8.1f}")
+
+
+@click.command()
+@click.argument("videofile", type=click.Path(exists=True))
+@click.option("--viewers", default=32, show_default=True)
+@click.option("--duration", default=10, show_default=True, help="Seconds each case plays")
+@click.option("--frame-rate", default=25, show_default=True)
+@click.option("--max-workers", default=os.cpu_count(), show_default=True)
+@click.option("--engine", default="threads", show_default=True, type=click.Choice(["threads", "asyncio"]))
+@click.option("--port", default=6400, show_default=True, help="Port of the first case, the next ones use the following ports")
+def main(videofile, viewers, duration, frame_rate, max_workers, engine, port):
+    click.echo(f"{viewers} viewers at {frame_rate} fps, {os.cpu_count()} CPUs, {engine} engine")
+    click.echo(f"{'server':12} {'frames/s':>10} {'of asked':>7} {'failed':>7} {'CPU s':>8}")
+    measure("1 process", videofile, port, 0, viewers, duration, frame_rate, engine)
+    workers = 1
+    while workers <= max_workers:
+        port += 1
+        measure(f"{workers} workers", videofile, port, workers, viewers, duration, frame_rate, engine)
+        workers *= 2
+
+
+if __name__ == "__main__":
+    main()
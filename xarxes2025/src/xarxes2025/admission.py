@@ -0,0 +1,161 @@
+import threading
+
+from loguru import logger
+
+
+# Bitrate reserved for a session before it sends anything, when there is
+# no --max-bitrate cap nor a playing session to learn it from
+DEFAULT_SESSION_BITRATE = 2000000
+
+# Connections accepted per admitted session, the rest are closed right away
+# so a burst of clients can't create threads without bound
+CONNECTION_FACTOR = 2
+
+
+class Lease(object):
+
+    """ What an admitted session holds: a live decoder or not, and its bandwidth """
+
+    def __init__(self, decoder, bitrate):
+        self.decoder = decoder
+        self.bitrate = bitrate
+
+        # bytes_sent of the session at the last measure, None before
+        self.bytes_sent = None
+
+
+class AdmissionControl(object):
+    """
+    Limits of a server: sessions, live decoders and egress bandwidth.
+
+    Every SETUP asks for a lease before opening anything. Over the session
+    or decoder limits, or while the server drains, it gets 503 Service
+    Unavailable; over the bandwidth limit 453 Not Enough Bandwidth. The
+    bandwidth of a session is first estimated, then measured every second
+    while it plays, so the sessions already admitted keep their frame rate
+    and the new ones are refused instead. Live channels hold one decoder
+    for all their viewers.
+    """
+
+    def __init__(self, max_sessions=0, max_decoders=0, max_bandwidth=0, session_bitrate=0):
+        """
+        Constructor for AdmissionControl object.
+
+        :param max_sessions: Sessions past SETUP, 0 for no limit.
+        :param max_decoders: Sessions and channels decoding a video live
+                             (VideoCapture handles), 0 for no limit.
+        :param max_bandwidth: Egress of all the sessions in bits per second,
+                              0 for no limit.
+        :param session_bitrate: Bitrate reserved for a new session, 0 to
+                                estimate it from the playing ones.
+        """
+        self.max_sessions = max_sessions
+        self.max_decoders = max_decoders
+        self.max_bandwidth = max_bandwidth
+        self.session_bitrate = session_bitrate
+        self.leases = {}
+        self.channel_decoders = set()
+        self.lock = threading.Lock()
+        self.draining = False
+
+        # Refused SETUPs by status code
+        self.rejected = {453: 0, 503: 0}
+
+    def max_connections(self):
+        """ Connections to keep open, 0 for no limit """
+
+        return self.max_sessions * CONNECTION_FACTOR
+
+    def decoders(self):
+        return sum(1 for lease in self.leases.values() if lease.decoder) + len(self.channel_decoders)
+
+    def bandwidth(self):
+        return sum(lease.bitrate for lease in self.leases.values())
+
+    def estimate(self):
+
+        """ Bitrate to reserve for a new session """
+
+        if self.session_bitrate:
+            return self.session_bitrate
+        measured = [lease.bitrate for lease in self.leases.values() if lease.bytes_sent is not None]
+        return sum(measured) / len(measured) if measured else DEFAULT_SESSION_BITRATE
+
+    def admit(self, session, decoder=True, bitrate=None):
+        """
+        Give a lease to a session doing SETUP.
+
+        :param session: The RTSPSession.
+        :param decoder: True if it decodes its video live.
+        :param bitrate: Bits per second it will send, estimated if None.
+        :returns: None if admitted, else the status code to answer.
+        """
+        with self.lock:
+            status = None
+            if bitrate is None:
+                bitrate = self.estimate()
+            if self.draining:
+                status = 503
+            elif self.max_sessions and len(self.leases) >= self.max_sessions:
+                status = 503
+            elif decoder and self.max_decoders and self.decoders() >= self.max_decoders:
+                status = 503
+            elif self.max_bandwidth and self.bandwidth() + bitrate > self.max_bandwidth:
+                status = 453
+            if status is not None:
+                self.rejected[status] += 1
+                return status
+            self.leases[session] = Lease(decoder, bitrate)
+            return None
+
+    def release(self, session):
+        with self.lock:
+            self.leases.pop(session, None)
+
+    def decoder_available(self):
+        """ True if one more live decoder fits, for a new channel """
+
+        with self.lock:
+            return not self.max_decoders or self.decoders() < self.max_decoders
+
+    def add_channel(self, channel):
+        with self.lock:
+            self.channel_decoders.add(channel)
+
+    def remove_channel(self, channel):
+        with self.lock:
+            self.channel_decoders.discard(channel)
+
+    def measure(self, sessions, elapsed):
+        """
+        Replace the estimated bitrate of the playing sessions by the measured one.
+
+        :param sessions: The sessions of the server.
+        :param elapsed: Seconds since the last measure.
+        """
+        with self.lock:
+            for session in sessions:
+                lease = self.leases.get(session)
+                if lease is None or session.state != "PLAYING" or session.channel is not None:
+                    continue
+                if lease.bytes_sent is not None and elapsed > 0:
+                    lease.bitrate = (session.bytes_sent - lease.bytes_sent) * 8 / elapsed
+                lease.bytes_sent = session.bytes_sent
+
+    def stats(self):
+        """ Return a dict with the leases and the refused SETUPs """
+
+        with self.lock:
+            return {
+                "sessions": len(self.leases),
+                "decoders": self.decoders(),
+                "bandwidth_mbps": round(self.bandwidth() / 1e6, 3),
+                "rejected_453": self.rejected[453],
+                "rejected_503": self.rejected[503],
+            }
+
+    def start_drain(self):
+        """ Refuse every new SETUP, the server is shutting down """
+
+        self.draining = True
+        logger.info(f"Draining, {len(self.leases)} sessions left")
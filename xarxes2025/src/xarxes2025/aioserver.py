@@ -0,0 +1,368 @@
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import signal
+import socket
+import time
+
+from loguru import logger
+from xarxes2025.metrics import stage_timer
+from xarxes2025.rtsp import BadRequest, RTSPParser
+from xarxes2025.framecache import FRAME_CACHE
+from xarxes2025.scheduler import FramePrefetch
+from xarxes2025.sender import DATAGRAMS, SEND_TIME, SYSCALLS
+from xarxes2025.server import REAP_INTERVAL, RTSPSession, ServerEngine, reap_sessions
+
+
+SLEEP_TIME = stage_timer("pacing_sleep")
+
+
+class AsyncClientSession(RTSPSession, asyncio.Protocol):
+
+    """ RTSP session served from the event loop.
+
+    The control connection is an asyncio protocol and the frames are sent by
+    a task through the datagram transport shared by all the sessions, so a
+    session costs no OS thread. """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.stream_task = None
+        self.playing = asyncio.Event()
+        self.parser = RTSPParser()
+
+        # Requests waiting for the blocking part of the one before, run in the executor
+        self.pending = collections.deque()
+        self.blocked = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+        # Over the connection limit, close it before it can do anything
+        max_connections = self.server.admission.max_connections()
+        if max_connections and len(self.server.sessions) >= max_connections:
+            logger.warning(f"Connection from {transport.get_extra_info('peername')} refused, "
+                           f"{len(self.server.sessions)} open")
+            transport.close()
+            return
+        RTSPSession.__init__(self, transport.get_extra_info("peername"), self.server)
+
+        # Next frame, produced in the server's frame producers while the
+        # stream task waits for its deadline
+        self.prefetch = FramePrefetch(self.server.producers, self.next_video_frame, None)
+        self.server.sessions.add(self)
+
+    def data_received(self, data):
+        try:
+            requests = self.parser.feed(data)
+        except BadRequest as e:
+            self.refuse_request(e)
+            self.transport.close()
+            return
+        self.pending.extend(requests)
+        self.handle_pending()
+
+    def handle_pending(self):
+
+        """ Handle the requests received, in order, until one has to wait for the executor """
+
+        while self.pending and not self.blocked:
+            request = self.pending.popleft()
+            try:
+                self.handle_request(request)
+            except Exception as e:
+                logger.error(f"Error handling client {self.client_address}: {e}")
+
+    def run_blocking(self, work, done):
+
+        """ Run the blocking part of a request in the executor, the next requests wait for it """
+
+        self.blocked = True
+        future = asyncio.get_running_loop().run_in_executor(None, work)
+        future.add_done_callback(functools.partial(self.unblock, done))
+
+    def unblock(self, done, future):
+
+        """ Finish the request whose blocking part ran, and go on with the next ones """
+
+        self.blocked = False
+        if future.cancelled():
+            return
+        error = future.exception()
+        try:
+            done(None if error is not None else future.result(), error)
+        except Exception as e:
+            logger.error(f"Error handling client {self.client_address}: {e}")
+
+        # The connection closed meanwhile, free what the request took
+        if self not in self.server.sessions:
+            self.stop_streaming()
+            self.release()
+            return
+        self.handle_pending()
+
+    def connection_lost(self, exc):
+        # Refused connections had no session
+        if self not in self.server.sessions:
+            return
+        self.stop_streaming()
+        self.release()
+        self.server.sessions.discard(self)
+
+    async def stream_udp(self):
+
+        """ Video streaming loop, paced on absolute deadlines of the (monotonic) loop clock """
+
+        loop = asyncio.get_running_loop()
+        period = 1 / self.frame_rate
+        deadline = loop.time()
+
+        # Decoding and encoding may block: the next frame is produced in the
+        # executor while the loop waits for its deadline, so the sessions
+        # encode in parallel. stop_streaming waits for it before the video
+        # is released.
+        video = self.video
+        prefetch = self.prefetch
+        prefetch.start()
+        try:
+            while True:
+                if not self.playing.is_set():
+                    await self.playing.wait()
+                    deadline = loop.time()
+                with SLEEP_TIME.time():
+                    await asyncio.sleep(max(0, deadline - loop.time()))
+
+                # A frame produced before a PLAY Range is of the old position
+                if self.pending_seek is not None:
+                    prefetch.discard()
+                prefetch.start()
+                await asyncio.wait([asyncio.wrap_future(prefetch.future)])
+                frame_data = prefetch.take()
+
+                # A TEARDOWN may have come meanwhile and released the video
+                if self.video is not video or self.stream_task is not asyncio.current_task():
+                    break
+                deadline = self.catch_up(deadline, loop.time())
+                if not self.send_frame(frame_data):
+                    logger.debug(f"Session {self.sessionid} stream finished")
+                    break
+                prefetch.start()
+                deadline += period
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if self.stream_task is asyncio.current_task():
+                logger.error(f"Error in UDP streaming: {e}")
+        finally:
+            if self.stream_task is asyncio.current_task():
+                self.stream_task = None
+
+    def send_response(self, response):
+        self.transport.write(response.encode())
+
+    def send_packets(self, packets, address):
+        self.server.send_packets(packets, address)
+
+    def start_streaming(self):
+        if self.stream_task is None:
+            self.stream_task = asyncio.get_running_loop().create_task(self.stream_udp())
+
+    def pause_streaming(self):
+        self.playing.clear()
+
+    def resume_streaming(self):
+        self.playing.set()
+
+    def stop_streaming(self):
+        self.playing.clear()
+        if self.stream_task is not None:
+            self.stream_task.cancel()
+            self.stream_task = None
+        self.prefetch.reset()
+
+    def is_streaming(self):
+        return self.stream_task is not None and self.playing.is_set()
+
+    def close_connection(self):
+        self.transport.close()
+
+
+class RTCPProtocol(asyncio.DatagramProtocol):
+
+    """ RTCP port of the asyncio engine """
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+
+    def datagram_received(self, data, address):
+        self.dispatcher.handle(data, address)
+
+
+class AsyncServer(ServerEngine):
+
+    """ Server engine running every session on a single event loop """
+
+    def __init__(self, **options):
+        ServerEngine.__init__(self, **options)
+        self.loop = None
+        self.udp_transport = None
+        self.rtcp_transport = None
+
+        # Set by the signal handlers: the first signal drains, the second stops
+        self.stopping = None
+        self.drain_task = None
+
+        # Live channels, each one streamed by its own task
+        self.channel_tasks = {}
+
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logger.warning("Server interrupted by user")
+        finally:
+            if self.encoder:
+                self.encoder.close()
+            if self.netem is not None:
+                self.netem.close()
+                logger.info(f"Network emulator {self.netem.stats()}")
+            logger.info(f"Server shutdown, admission {self.admission.stats()}, frame cache {FRAME_CACHE.stats()}")
+
+    async def serve(self):
+
+        """ Open the shared RTP transport and accept RTSP connections """
+
+        loop = self.loop = asyncio.get_running_loop()
+
+        # Threads producing the next frame of every stream, and opening the videos
+        self.producers = concurrent.futures.ThreadPoolExecutor(max_workers=self.producer_threads,
+                                                               thread_name_prefix="frame-producer")
+        loop.set_default_executor(self.producers)
+        self.udp_transport, _ = await loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol, local_addr=(self.host, 0))
+        self.udp_transport.get_extra_info("socket").setsockopt(
+            socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicast_ttl)
+        self.rtp_port = self.udp_transport.get_extra_info("sockname")[1]
+
+        # Receiver reports of every session go to the RTCP dispatcher
+        self.rtcp_transport, _ = await loop.create_datagram_endpoint(
+            lambda: RTCPProtocol(self.rtcp), local_addr=(self.host, 0))
+        self.rtcp_port = self.rtcp_transport.get_extra_info("sockname")[1]
+        server = await loop.create_server(lambda: AsyncClientSession(self), self.host, self.port,
+                                          backlog=self.backlog, reuse_port=self.worker is not None)
+        logger.info(f"Asyncio server listening on {self.host}:{self.port}")
+
+        # SIGINT and SIGTERM drain, a second one stops right away
+        self.stopping = asyncio.Event()
+        try:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(signum, self.on_signal, server)
+        except NotImplementedError:
+            pass
+        reaper = loop.create_task(self.reap_sessions())
+
+        try:
+            async with server:
+                await self.stopping.wait()
+        finally:
+            reaper.cancel()
+            for session in list(self.sessions):
+                session.close_connection()
+            self.udp_transport.close()
+            self.rtcp_transport.close()
+
+    def on_signal(self, server):
+
+        """ Signal handler: start draining, or stop if already draining """
+
+        if self.drain_task is None:
+            logger.warning("Server interrupted by user")
+            self.drain_task = asyncio.get_running_loop().create_task(self.drain(server))
+        else:
+            logger.warning("Drain interrupted by user")
+            self.stopping.set()
+
+    async def drain(self, server):
+
+        """ Graceful shutdown: refuse new sessions and let the streaming ones go on for drain_timeout s """
+
+        self.admission.start_drain()
+        server.close()
+        deadline = time.monotonic() + self.drain_timeout
+        while time.monotonic() < deadline and any(session.is_streaming() for session in list(self.sessions)):
+            await asyncio.sleep(0.1)
+        self.stopping.set()
+
+    async def reap_sessions(self):
+
+        """ Housekeeping task, see server.reap_sessions """
+
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(REAP_INTERVAL)
+            now = time.monotonic()
+            reap_sessions(self, now, now - last)
+            last = now
+
+    def send_packets(self, packets, address):
+
+        """ Send datagrams through the shared transport """
+
+        # Datagram transports take a single buffer, no scatter-gather here
+        with SEND_TIME.time():
+            for header, payload in packets:
+                self.udp_transport.sendto(b"".join((header, payload)), address)
+        DATAGRAMS.inc(len(packets))
+        SYSCALLS.inc(len(packets))
+
+    def send_delayed(self, packets, address):
+
+        """ Delay line of the network emulator, from its thread: send on the event loop """
+
+        self.loop.call_soon_threadsafe(self.send_packets, packets, address)
+
+    def send_rtcp(self, packet, address):
+        self.rtcp_transport.sendto(packet, address)
+
+    def start_channel(self, channel):
+        if channel not in self.channel_tasks:
+            self.channel_tasks[channel] = asyncio.get_running_loop().create_task(self.stream_channel(channel))
+
+    def stop_channel(self, channel):
+        task = self.channel_tasks.pop(channel, None)
+        if task is not None:
+            task.cancel()
+
+        # A frame still being produced would race the next task on the video
+        if channel.prefetch is not None:
+            channel.prefetch.reset()
+
+    async def stream_channel(self, channel):
+
+        """ Live channel loop, paced like a session on absolute deadlines of the loop clock """
+
+        loop = asyncio.get_running_loop()
+        period = 1 / self.frame_rate
+        deadline = loop.time()
+        if channel.prefetch is None:
+            channel.prefetch = FramePrefetch(self.producers, channel.next_frame, None)
+        prefetch = channel.prefetch
+        prefetch.start()
+        try:
+            while True:
+                with SLEEP_TIME.time():
+                    await asyncio.sleep(max(0, deadline - loop.time()))
+                prefetch.start()
+                await asyncio.wait([asyncio.wrap_future(prefetch.future)])
+                frame_data = prefetch.take()
+                deadline = channel.catch_up(deadline, loop.time())
+                channel.send_frame(frame_data)
+                prefetch.start()
+                deadline += period
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in channel {channel.name}: {e}")
+            self.channel_tasks.pop(channel, None)
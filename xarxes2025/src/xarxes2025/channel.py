@@ -0,0 +1,292 @@
+import random
+import threading
+
+from loguru import logger
+from xarxes2025.fec import FEC_HEADER, FECEncoder
+from xarxes2025.metrics import stage_timer
+from xarxes2025.packedvideo import open_video
+from xarxes2025.rtpjpeg import CLOCK_RATE
+from xarxes2025.scheduler import NOT_READY, PRODUCE_RETRY, FramePrefetch, PacingStats
+from xarxes2025.udpdatagram import RTPPacketizer
+
+
+# SETUP of "channel/<video>" joins the live channel of <video>
+CHANNEL_PREFIX = "channel/"
+
+PACKETIZE_TIME = stage_timer("packetize")
+
+
+class Channel(object):
+    """
+    Live channel playing a video once for all its viewers.
+
+    The channel has its own place in the pacing schedule: every frame is
+    read, encoded and packetized once, and the same packets are then queued
+    for each viewer (unicast fan-out) or sent once to a multicast group.
+    Viewers join a stream that is already running, so there is nothing to
+    pause or seek; PAUSE only stops the delivery to that viewer. The video
+    loops, with RTP timestamps that keep growing.
+    """
+
+    def __init__(self, name, server, group=None):
+        """
+        Constructor for Channel object.
+
+        :param name: Video file played by the channel.
+        :param server: Server engine, provides the configuration and
+                       send_packets/start_channel/stop_channel.
+        :param group: (address, port) of the multicast group, None for
+                      unicast fan-out.
+        """
+        self.name = name
+        self.server = server
+        self.group = group
+        self.frame_rate = server.frame_rate
+        self.video = open_video(name, server.resolution, server.max_quality, server.encoder, server.jpeg)
+
+        width, height = self.video.get_size()
+        self.ssrc = random.getrandbits(32)
+        self.packetizer = RTPPacketizer(server.mtu - (FEC_HEADER.size if server.fec else 0), ssrc=self.ssrc)
+        self.packetizer.set_frame_info(width, height, self.video.quality)
+
+        # Parity packets with the server's --fec, the viewers share the stream and can't ask for others
+        self.fec = FECEncoder(server.fec, self.ssrc) if server.fec else None
+
+        # Sessions that did SETUP, and the ones playing with their address
+        self.members = set()
+        self.viewers = {}
+        self.lock = threading.Lock()
+
+        # Emulated network to each viewer's address, or to the multicast
+        # group, when the server has one
+        self.networks = {}
+
+        # Frames since the channel started, loops included, for the timestamps
+        self.position = 0
+        self.frames_sent = 0
+        self.pacing = PacingStats()
+
+        # The viewers' receiver reports keep their sessions from expiring
+        server.rtcp.register(self.ssrc, self)
+
+        # Next frame produced ahead of its deadline, by on_deadline in the
+        # threaded engine and by the channel task in the asyncio one
+        self.prefetch = None
+        self.late_deadline = None
+
+    def play(self, session, address):
+        """ Start delivering the stream to a session, address is its RTP port """
+
+        with self.lock:
+            first = not self.viewers
+            self.viewers[session] = address
+        if first:
+            self.server.start_channel(self)
+        logger.debug(f"Channel {self.name}: {session.sessionid} playing, {len(self.viewers)} viewers")
+
+    def pause(self, session):
+        """ Stop delivering the stream to a session, the channel goes on for the others """
+
+        with self.lock:
+            if self.viewers.pop(session, None) is None:
+                return
+            last = not self.viewers
+        if last:
+            self.server.stop_channel(self)
+
+    def catch_up(self, deadline, now):
+
+        """ Record the pacing lateness and skip the frames whose time already passed """
+
+        period = 1 / self.frame_rate
+        lateness = now - deadline
+        self.pacing.record(lateness)
+        if lateness >= period:
+            missed = int(lateness / period)
+            self.video.skip(missed)
+            self.position += missed
+            self.pacing.skipped += missed
+            deadline += missed * period
+        return deadline
+
+    def next_frame(self):
+
+        """ Return the next frame, starting the video over at its end """
+
+        frame_data = self.video.next_frame()
+        if frame_data is None:
+            self.video = open_video(self.name, self.server.resolution, self.server.max_quality,
+                                    self.server.encoder, self.server.jpeg)
+            frame_data = self.video.next_frame()
+        return frame_data
+
+    def send_frame(self, frame_data):
+
+        """ Packetize a frame once and deliver it to every viewer """
+
+        if not frame_data:
+            return
+        self.position += 1
+        timestamp = (self.position * CLOCK_RATE // self.frame_rate) & 0xFFFFFFFF
+        with PACKETIZE_TIME.time():
+            packets = self.packetizer.packetize(frame_data, timestamp)
+        if self.fec is not None:
+            packets = self.fec.protect(packets, timestamp)
+        self.frames_sent += 1
+
+        if self.group is not None:
+            self.server.send_packets(self.impair(packets, self.group), self.group)
+            return
+        with self.lock:
+            addresses = list(self.viewers.values())
+        for address in addresses:
+            self.server.send_packets(self.impair(packets, address), address)
+
+    def on_receiver_report(self, block, rtt, address):
+
+        """ RTCP dispatcher callback: hand a report about the channel's stream to the member that sent it """
+
+        host, port = address
+        with self.lock:
+            members = [session for session in self.members
+                       if session.client_address[0] == host and port in self.report_ports(session)]
+        for session in members:
+            session.on_receiver_report(block, rtt, address)
+
+    def report_ports(self, session):
+
+        """ Ports a member may send its receiver reports from: its RTP and RTCP ports, or the group's """
+
+        ports = {session.client_udp_port, session.client_udp_port + 1}
+        if self.group is not None:
+            ports.update((self.group[1], self.group[1] + 1))
+        return ports
+
+    def impair(self, packets, address):
+
+        """ Packets of a frame through the emulated network to address, if the server has one """
+
+        netem = self.server.netem
+        if netem is None:
+            return packets
+        network = self.networks.get(address)
+        if network is None:
+            network = self.networks[address] = netem.path()
+        return network.impair(packets, address)[0]
+
+    def close(self):
+
+        """ Stop taking reports, add up the counters of the emulated networks and drop the next frame """
+
+        self.server.rtcp.unregister(self.ssrc)
+        for network in self.networks.values():
+            self.server.netem.close_path(network)
+        self.networks.clear()
+        if self.prefetch is not None:
+            self.prefetch.reset()
+
+    def on_deadline(self, deadline, now):
+
+        """ Pacing scheduler callback: send the frame due at deadline, return the next deadline """
+
+        if not self.viewers:
+            return None
+        if self.prefetch is None:
+            self.prefetch = FramePrefetch(self.server.producers, self.next_frame,
+                                          lambda: self.server.scheduler.wake(self))
+        frame_data = self.prefetch.take()
+        if frame_data is NOT_READY:
+            if self.late_deadline is None:
+                self.late_deadline = deadline
+            return now + PRODUCE_RETRY
+        if self.late_deadline is not None:
+            deadline, self.late_deadline = self.late_deadline, None
+
+        deadline = self.catch_up(deadline, now)
+        self.send_frame(frame_data)
+        self.prefetch.start()
+        return deadline + 1 / self.frame_rate
+
+    def transport(self, session):
+        """
+        Transport header value of the SETUP response of a member.
+
+        Besides where the stream goes, it tells the server's RTCP port and
+        the SSRC of the channel: the receiver reports of the viewers keep
+        their sessions from expiring while they watch.
+        """
+        server = self.server
+        if self.group is None:
+            port = session.client_udp_port
+            transport = f"RTP/UDP;unicast;client_port={port}-{port + 1}"
+        else:
+            address, port = self.group
+            transport = f"RTP/UDP;multicast;destination={address};port={port}-{port + 1};ttl={server.multicast_ttl}"
+        transport += f";server_port={server.rtp_port}-{server.rtcp_port};ssrc={self.ssrc:08X}"
+        if self.fec is not None:
+            transport += f";fec={self.fec.k}"
+        return transport
+
+
+class ChannelRegistry(object):
+    """
+    Live channels of a server, one per video and delivery mode.
+
+    A channel is created by the SETUP of its first member and closed at
+    the TEARDOWN of its last one. Multicast channels get a port each,
+    starting at the server's multicast port.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.next_port = server.multicast_port
+
+    def join(self, name, session, multicast=False):
+        """
+        Add a session to the channel of a video, creating it if needed.
+
+        :param name: Video file of the channel.
+        :param session: The RTSP session joining.
+        :param multicast: Deliver by multicast, falls back to unicast
+                          fan-out when the server has no multicast group.
+        :returns: The Channel. Raises IOError if the video can't be opened.
+        """
+        multicast = multicast and self.server.multicast_group is not None
+        key = (name, multicast)
+        with self.lock:
+            channel = self.channels.get(key)
+            if channel is None:
+                group = None
+                if multicast:
+                    group = (self.server.multicast_group, self.next_port)
+                    self.next_port += 2
+                channel = self.channels[key] = Channel(name, self.server, group)
+                logger.info(f"Channel {name} opened, {'multicast to ' + str(group) if group else 'unicast fan-out'}")
+                if channel.video.adaptive:
+                    self.server.admission.add_channel(channel)
+            channel.members.add(session)
+        return channel
+
+    def is_open(self, name, multicast=False):
+        """ True if the channel of a video is already playing """
+
+        multicast = multicast and self.server.multicast_group is not None
+        with self.lock:
+            return (name, multicast) in self.channels
+
+    def leave(self, channel, session):
+        """ Remove a session from its channel, closing the channel after its last member """
+
+        channel.pause(session)
+        with self.lock:
+            channel.members.discard(session)
+            if channel.members:
+                return
+            key = (channel.name, channel.group is not None)
+            if self.channels.get(key) is channel:
+                del self.channels[key]
+        self.server.admission.remove_channel(channel)
+        channel.close()
+        logger.info(f"Channel {channel.name} closed, {channel.frames_sent} frames sent, pacing {channel.pacing.snapshot()}")
@@ -1,12 +1,16 @@
 import click
+import json
 import sys 
 
 
 from loguru import logger
 
+from xarxes2025.delta import DELTA_MODES
+from xarxes2025.encoders import ENCODERS, SUBSAMPLINGS
+from xarxes2025.fec import MAX_GROUP
 
-from xarxes2025.server import Server
-from xarxes2025.client import Client
+# Each subcommand imports what it runs: a server never loads Tk nor PIL and
+# a client never loads OpenCV (see benchmarks/bench_startup.py)
 
 
 @click.group()
@@ -55,6 +59,19 @@ def cli(ctx, debug, debug_level, debug_file, debug_filename):
     logger.debug(f"Debug file is {debug_file}")
 
 
+def parse_resolution(ctx, param, value):
+
+    """ Convert a WIDTHxHEIGHT option to a tuple, None for 'source' """
+
+    if value.lower() == "source":
+        return None
+    try:
+        width, height = (int(v) for v in value.lower().split("x"))
+    except ValueError:
+        raise click.BadParameter("use WIDTHxHEIGHT or 'source'")
+    return (width, height)
+
+
 @cli.command(name="server")
 @click.pass_context
 @click.option(
@@ -92,31 +109,328 @@ def cli(ctx, debug, debug_level, debug_file, debug_filename):
     help="Loss rate of UDP/RTP stream (0-100)",
     default=0,
     show_default=True,
-    type=int
+    type=click.FloatRange(0, 100)
 )
 @click.option(
     "--error",
-    help="Simulate server error (0 = none)",
+    help="Percent of RTP packets with a corrupted payload byte (0 = none)",
+    default=0,
+    show_default=True,
+    type=float
+)
+@click.option(
+    "--loss-burst",
+    help="Mean length in packets of the --loss-rate losses, bursts with a Gilbert-Elliott model above 1",
+    default=1.0,
+    show_default=True,
+    type=click.FloatRange(min=1)
+)
+@click.option(
+    "--delay",
+    help="Delay of the RTP packets (ms)",
+    default=0,
+    show_default=True,
+    type=click.FloatRange(min=0)
+)
+@click.option(
+    "--jitter",
+    help="Uniform variation of the delay of each RTP packet, +- ms",
+    default=0,
+    show_default=True,
+    type=click.FloatRange(min=0)
+)
+@click.option(
+    "--reorder",
+    help="Percent of RTP packets delayed 10 ms more, behind the next ones",
+    default=0,
+    show_default=True,
+    type=click.FloatRange(0, 100)
+)
+@click.option(
+    "--duplicate",
+    help="Percent of RTP packets sent twice",
+    default=0,
+    show_default=True,
+    type=click.FloatRange(0, 100)
+)
+@click.option(
+    "--link-rate",
+    help="Rate of the emulated link to each client in Mbit/s, token bucket (0 = no limit)",
+    default=0,
+    show_default=True,
+    type=click.FloatRange(min=0)
+)
+@click.option(
+    "--link-burst",
+    help="Token bucket size of the emulated link (KB)",
+    default=64,
+    show_default=True,
+    type=click.FloatRange(min=0)
+)
+@click.option(
+    "--netem-seed",
+    help="Seed of the network emulation, the same seed repeats the same impairments (random if not given)",
+    default=None,
+    type=int
+)
+@click.option(
+    "--fec",
+    help="Media packets per XOR parity packet of the sessions that don't ask for FEC in SETUP, "
+         "the live channels use it too (0 = no FEC)",
+    default=0,
+    show_default=True,
+    type=click.IntRange(0, MAX_GROUP)
+)
+@click.option(
+    "--cache-size",
+    help="Memory budget of the shared encoded-frame cache (MB)",
+    default=256,
+    show_default=True,
+    type=int
+)
+@click.option(
+    "--engine",
+    help="Server engine: one thread per session or a single asyncio event loop",
+    default="threads",
+    show_default=True,
+    type=click.Choice(["threads", "asyncio"], case_sensitive=False)
+)
+@click.option(
+    "--mtu",
+    help="Path MTU, frames are split in RTP packets that fit in it",
+    default=1400,
+    show_default=True,
+    type=int
+)
+@click.option(
+    "--resolution",
+    help="Size of the streamed frames, WIDTHxHEIGHT or 'source'",
+    default="500x380",
+    show_default=True,
+    callback=parse_resolution
+)
+@click.option(
+    "--encode-workers",
+    help="Processes decoding and encoding frames (0 = in the server process)",
     default=0,
     show_default=True,
     type=int
 )
-def server(ctx, port, host, max_frames, frame_rate, loss_rate, error):
+@click.option(
+    "--multicast-group",
+    help="Multicast group of the live channels asked for with Transport multicast (default: unicast fan-out)",
+    default=None,
+    type=str
+)
+@click.option(
+    "--multicast-port",
+    help="First RTP port of the multicast channels, one even port per channel",
+    default=5004,
+    show_default=True,
+    type=int
+)
+@click.option(
+    "--multicast-ttl",
+    help="TTL of the multicast datagrams",
+    default=1,
+    show_default=True,
+    type=int
+)
+@click.option(
+    "--metrics-port",
+    help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics (default: disabled)",
+    default=None,
+    type=int
+)
+@click.option(
+    "--rate-control/--no-rate-control",
+    help="Adapt the JPEG quality and resolution of each session to the loss its client reports",
+    default=True,
+    show_default=True
+)
+@click.option(
+    "--min-quality",
+    help="Lowest JPEG quality the rate control goes down to",
+    default=30,
+    show_default=True,
+    type=click.IntRange(0, 100)
+)
+@click.option(
+    "--max-quality",
+    help="JPEG quality of the live encoded streams, and highest one of the rate control",
+    default=95,
+    show_default=True,
+    type=click.IntRange(0, 100)
+)
+@click.option(
+    "--max-bitrate",
+    help="Bitrate cap of each session in kbit/s, met by the rate control (0 = no cap)",
+    default=0,
+    show_default=True,
+    type=int
+)
+@click.option(
+    "--max-sessions",
+    help="Sessions served at once, the next SETUPs get 503 (0 = no limit)",
+    default=0,
+    show_default=True,
+    type=int
+)
+@click.option(
+    "--max-decoders",
+    help="Videos decoded live at once, packed videos need none (0 = no limit)",
+    default=0,
+    show_default=True,
+    type=int
+)
+@click.option(
+    "--max-bandwidth",
+    help="Egress of all the sessions in Mbit/s, the next SETUPs get 453 (0 = no limit)",
+    default=0,
+    show_default=True,
+    type=float
+)
+@click.option(
+    "--backlog",
+    help="Connections waiting to be accepted by the RTSP socket",
+    default=5,
+    show_default=True,
+    type=int
+)
+@click.option(
+    "--session-timeout",
+    help="Seconds without requests nor receiver reports before a session is closed (0 = never)",
+    default=60,
+    show_default=True,
+    type=int
+)
+@click.option(
+    "--drain-timeout",
+    help="Seconds the playing sessions go on after Ctrl-C or SIGTERM",
+    default=10,
+    show_default=True,
+    type=float
+)
+@click.option(
+    "--jpeg-encoder",
+    help="JPEG encoder backend of the live encoded streams, a SETUP X-Encoding header can ask for another, turbojpeg needs PyTurboJPEG",
+    default="opencv",
+    show_default=True,
+    type=click.Choice(ENCODERS)
+)
+@click.option(
+    "--subsampling",
+    help="Chroma subsampling of the JPEG frames",
+    default="420",
+    show_default=True,
+    type=click.Choice(SUBSAMPLINGS)
+)
+@click.option(
+    "--jpeg-optimize/--no-jpeg-optimize",
+    help="Optimal Huffman tables, smaller frames for more CPU",
+    default=False,
+    show_default=True
+)
+@click.option(
+    "--jpeg-progressive/--no-jpeg-progressive",
+    help="Progressive JPEG frames",
+    default=False,
+    show_default=True
+)
+@click.option(
+    "--delta",
+    help="Frames that didn't change: send them anyway (off), don't send them (skip), "
+         "or also send only the changed tiles of the others (tiles)",
+    default="off",
+    show_default=True,
+    type=click.Choice(DELTA_MODES)
+)
+@click.option(
+    "--delta-threshold",
+    help="Mean difference per pixel (0-255) of a tile that changed",
+    default=2.0,
+    show_default=True,
+    type=float
+)
+@click.option(
+    "--refresh-interval",
+    help="Seconds between two full frames at most with --delta, to recover from loss",
+    default=2.0,
+    show_default=True,
+    type=float
+)
+@click.option(
+    "--workers",
+    help="Server processes sharing the RTSP port with SO_REUSEPORT, the limits and the frame cache are split among them (0 = a single process)",
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0)
+)
+def server(ctx, port, host, max_frames, frame_rate, loss_rate, error, loss_burst, delay, jitter, reorder,
+           duplicate, link_rate, link_burst, netem_seed, fec, cache_size, engine, mtu, resolution,
+           encode_workers, multicast_group, multicast_port, multicast_ttl, metrics_port, rate_control,
+           min_quality, max_quality, max_bitrate, max_sessions, max_decoders, max_bandwidth, backlog,
+           session_timeout, drain_timeout, jpeg_encoder, subsampling, jpeg_optimize, jpeg_progressive,
+           delta, delta_threshold, refresh_interval, workers):
     """
     Start an RTSP server streaming video.
 
     \b
     The server will listen for incoming RTSP connections on the specified
-    port (default is 4321).
+    port (default is 4321). With --workers N, N server processes share the
+    port and a supervisor restarts the ones that crash.
     """
     logger.info("Server xarxes 2025 video streaming")
-    server = Server(
+    options = dict(
         port = port,
         host = host,
         max_frames = max_frames,
         frame_rate = frame_rate,
         loss_rate = loss_rate,
-        error = error)
+        error = error,
+        loss_burst = loss_burst,
+        delay = delay,
+        jitter = jitter,
+        reorder = reorder,
+        duplicate = duplicate,
+        link_rate = link_rate,
+        link_burst = link_burst,
+        netem_seed = netem_seed,
+        fec = fec,
+        cache_size = cache_size,
+        mtu = mtu,
+        resolution = resolution,
+        encode_workers = encode_workers,
+        multicast_group = multicast_group,
+        multicast_port = multicast_port,
+        multicast_ttl = multicast_ttl,
+        metrics_port = metrics_port,
+        rate_control = rate_control,
+        min_quality = min_quality,
+        max_quality = max_quality,
+        max_bitrate = max_bitrate,
+        max_sessions = max_sessions,
+        max_decoders = max_decoders,
+        max_bandwidth = max_bandwidth,
+        backlog = backlog,
+        session_timeout = session_timeout,
+        drain_timeout = drain_timeout,
+        jpeg_encoder = jpeg_encoder,
+        subsampling = subsampling,
+        jpeg_optimize = jpeg_optimize,
+        jpeg_progressive = jpeg_progressive,
+        delta = delta,
+        delta_threshold = delta_threshold,
+        refresh_interval = refresh_interval)
+    if workers:
+        from xarxes2025.workers import Supervisor
+        Supervisor(engine.lower(), options, workers).run()
+        return
+    if engine.lower() == "asyncio":
+        from xarxes2025.aioserver import AsyncServer as engine_class
+    else:
+        from xarxes2025.server import Server as engine_class
+    engine_class(**options)
 
 
 @cli.command(name="client")
@@ -150,14 +464,223 @@ def server(ctx, port, host, max_frames, frame_rate, loss_rate, error):
     show_default=True,
     type=int
 )
-def client(ctx, videofile, port, host, udp_port):
+@click.option(
+    "--playout-delay",
+    help="Jitter buffer playout delay (ms)",
+    default=100,
+    show_default=True,
+    type=int
+)
+@click.option(
+    "--decoders",
+    help="Threads decoding JPEG frames",
+    default=2,
+    show_default=True,
+    type=int
+)
+@click.option(
+    "--multicast/--no-multicast",
+    help="Ask for the live channel of the video by multicast",
+    default=False,
+    show_default=True
+)
+@click.option(
+    "--rtsp-timeout",
+    help="Seconds to wait for the response to an RTSP request",
+    default=5.0,
+    show_default=True,
+    type=float
+)
+@click.option(
+    "--rtsp-retries",
+    help="Times a PLAY, PAUSE or TEARDOWN is sent again after a timeout",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=0)
+)
+@click.option(
+    "--fec",
+    help="Media packets per XOR parity packet to ask for, 0 for none (default: the server's)",
+    default=None,
+    type=click.IntRange(0, MAX_GROUP)
+)
+def client(ctx, videofile, port, host, udp_port, playout_delay, decoders, multicast, rtsp_timeout, rtsp_retries,
+           fec):
     """
     Start an RTSP client streaming video.
 
     \b
     The client will use for outgoing RTSP connections the specified
-    port (default is 4321).
+    port (default is 4321). Use channel/VIDEOFILE as video file to
+    watch the live channel of VIDEOFILE.
     """
     logger.info("Client xarxes 2025 video streaming")
-    client = Client(port, videofile, host, udp_port, )
+    from xarxes2025.client import Client
+    client = Client(port, videofile, host, udp_port, playout_delay / 1000, decoders, multicast,
+                    rtsp_timeout, rtsp_retries, fec)
     client.root.mainloop()
+
+
+@cli.command(name="pack")
+@click.pass_context
+@click.argument("videofile", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "-o",
+    "--output",
+    help="Packed container to write (default: VIDEOFILE.xpk)",
+    default=None,
+    type=click.Path(dir_okay=False)
+)
+@click.option(
+    "--resolution",
+    help="Size of the packed frames, WIDTHxHEIGHT or 'source'",
+    default="500x380",
+    show_default=True,
+    callback=parse_resolution
+)
+@click.option(
+    "--quality",
+    help="JPEG quality (0-100)",
+    default=95,
+    show_default=True,
+    type=click.IntRange(0, 100)
+)
+@click.option(
+    "--jpeg-encoder",
+    help="JPEG encoder backend, turbojpeg needs PyTurboJPEG",
+    default="opencv",
+    show_default=True,
+    type=click.Choice(ENCODERS)
+)
+@click.option(
+    "--subsampling",
+    help="Chroma subsampling of the JPEG frames",
+    default="420",
+    show_default=True,
+    type=click.Choice(SUBSAMPLINGS)
+)
+@click.option(
+    "--jpeg-optimize/--no-jpeg-optimize",
+    help="Optimal Huffman tables, smaller frames for more CPU",
+    default=False,
+    show_default=True
+)
+@click.option(
+    "--jpeg-progressive/--no-jpeg-progressive",
+    help="Progressive JPEG frames",
+    default=False,
+    show_default=True
+)
+def pack(ctx, videofile, output, resolution, quality, jpeg_encoder, subsampling, jpeg_optimize, jpeg_progressive):
+    """
+    Transcode a video once into a packed container.
+
+    \b
+    The server streams VIDEOFILE.xpk instead of VIDEOFILE when it exists,
+    sending the stored JPEG frames without decoding or encoding them.
+    """
+    from xarxes2025.encoders import make_encoder
+    from xarxes2025.packedvideo import pack_video
+    jpeg = make_encoder(jpeg_encoder, subsampling, jpeg_optimize, jpeg_progressive)
+    frames = pack_video(videofile, output, resolution, quality, jpeg)
+    click.echo(f"{frames} frames packed")
+
+
+@cli.command(name="bench")
+@click.pass_context
+@click.option(
+    "-f",
+    "--videofile",
+    help="Video every viewer watches, channel/VIDEOFILE for its live channel",
+    default="rick.webm",
+    show_default=True,
+    type=str
+)
+@click.option(
+    "-p",
+    "--port",
+    help="RTSP port (TCP)",
+    default=4321,
+    show_default=True,
+    type=int
+)
+@click.option(
+    "-h",
+    "--host",
+    help="IP Address of the RTSP server",
+    default="127.0.0.1",
+    show_default=True,
+    type=str
+)
+@click.option(
+    "-n",
+    "--viewers",
+    help="Simulated viewers",
+    default=10,
+    show_default=True,
+    type=click.IntRange(1)
+)
+@click.option(
+    "--duration",
+    help="Seconds each viewer plays",
+    default=10.0,
+    show_default=True,
+    type=float
+)
+@click.option(
+    "--ramp-up",
+    help="Seconds over which the viewers are started",
+    default=0.0,
+    show_default=True,
+    type=float
+)
+@click.option(
+    "--pause",
+    help="Seconds each viewer pauses in the middle of its playback",
+    default=0.0,
+    show_default=True,
+    type=float
+)
+@click.option(
+    "--seeks",
+    help="PLAY Range seeks to random positions by each viewer, their latency is reported",
+    default=0,
+    show_default=True,
+    type=click.IntRange(0)
+)
+@click.option(
+    "--encoding",
+    help="X-Encoding header of the SETUPs, e.g. 'encoder=pillow; subsampling=444; quality=80' (default: the server's)",
+    default=None,
+    type=str
+)
+@click.option(
+    "--fec",
+    help="Media packets per XOR parity packet asked for in the SETUPs, 0 for none (default: the server's)",
+    default=None,
+    type=click.IntRange(0, MAX_GROUP)
+)
+@click.option(
+    "-o",
+    "--output",
+    help="File to write the JSON results to (default: standard output)",
+    default=None,
+    type=click.Path(dir_okay=False)
+)
+def bench(ctx, videofile, port, host, viewers, duration, ramp_up, pause, seeks, encoding, fec, output):
+    """
+    Load test an RTSP server with headless viewers.
+
+    \b
+    All the viewers run in this process, without UI nor decoding. The
+    results (frames/s, Mbit/s, loss, setup latency, inter-frame jitter and
+    seek latency percentiles, per session counters) are written as JSON.
+    """
+    from xarxes2025.loadclient import run_bench
+    results = run_bench(host, port, videofile, viewers, duration, ramp_up, pause, seeks, encoding, fec)
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        click.echo(text)
@@ -1,42 +1,100 @@
 import sys
+import random
 import socket
+import struct
 import threading
-
+import time
+
+from xarxes2025.decodepool import DecodePool
+from xarxes2025.delta import DeltaImage
+from xarxes2025.fec import FECDecoder, is_parity
+from xarxes2025.jitterbuffer import JitterBuffer
+from xarxes2025.rtcp import RTCP_INTERVAL, SR, ReceptionStats, build_receiver_report, parse_rtcp
+from xarxes2025.rtpjpeg import FrameReassembler
+from xarxes2025.rtsp import parse_transport
+from xarxes2025.rtspcontrol import DEFAULT_RETRIES, DEFAULT_TIMEOUT, RTSPControl
 from xarxes2025.udpdatagram import UDPDatagram
 from tkinter import Tk, Label, Button, W, E, N, S
 from tkinter import messagebox
 import tkinter as tk
 
 from loguru import logger
-from PIL import Image, ImageTk
-import io
+from PIL import ImageTk
+
+
+# How often the playout loop looks for due frames (ms)
+PLAYOUT_TICK = 5
+
+# Kernel receive buffer, holds bursts while the receive thread is busy
+RECEIVE_BUFFER = 4 * 1024 * 1024
+
+# Session timeout (s) when the SETUP response tells none, the RTSP default
+SESSION_TIMEOUT = 60
 
 
 class Client(object):
-    def __init__(self, server_port, filename, host , udp_port):
+    def __init__(self, server_port, filename, host , udp_port, playout_delay=0.1, decoders=2, multicast=False,
+                 rtsp_timeout=DEFAULT_TIMEOUT, rtsp_retries=DEFAULT_RETRIES, fec=None):
 
         #Connection parameters
         self.server_port = server_port
         self.server_host = host
         self.filename = filename
         self.udp_port = udp_port
+        self.multicast = multicast
+        self.multicast_group = None
+        self.multicast_port = None
+        self.server_rtcp_port = None
 
         # RTSP protocol state
-        self.rtsp_socket = None    # TCP socket for RTSP control
-        self.seq = 1    #RTSP sequence number
+        self.control = None    # RTSP control connection, with the CSeq numbers
+        self.rtsp_timeout = rtsp_timeout
+        self.rtsp_retries = rtsp_retries
         self.session_id = None    # Server-assigned session ID
         self.state = "INIT"   # State machine: INIT, READY, PLAYING
 
+        # Methods sent and waiting for their response
+        self.pending = set()
+
+        # The server expires a session without requests nor receiver
+        # reports for its timeout: a GET_PARAMETER goes every half of it
+        self.session_timeout = SESSION_TIMEOUT
+        self.last_request = time.monotonic()
+
 
         self.playing = False
         self.paused = False
         self.udp_socket = None
 
-        # Packets statistics
+        # Seconds of video, from the Range of the PLAY responses, and the
+        # RTP timestamp the stream continues at after a seek
+        self.duration = None
+        self.pending_resync = None
+        self.rtcp_socket = None
+
+        # Packets statistics, with sequence numbers extended past 16 bits
         self.packets_lost = 0
         self.packets_received = 0
         self.total_packets = 0
-        self.last_seq = -1
+        self.reception = ReceptionStats()
+        self.ssrc = random.getrandbits(32)
+
+        # Media packets per parity packet asked for in SETUP, None for the
+        # server's, and the packets lost that the parity packets rebuilt
+        self.fec = fec
+        self.fec_decoder = FECDecoder()
+
+        # Pipeline: the receive thread reassembles the RTP packets in frames,
+        # the decode pool decodes them and the jitter buffer holds them until
+        # the Tk playout loop renders them at the pace of their timestamps
+        self.reassembler = FrameReassembler()
+        self.jitter = JitterBuffer(playout_delay)
+        self.decoder = DecodePool(self.on_frame_decoded, workers=decoders)
+
+        # Last picture shown, delta frames are pasted on it, and the delta
+        # frames dropped for lack of a picture to apply them on
+        self.picture = None
+        self.delta_drops = 0
 
         # Initialize connection and UI
         self.connect_to_server()
@@ -44,228 +102,356 @@ class Client(object):
 
     def create_udp_socket(self):
 
-        """ Create and bind the UDP socket for recieving video packets """
+        """ Create and bind the UDP socket for recieving video packets, joining the multicast group if any """
 
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+        logger.debug(f"UDP receive buffer {self.udp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)} bytes")
         
+        port = self.rtp_port()
+        try:
+            self.udp_socket.bind(('', port))
+            logger.info(f"UDP socket listening on port {port}")
+            if self.multicast_group:
+                membership = struct.pack("4s4s", socket.inet_aton(self.multicast_group), socket.inet_aton("0.0.0.0"))
+                self.udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+                logger.info(f"Joined multicast group {self.multicast_group}")
+        except Exception as e:
+            logger.error(f"Could not bind UDP socket on port {port}: {e}")
+            messagebox.showerror("UDP Error", f"Port {port} is already in use.\nTry another port.")
+
+    def rtp_port(self):
+
+        """ Port the stream arrives at: the multicast group's, else the client_port asked for in SETUP """
+
+        return self.multicast_port or self.udp_port
+
+    def create_rtcp_socket(self):
+
+        """ Create and bind the RTCP socket, on the port after the RTP one """
+
+        self.rtcp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rtcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.rtcp_socket.settimeout(RTCP_INTERVAL)
         try:
-            self.udp_socket.bind(('', self.udp_port))
-            logger.info(f"UDP socket listening on port {self.udp_port}")
+            self.rtcp_socket.bind(('', self.rtp_port() + 1))
         except Exception as e:
-            logger.error(f"Could not bind UDP socket on port {self.udp_port}: {e}")
-            messagebox.showerror("UDP Error", f"Port {self.udp_port} is already in use.\nTry another port.")
+            logger.warning(f"Could not bind RTCP socket on port {self.rtp_port() + 1}: {e}")
 
-    def update_packet_stats(self, current_seq):
+    def update_packet_stats(self, datagrama, arrival):
 
-        """ Udapte packet loss/reception statistics and dsplay them """
+        """ Udapte packet loss/reception statistics, the playout loop displays them """
 
-        # Detect lost packets
-        if self.last_seq != -1 and current_seq > self.last_seq + 1:
-            self.packets_lost += current_seq - self.last_seq - 1
+        self.reception.update(datagrama.get_seqnum(), datagrama.timestamp(), arrival, datagrama.get_ssrc())
 
         # Udapte packets counters
-        self.packets_received += 1
-        self.total_packets = self.packets_received + self.packets_lost
-        self.last_seq = current_seq
+        self.packets_received = self.reception.received
+        self.packets_lost = max(self.reception.lost, 0)
+        self.total_packets = self.reception.expected
+
+    def listen_rtcp(self, rtcp_socket):
+
+        """ RTCP thread: takes note of the server's sender reports and
+        sends a receiver report about the stream every RTCP_INTERVAL """
+
+        last_report = time.monotonic()
+        while True:
+            try:
+                data, _ = rtcp_socket.recvfrom(2048)
+                for packet_type, _, sender_info, _ in parse_rtcp(data):
+                    if packet_type == SR:
+                        self.reception.on_sender_report(sender_info[0], time.monotonic())
+            except socket.timeout:
+                pass
+            except Exception:
+                break
+
+            now = time.monotonic()
+            if now - last_report < RTCP_INTERVAL or not self.server_rtcp_port:
+                continue
+            last_report = now
+            block = self.reception.report_block(now)
+            if block is None:
+                continue
+            try:
+                rtcp_socket.sendto(build_receiver_report(self.ssrc, [block]), (self.server_host, self.server_rtcp_port))
+            except Exception as e:
+                logger.debug(f"Could not send receiver report: {e}")
+
+    def show_stats(self):
+
+        """ Display packet and playout statistics, with the frames dropped at each stage """
 
-        # Udapte UI
         self.counter["text"] = (
-            f"Seq Num:{self.total_packets} Lost:{self.packets_lost} OK:{self.packets_received}"
+            f"Seq Num:{self.total_packets} Lost:{self.packets_lost} OK:{self.packets_received} "
+            f"Jitter:{self.reception.jitter_ms():.1f}ms Buffer:{self.jitter.depth()} Late:{self.jitter.late_drops}\n"
+            f"Drops network:{self.packets_lost} reassembly:{self.reassembler.frames_dropped} "
+            f"decode:{self.decoder.overload_drops + self.decoder.decode_errors} "
+            f"late:{self.jitter.late_drops} skipped:{self.jitter.skipped} delta:{self.delta_drops} "
+            f"RTSP in flight:{self.control.in_flight()} timeouts:{self.control.timeouts} "
+            f"FEC recovered:{self.fec_decoder.recovered} "
+            f"unrecoverable:{max(self.packets_lost - self.fec_decoder.recovered, 0)}"
         )
-        self.counter.update_idletasks()
 
     def listen_udp(self):
 
         """ UDP listener thread that recieves video packets,
-        handles packets decoding, packets statistics (recieves, lost and total) and video frame udaptes """
+        handles packets decoding, packets statistics (recieves, lost and total) and hands
+        complete frames to the decode pool. It never waits on decoding or rendering, so
+        the socket is drained as fast as packets arrive """
 
         while True:
             try:
                 # Recieve UDP packet
-                data, addr = self.udp_socket.recvfrom(65536)
+                data = self.udp_socket.recv(65536)
 
-                # Decode RTP packet
-                datagrama = UDPDatagram(10, 10)
-                datagrama.decode(data)
+                # After a seek, frames of the old position are ignored
+                resync, self.pending_resync = self.pending_resync, None
+                if resync is not None:
+                    self.reassembler.resync(resync)
 
-                # Udapte statistics an display frame
-                current_seq = datagrama.get_seqnum()
-                self.update_packet_stats(current_seq)
-                self.updateMovie(datagrama.get_payload())
+                # Parity packets only rebuild the media packets lost, they
+                # are not counted in the statistics
+                if is_parity(data):
+                    recovered = self.fec_decoder.add_parity(data)
+                else:
+                    # Decode RTP packet, udapte statistics and keep it for the parity packets
+                    datagrama = UDPDatagram(10, 10)
+                    datagrama.decode(data)
+                    self.update_packet_stats(datagrama, time.monotonic())
+                    recovered = self.fec_decoder.add_media(datagrama.get_seqnum(), data)
+                    self.reassemble(datagrama)
+
+                for packet in recovered:
+                    datagrama = UDPDatagram(10, 10)
+                    datagrama.decode(packet)
+                    self.reassemble(datagrama)
 
             except Exception as e:
                 logger.error(f"Error receiving UDP packet: {e}")
                 break
 
+    def reassemble(self, datagrama):
+
+        """ Buffer the payload of a packet, the frame goes to the decode pool once all its packets arrived """
+
+        timestamp = datagrama.timestamp()
+        frame = self.reassembler.add(timestamp, datagrama.get_payload(), datagrama.get_marker())
+        if frame is not None:
+            self.decoder.submit(timestamp, frame, time.monotonic())
+
+    def on_frame_decoded(self, timestamp, image, arrival):
+
+        """ Decode pool callback, the frame waits in the jitter buffer for its playout time """
+
+        self.jitter.push(timestamp, image, arrival)
+
     def connect_to_server(self):
 
-        """ Establish TCP connection to RSTP server """
+        """ Open the RTSP control connection to the server, from its own thread """
 
-        self.rtsp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            self.rtsp_socket.connect((self.server_host, self.server_port))
-            logger.info(f"Conectat a server")
-        except Exception as e:
-            logger.error(f"Conexio fallada")
-            messagebox.showerror("Error conexio", f"NO es pot conectar amb el servidor")
+        self.control = RTSPControl(self.server_host, self.server_port, self.rtsp_timeout, self.rtsp_retries,
+                                   on_closed=self.on_control_closed)
+
+    def on_control_closed(self, reason):
+
+        """ The control connection could not be opened or was lost """
+
+        self.text["text"] = f"RTSP connection closed: {reason}"
+        messagebox.showerror("Error conexio", f"NO es pot conectar amb el servidor\n{reason}")
+
+    def send_request(self, method, headers, on_response):
+
+        """ Send an RTSP request, on_response(response) runs on the Tk thread when it completes """
+
+        def callback(response, error):
+            self.pending.discard(method)
+            if error is not None:
+                logger.error(f"{method} failed: {error}")
+                self.text["text"] = f"Error {method}: {error}"
+                return
+            on_response(response)
+
+        logger.debug(f"Sending {method} request, headers {headers}")
+        self.pending.add(method)
+        self.last_request = time.monotonic()
+        self.control.request(method, self.filename, headers, callback)
 
     def send_setup_request(self):
 
         """ Send RSTP Setup request to initialize streaming session 
         and create udp socket """
 
-        if self.state != "INIT":
+        if self.state != "INIT" or "SETUP" in self.pending:
             self.text["text"] = "Setup already done"
             return
 
         # Setup request
-        request = (
-            f"SETUP {self.filename} RTSP/1.0\r\n"
-            f"CSeq: {self.seq}\r\n"
-            f"Transport: RTP/UDP; client_port= {self.udp_port}\r\n"
-            f"\r\n"
-        )
-        logger.debug(f"Sending SETUP request:\n{request}")
-        try:
-            # Send request and wait for response
-            self.rtsp_socket.send(request.encode())
-            self.seq += 1
-            response = self.rtsp_socket.recv(1024).decode()
-
-            if "200 OK" in response:
-
-                # Udapte state and create UDP resources
-                self.state = "READY"
-                self.paused = False
-                if self.udp_socket is None:
-                    self.create_udp_socket()
-                    threading.Thread(target=self.listen_udp, daemon=True).start()
-
-                # Extract session ID from response
-                for line in response.split("\n"):
-                    if line.strip().startswith("Session:"):
-                        self.session_id = line.split(":")[1].strip()
-                        logger.debug(f"Session ID received: {self.session_id}")
-
-                self.text["text"] = (f"Setup done. Session ID:{self.session_id} \n Port: {self.udp_port} opened.(BIND OK)")
-
-            else:
-                self.text["text"] = "Setup failed"
-        except Exception as e:
-            logger.error(f"Fallo d'enviament de SETUP: {e}")
-            self.text["text"] = f"error SETUP: {e}"
+        transport = f"RTP/UDP; client_port= {self.udp_port}{'; multicast' if self.multicast else ''}"
+        if self.fec is not None:
+            transport += f"; fec={self.fec}"
+        headers = {"Transport": transport}
+        self.send_request("SETUP", headers, self.on_setup_response)
+
+    def on_setup_response(self, response):
 
-    def send_play_request(self):
+        """ SETUP response: take the session and create the UDP resources """
 
-        """ Send RTSP Play request to start streaming"""
+        if response.status != 200:
+            self.text["text"] = "Setup failed"
+            return
+
+        # Udapte state and create UDP resources
+        self.state = "READY"
+        self.paused = False
+        self.parse_transport(response)
 
-        if self.state != "READY":
+        # The new session's parity packets protect new sequence numbers, the
+        # media and parities kept from the previous one must not rebuild them
+        self.fec_decoder = FECDecoder()
+        if self.udp_socket is None:
+            self.create_udp_socket()
+            threading.Thread(target=self.listen_udp, daemon=True).start()
+            self.create_rtcp_socket()
+            threading.Thread(target=self.listen_rtcp, args=(self.rtcp_socket,), daemon=True).start()
+
+        # Extract session ID and timeout from response
+        session = response.header("Session") or ""
+        self.session_id = session.split(";")[0].strip() or None
+        self.session_timeout = int(parse_transport(session).get("timeout") or SESSION_TIMEOUT)
+        logger.debug(f"Session ID received: {self.session_id}, timeout {self.session_timeout} s")
+
+        self.text["text"] = (f"Setup done. Session ID:{self.session_id} \n Port: {self.rtp_port()} opened.(BIND OK)")
+
+    def parse_transport(self, response):
+
+        """ Take the multicast group and port, and the server's RTCP port,
+        from the SETUP response's transport header, if any """
+
+        transport = parse_transport(response.header("Transport", ""))
+        if "destination" in transport:
+            self.multicast_group = transport["destination"]
+        if "port" in transport:
+            self.multicast_port = int(transport["port"].split("-")[0])
+        if "-" in transport.get("server_port", ""):
+            self.server_rtcp_port = int(transport["server_port"].split("-")[1])
+
+    def send_play_request(self, position=None):
+
+        """ Send RTSP Play request to start streaming, from position (seconds) to seek """
+
+        if position is None and (self.state != "READY" or "PLAY" in self.pending):
             self.text["text"] = "Already playing"
             return
+        if position is not None and self.state == "INIT":
+            self.text["text"] = "Setup first"
+            return
 
-        # Play request
-        request = (
-            f"PLAY {self.filename} RTSP/1.0\r\n"
-            f"CSeq: {self.seq}\r\n"
-            f"Session: {self.session_id}\r\n"
-            f"\r\n"
-        )
-        logger.debug(f"Sending PLAY request:\n{request}")
+        # Play request, the Range of the response tells the video duration
+        start = "now" if position is None else f"{position:.3f}"
+        headers = {"Session": self.session_id, "Range": f"npt={start}-"}
+        self.send_request("PLAY", headers, lambda response: self.on_play_response(response, position))
 
-        try:
-            # Send request and wait for response
-            self.rtsp_socket.send(request.encode())
-            self.seq += 1
-            response = self.rtsp_socket.recv(1024).decode()
-
-            if "200 OK" in response:
-                self.text["text"] = "Playing"
-                self.state = "PLAYING"
-                self.paused = False
-                self.playing = True
-            else:
-                self.text["text"] = "Play failed"
-        except Exception as e:
-            logger.error(f"Failed to send PLAY request: {e}")
-            self.text["text"] = f"Error PLAY: {e}"
+    def on_play_response(self, response, position):
+
+        """ PLAY response, position is where it seeked to or None """
+
+        if response.status != 200:
+            self.text["text"] = "Play failed"
+            return
+        self.parse_play_response(response, position is not None)
+        self.jitter.resync()
+        self.text["text"] = "Playing" if position is None else f"Playing from {position:.1f} s"
+        self.state = "PLAYING"
+        self.paused = False
+        self.playing = True
+
+    def parse_play_response(self, response, seek):
+
+        """ Take the duration from the Range header and, after a seek, the rtptime to resync to """
+
+        value = response.header("Range", "")
+        if "-" in value:
+            end = value.split("-", 1)[1]
+            if end:
+                self.duration = float(end)
+                self.seek_scale.configure(to=self.duration)
+        if seek:
+            for part in response.header("RTP-Info", "").split(";"):
+                key, _, param = part.strip().partition("=")
+                if key == "rtptime":
+                    self.pending_resync = int(param)
 
     def send_pause_request(self):
 
         """ Send RTSP Pause request to temporarily stop streaming """
 
-        if self.state != "PLAYING":
+        if self.state != "PLAYING" or "PAUSE" in self.pending:
             self.text["text"] = "Already paused"
             return
 
         # Pause request
-        request = (
-            f"PAUSE {self.filename} RTSP/1.0\r\n"
-            f"CSeq: {self.seq}\r\n"
-            f"Session: {self.session_id}\r\n"
-            f"\r\n"
-        )
-        logger.debug(f"Sending PAUSE request:\n{request}")
+        self.send_request("PAUSE", {"Session": self.session_id}, self.on_pause_response)
 
-        try:
-            # Send request and wait for response
-            self.rtsp_socket.send(request.encode())
-            self.seq += 1
-            response = self.rtsp_socket.recv(1024).decode()
-
-            if "200 OK" in response:
-                self.text["text"] = "Paused"
-                self.state = "READY"
-                self.paused = True
-            else:
-                self.text["text"] = "Pause failed"
-        except Exception as e:
-            logger.error(f"Failed to send PAUSE request: {e}")
-            self.text["text"] = f"Error PAUSE: {e}"
+    def on_pause_response(self, response):
+        if response.status == 200:
+            self.text["text"] = "Paused"
+            self.state = "READY"
+            self.paused = True
+        else:
+            self.text["text"] = "Pause failed"
+
+    def send_keepalive(self, now):
+
+        """ Send a GET_PARAMETER when no request went for half the session timeout, a paused session sends no reports """
+
+        if self.state == "INIT" or self.pending or now - self.last_request < self.session_timeout / 2:
+            return
+        self.send_request("GET_PARAMETER", {"Session": self.session_id}, lambda response: None)
 
     def send_teardown_request(self):
 
         """ Send RSTP Teardown request to terminate session,
         close udp socket and reset state and variables"""
 
-        if self.state == "INIT":
+        if self.state == "INIT" or "TEARDOWN" in self.pending:
             self.text["text"] = "Can't do teardown right now"
             return
 
         # Teardown request
-        request = (
-            f"TEARDOWN {self.filename} RTSP/1.0\r\n"
-            f"CSeq: {self.seq}\r\n"
-            f"Session: {self.session_id}\r\n"
-            f"\r\n"
-        )
-        try:
-            # Send request and wait for response
-            if self.rtsp_socket and not self.rtsp_socket._closed:
-                self.rtsp_socket.send(request.encode())
-                response = self.rtsp_socket.recv(1024).decode()
-
-                if "200 OK" in response:
-                    self.text["text"] = "Teardown"
-                    
-                    # Close UDP socket only if it does exist
-                    if self.udp_socket:
-                        self.udp_socket.close()
-                        self.udp_socket = None
-
-                    # Reset state and variables
-                    self.state = "INIT"
-                    self.playing = False
-                    self.paused = False
-                    self.seq = 1
-                    self.total_packets = 0
-                    self.packets_lost = 0
-                    self.packets_received = 0
-                else:
-                    self.text["text"] = "Teardown failed"
-        except Exception as e:
-            logger.error(f"Failed to send TEARDOWN request: {e}")
-            self.text["text"] = f"Error TEARDOWN: {e}"
+        self.send_request("TEARDOWN", {"Session": self.session_id}, self.on_teardown_response)
+
+    def on_teardown_response(self, response):
+        if response.status != 200:
+            self.text["text"] = "Teardown failed"
+            return
+        self.text["text"] = "Teardown"
+
+        # Close UDP socket only if it does exist
+        if self.udp_socket:
+            self.udp_socket.close()
+            self.udp_socket = None
+        if self.rtcp_socket:
+            self.rtcp_socket.close()
+            self.rtcp_socket = None
+
+        # Reset state and variables
+        self.state = "INIT"
+        self.playing = False
+        self.paused = False
+        self.total_packets = 0
+        self.packets_lost = 0
+        self.packets_received = 0
+        self.reception.reset()
+        self.multicast_group = None
+        self.multicast_port = None
+        self.server_rtcp_port = None
+        self.reassembler = FrameReassembler()
+        self.jitter.reset()
+        self.decoder.reset()
+        self.picture = None
+        self.delta_drops = 0
 
     def create_ui(self):
         self.root = Tk()
@@ -288,6 +474,14 @@ class Client(object):
         self.counter = Label(self.root, height=2)
         self.counter.grid(row=3, column=0, columnspan=4, sticky=W+E+N+S, padx=5, pady=5)
 
+        # Seek bar, its end is the duration of the video once playing
+        self.seek_scale = tk.Scale(self.root, from_=0, to=0, resolution=0.5, orient=tk.HORIZONTAL, label="Seek (s)")
+        self.seek_scale.grid(row=4, column=0, columnspan=4, sticky=W+E, padx=5, pady=5)
+        self.seek_scale.bind("<ButtonRelease-1>", self.ui_seek_event)
+
+        # Frames are rendered by the playout loop, on the Tk thread
+        self.root.after(PLAYOUT_TICK, self.playout_tick)
+
         return self.root
 
     def _create_button(self, text, command, row=0, column=0, width=20, padx=3, pady=3 ):
@@ -303,6 +497,9 @@ class Client(object):
 
         if self.state != "INIT":
             self.send_teardown_request()
+
+        # Give the TEARDOWN a moment to go out, its response is not waited for
+        self.control.close(wait=1)
         self.playing = False
         self.root.destroy()
         logger.debug("Window closed")
@@ -333,6 +530,14 @@ class Client(object):
         self.text["text"] = "Sending pause request..."
         self.send_pause_request()
 
+    def ui_seek_event(self, event):
+
+        """ Seek bar handler, plays from the position it was released at """
+
+        logger.debug(f"Seek to {self.seek_scale.get()} s")
+        self.text["text"] = "Sending play request..."
+        self.send_play_request(float(self.seek_scale.get()))
+
     def ui_teardown_event(self):
 
         """ Teardown button handler """
@@ -341,7 +546,33 @@ class Client(object):
         self.text["text"] = "Sending teardown request..."
         self.send_teardown_request()
 
-    def updateMovie(self, data):
-        photo = ImageTk.PhotoImage(Image.open(io.BytesIO(data)))
-        self.movie.configure(image=photo, height=380) 
+    def playout_tick(self):
+
+        """ Render the frame whose playout time has come and refresh the statistics """
+
+        # Responses of the RTSP requests, they never wait for the server
+        self.control.dispatch()
+        self.send_keepalive(time.monotonic())
+
+        image = None
+        for frame in self.jitter.pop_all_due(time.monotonic()):
+            # Delta frames update the last picture, the next full frame
+            # repairs it after a loss
+            if isinstance(frame, DeltaImage):
+                frame = frame.apply(self.picture)
+                if frame is None:
+                    self.delta_drops += 1
+                    continue
+            image = self.picture = frame
+        if image is not None:
+            self.updateMovie(image)
+        self.show_stats()
+        self.root.after(PLAYOUT_TICK, self.playout_tick)
+
+    def updateMovie(self, image):
+
+        """ Show a decoded frame, PhotoImage must be created on the Tk thread """
+
+        photo = ImageTk.PhotoImage(image)
+        self.movie.configure(image=photo, height=photo.height()) 
         self.movie.photo_image = photo
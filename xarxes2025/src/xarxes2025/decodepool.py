@@ -0,0 +1,85 @@
+import io
+import queue
+import threading
+
+from loguru import logger
+from PIL import Image
+
+from xarxes2025.delta import DeltaImage, is_delta, unpack_delta
+
+
+def decode_frame(data):
+
+    """ Decode a JPEG frame, or the patches of a delta frame """
+
+    if is_delta(data):
+        size, patches = unpack_delta(data)
+        return DeltaImage(size, [(x, y, decode_jpeg(jpeg)) for x, y, jpeg in patches])
+    return decode_jpeg(data)
+
+
+def decode_jpeg(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+class DecodePool(object):
+    """
+    Bounded pool of threads decoding JPEG frames off the receive thread.
+
+    The receive thread only submits frames, so it goes back to draining the
+    socket right away. When the queue is full the frame is dropped and
+    counted as a client overload drop instead of blocking the receiver.
+    Pillow releases the GIL while decoding, so the workers run in parallel.
+    """
+
+    def __init__(self, on_decoded, workers=2, queue_size=8):
+        """
+        Constructor for DecodePool object.
+
+        :param on_decoded: Called from a worker with (timestamp, image,
+                           arrival) for every decoded frame, image is a
+                           DeltaImage for the delta frames.
+        :param workers: Number of decoding threads.
+        :param queue_size: Frames waiting to be decoded before dropping.
+        """
+        self.on_decoded = on_decoded
+        self.queue = queue.Queue(queue_size)
+
+        # Drops of this stage
+        self.overload_drops = 0
+        self.decode_errors = 0
+
+        for n in range(workers):
+            threading.Thread(target=self.work, daemon=True, name=f"decoder-{n}").start()
+
+    def submit(self, timestamp, data, arrival):
+        """ Queue a frame for decoding, returns False if it was dropped """
+
+        try:
+            self.queue.put_nowait((timestamp, data, arrival))
+            return True
+        except queue.Full:
+            self.overload_drops += 1
+            return False
+
+    def work(self):
+
+        """ Worker loop decoding frames """
+
+        while True:
+            timestamp, data, arrival = self.queue.get()
+            try:
+                image = decode_frame(data)
+            except Exception as e:
+                self.decode_errors += 1
+                logger.debug(f"Cannot decode frame {timestamp}: {e}")
+                continue
+            self.on_decoded(timestamp, image, arrival)
+
+    def reset(self):
+        """ Forget the counters """
+
+        self.overload_drops = 0
+        self.decode_errors = 0
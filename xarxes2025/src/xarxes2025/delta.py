@@ -0,0 +1,249 @@
+import struct
+
+from xarxes2025.metrics import METRICS, stage_timer
+
+
+# Delta frames, sent instead of a full JPEG when only part of the picture
+# changed. They go through the same RTP packetizer as any frame:
+#
+#   header    magic, width and height of the full frame, patch count
+#   patches   x, y of the patch in pixels and its length, then a small
+#             JPEG of that rectangle of the frame
+#
+# A JPEG starts with FF D8, so the magic tells the two apart. The client
+# pastes the patches on the last frame it showed.
+
+DELTA_MAGIC = b"XDT1"
+DELTA_HEADER = struct.Struct("!4sHHH")
+PATCH_HEADER = struct.Struct("!HHI")
+
+# Delta modes of the server
+DELTA_MODES = ("off", "skip", "tiles")
+
+# Side of the tiles compared, a multiple of the 8 pixel JPEG blocks
+TILE_SIZE = 64
+
+# Mean absolute difference per pixel and channel (0-255) above which a tile changed
+DIFF_THRESHOLD = 2.0
+
+# Above this fraction of changed tiles a full frame is smaller than the patches
+MAX_CHANGED = 0.5
+
+# What each frame became
+FULL = "full"
+UNCHANGED = "unchanged"
+DELTA = "delta"
+
+DIFF_TIME = stage_timer("delta_diff")
+FRAME_KINDS = {kind: METRICS.counter("xarxes_delta_frames_total", "Frames of the delta sessions by kind",
+                                     {"kind": kind})
+               for kind in (FULL, UNCHANGED, DELTA)}
+
+
+def is_delta(data):
+
+    """ True if a frame is a delta frame, not a JPEG """
+
+    return bytes(data[:len(DELTA_MAGIC)]) == DELTA_MAGIC
+
+
+def pack_delta(size, patches):
+    """
+    Build a delta frame.
+
+    :param size: (width, height) of the full frame.
+    :param patches: List of (x, y, JPEG bytes).
+    :returns: The delta frame bytes.
+    """
+    width, height = size
+    parts = [DELTA_HEADER.pack(DELTA_MAGIC, width, height, len(patches))]
+    for x, y, jpeg in patches:
+        parts.append(PATCH_HEADER.pack(x, y, len(jpeg)))
+        parts.append(jpeg)
+    return b"".join(parts)
+
+
+def unpack_delta(data):
+    """
+    Split a delta frame.
+
+    :param data: Delta frame bytes.
+    :returns: ((width, height), list of (x, y, JPEG bytes)). Raises
+              ValueError if the frame is truncated.
+    """
+    magic, width, height, count = DELTA_HEADER.unpack_from(data)
+    if magic != DELTA_MAGIC:
+        raise ValueError("not a delta frame")
+    offset = DELTA_HEADER.size
+    patches = []
+    for _ in range(count):
+        x, y, length = PATCH_HEADER.unpack_from(data, offset)
+        offset += PATCH_HEADER.size
+        if offset + length > len(data):
+            raise ValueError("truncated delta frame")
+        patches.append((x, y, bytes(data[offset:offset + length])))
+        offset += length
+    return (width, height), patches
+
+
+class DeltaImage(object):
+    """
+    Decoded delta frame, for the client.
+
+    Goes through the jitter buffer like a decoded image and is applied on
+    the last frame shown when its playout time comes.
+    """
+
+    def __init__(self, size, patches):
+        """
+        :param size: (width, height) of the full frame.
+        :param patches: List of (x, y, PIL Image).
+        """
+        self.size = size
+        self.patches = patches
+
+    def apply(self, base):
+        """
+        Paste the patches on the last frame shown.
+
+        :param base: PIL Image shown last, modified in place.
+        :returns: The updated image, or None if there is no base of the same
+                  size to apply the delta on (it was lost), the client then
+                  waits for the next full frame.
+        """
+        if base is None or base.size != self.size:
+            return None
+        for x, y, patch in self.patches:
+            base.paste(patch, (x, y))
+        return base
+
+
+def tile_rects(changed, tile, size):
+    """
+    Rectangles to send for the changed tiles, runs of a row merged in one.
+
+    :param changed: 2D boolean array, a cell per tile.
+    :param tile: Tile side in pixels.
+    :param size: (width, height) of the frame, the last row and column of
+                 tiles are clipped to it.
+    :returns: List of (x, y, width, height) in pixels.
+    """
+    width, height = size
+    rects = []
+    for row, cells in enumerate(changed.tolist()):
+        column = 0
+        while column < len(cells):
+            if not cells[column]:
+                column += 1
+                continue
+            start = column
+            while column < len(cells) and cells[column]:
+                column += 1
+            x, y = start * tile, row * tile
+            rects.append((x, y, min(column * tile, width) - x, min(y + tile, height) - y))
+    return rects
+
+
+class DeltaEncoder(object):
+    """
+    Per session unchanged frame suppression and tile deltas.
+
+    Each frame is compared, tile by tile, with the picture the client has:
+    the last full frame with the patches sent since pasted on it. Tiles
+    whose mean difference is under the threshold are not sent. A frame
+    with no changed tile is not sent at all; in tiles mode, a frame with
+    few changed tiles is sent as a delta of JPEG patches. A full frame is
+    sent every refresh frames, so a lost frame or patch is not shown for
+    longer than that, and whenever the size changes.
+    """
+
+    def __init__(self, mode="tiles", refresh=50, threshold=DIFF_THRESHOLD, tile=TILE_SIZE, max_changed=MAX_CHANGED):
+        """
+        Constructor for DeltaEncoder object.
+
+        :param mode: "skip" only suppresses unchanged frames, "tiles" also
+                     sends the changed tiles as patches.
+        :param refresh: Frames between two full frames at most.
+        :param threshold: Mean absolute difference of a changed tile.
+        :param tile: Tile side in pixels.
+        :param max_changed: Fraction of changed tiles above which a full
+                            frame is sent.
+        """
+        self.mode = mode
+        self.refresh = max(refresh, 1)
+        self.threshold = threshold
+        self.tile = tile
+        self.max_changed = max_changed
+        self.reference = None
+        self.since_full = 0
+        self.frames = {FULL: 0, UNCHANGED: 0, DELTA: 0}
+        self.patches = 0
+
+    def reset(self):
+        """ Send the next frame in full """
+
+        self.reference = None
+
+    def compare(self, frame):
+        """
+        Which tiles of a frame changed since the picture the client has.
+
+        :param frame: Decoded BGR frame, numpy array.
+        :returns: 2D boolean numpy array, a cell per tile.
+        """
+        import cv2
+        import numpy
+
+        height, width = frame.shape[:2]
+        channels = frame.shape[2] if frame.ndim == 3 else 1
+        with DIFF_TIME.time():
+            # Sums of the absolute differences over whole tiles from the
+            # corners of the integral image, channels side by side in a row
+            diff = cv2.absdiff(frame, self.reference).reshape(height, width * channels)
+            integral = cv2.integral(diff)
+            rows = numpy.append(numpy.arange(0, height, self.tile), height)
+            columns = numpy.append(numpy.arange(0, width, self.tile), width) * channels
+            corners = integral[numpy.ix_(rows, columns)]
+            sums = corners[1:, 1:] - corners[:-1, 1:] - corners[1:, :-1] + corners[:-1, :-1]
+
+            # Tiles of the last row and column can be smaller
+            areas = numpy.outer(numpy.diff(rows), numpy.diff(columns))
+            return sums > areas * self.threshold
+
+    def next(self, frame):
+        """
+        Decide how to send a frame and update the picture of the client.
+
+        :param frame: Decoded BGR frame, numpy array, at the size it is encoded.
+        :returns: (FULL, None), (UNCHANGED, None) or (DELTA, rects) with the
+                  (x, y, width, height) rectangles to send as patches.
+        """
+        kind, rects = FULL, None
+        if (self.reference is not None and self.reference.shape == frame.shape
+                and self.since_full < self.refresh):
+            changed = self.compare(frame)
+            count = int(changed.sum())
+            if count == 0:
+                kind = UNCHANGED
+            elif self.mode == "tiles" and count <= changed.size * self.max_changed:
+                kind = DELTA
+                height, width = frame.shape[:2]
+                rects = tile_rects(changed, self.tile, (width, height))
+
+        if kind == FULL:
+            self.reference = frame.copy()
+            self.since_full = 0
+        else:
+            self.since_full += 1
+        if kind == DELTA:
+            for x, y, w, h in rects:
+                self.reference[y:y + h, x:x + w] = frame[y:y + h, x:x + w]
+            self.patches += len(rects)
+        self.frames[kind] += 1
+        FRAME_KINDS[kind].inc()
+        return kind, rects
+
+    def snapshot(self):
+        """ Return a dict with the frames sent of each kind """
+
+        return dict(self.frames, patches=self.patches)
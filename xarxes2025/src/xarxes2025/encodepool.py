@@ -0,0 +1,312 @@
+import itertools
+import multiprocessing
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+from loguru import logger
+from xarxes2025.encoders import make_encoder
+from xarxes2025.frameindex import load_index, seek_capture
+from xarxes2025.framecache import FRAME_CACHE, source_key
+from xarxes2025.metrics import stage_timer
+
+
+# Requests to the workers
+ENCODE = 0
+PROBE = 1
+
+# Result status
+OK = 0
+END = 1
+ERROR = 2
+
+# Round trip of a frame through a worker, the stages inside it are not
+# visible from the server process
+POOL_ENCODE_TIME = stage_timer("pool_encode")
+
+
+def encoder_worker(worker_id, shm_name, slots, slot_size, requests, results, free_slots, max_captures=16):
+
+    """ Worker process: owns the VideoCaptures, decodes, resizes and encodes frames into its ring """
+
+    import cv2
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    # (path, mtime, size) -> [VideoCapture, index of the next frame], a
+    # file replaced on disk is opened again
+    captures = OrderedDict()
+    slot = 0
+
+    def capture(source):
+        entry = captures.get(source)
+        if entry is None:
+            cap = cv2.VideoCapture(source[0])
+            if not cap.isOpened():
+                return None
+            entry = captures[source] = [cap, 0]
+            if len(captures) > max_captures:
+                captures.popitem(last=False)[1][0].release()
+        captures.move_to_end(source)
+        return entry
+
+    try:
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            kind, request_id, source, index, size, quality, spec = request
+            entry = capture(source)
+            if entry is None:
+                results.put((worker_id, request_id, ERROR, 0, 0, None))
+                continue
+            cap = entry[0]
+
+            if kind == PROBE:
+                info = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+                results.put((worker_id, request_id, OK, 0, 0, info))
+                continue
+
+            # Same decoding as VideoProcessor.encode_frame
+            if entry[1] != index - 1:
+                seek_capture(cap, entry[1], index - 1, load_index(source[0]))
+            ret, frame = cap.read()
+            if not ret:
+                results.put((worker_id, request_id, END, 0, 0, None))
+                continue
+            entry[1] = index
+            if size:
+                frame = cv2.resize(frame, size)
+            try:
+                encoded_frame = make_encoder(*spec).encode(frame, quality)
+            except Exception:
+                encoded_frame = None
+            if encoded_frame is None or len(encoded_frame) > slot_size:
+                results.put((worker_id, request_id, ERROR, 0, 0, None))
+                continue
+
+            # Wait for the server to copy out the oldest slot before reusing it
+            free_slots.acquire()
+            start = slot * slot_size
+            shm.buf[start:start + len(encoded_frame)] = encoded_frame
+            results.put((worker_id, request_id, OK, slot, len(encoded_frame), None))
+            slot = (slot + 1) % slots
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for cap, _ in captures.values():
+            cap.release()
+        shm.close()
+
+
+class EncoderPool(object):
+    """
+    Pool of processes doing the VideoCapture/resize/imencode work.
+
+    Python code in the encode path holds the GIL, so encoding in the
+    session threads does not scale past one core. The workers are separate
+    processes; each one writes encoded frames into its own ring of slots in
+    shared memory and only sends (slot, length) back through a queue, so no
+    frame is ever pickled. Requests for a file always go to the same worker,
+    which keeps its capture open and reads sequentially.
+    """
+
+    def __init__(self, workers, slots=8, slot_size=4 * 1024 * 1024):
+        """
+        Constructor for EncoderPool object.
+
+        :param workers: Number of worker processes.
+        :param slots: Frames each worker can have waiting in its ring.
+        :param slot_size: Maximum size of an encoded frame.
+        """
+        self.workers = workers
+        self.slot_size = slot_size
+        context = multiprocessing.get_context("spawn")
+        self.results = context.Queue()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count()
+
+        self.rings = []
+        self.requests = []
+        self.free_slots = []
+        self.processes = []
+        for worker_id in range(workers):
+            shm = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+            requests = context.Queue()
+            free_slots = context.Semaphore(slots)
+            process = context.Process(
+                target=encoder_worker,
+                args=(worker_id, shm.name, slots, slot_size, requests, self.results, free_slots),
+                daemon=True,
+                name=f"encoder-{worker_id}")
+            process.start()
+            self.rings.append(shm)
+            self.requests.append(requests)
+            self.free_slots.append(free_slots)
+            self.processes.append(process)
+
+        threading.Thread(target=self.collect, daemon=True, name="encoder-results").start()
+        logger.info(f"Encoder pool started with {workers} processes")
+
+    def collect(self):
+
+        """ Copy the frames out of the rings and wake up whoever asked for them """
+
+        while True:
+            result = self.results.get()
+            if result is None:
+                return
+            worker_id, request_id, status, slot, length, info = result
+            data = None
+            if status == OK and length:
+                start = slot * self.slot_size
+                data = bytes(self.rings[worker_id].buf[start:start + length])
+                self.free_slots[worker_id].release()
+            with self.lock:
+                waiter = self.pending.pop(request_id, None)
+            if waiter is not None:
+                waiter[1] = (status, data, info)
+                waiter[0].set()
+
+    def request(self, kind, source, index=0, size=None, quality=95, spec=None, timeout=10):
+
+        """ Send a request to the worker owning source, a framecache.source_key, and wait for its result,
+        spec is a JPEGEncoder spec """
+
+        request_id = next(self.request_ids)
+        waiter = [threading.Event(), None]
+        with self.lock:
+            self.pending[request_id] = waiter
+        worker_id = zlib.crc32(source[0].encode()) % self.workers
+        self.requests[worker_id].put((kind, request_id, source, index, size, quality, spec))
+        if not waiter[0].wait(timeout):
+            with self.lock:
+                self.pending.pop(request_id, None)
+            logger.error(f"Encoder {worker_id} timed out on {source[0]} frame {index}")
+            raise IOError
+        return waiter[1]
+
+    def encode(self, source, index, size, quality, spec):
+        """
+        Encode frame number index (1-based) of a video in a worker.
+
+        :param source: framecache.source_key of the video.
+        :param spec: Settings of the JPEGEncoder the worker uses.
+        :returns: JPEG bytes, or None past the end of the video.
+        """
+        with POOL_ENCODE_TIME.time():
+            status, data, _ = self.request(ENCODE, source, index, size, quality, spec)
+        if status == ERROR:
+            logger.error(f"Cannot encode frame {index} of {source[0]}")
+            raise IOError
+        return data
+
+    def probe(self, source):
+        """
+        Open a video, a framecache.source_key, in its worker, returns its (width, height) or None if it can't be read.
+        """
+        status, _, info = self.request(PROBE, source)
+        return info if status == OK else None
+
+    def close(self):
+        """ Stop the workers and free the shared memory """
+
+        for requests in self.requests:
+            requests.put(None)
+        for process in self.processes:
+            process.join(timeout=2)
+        self.results.put(None)
+        for shm in self.rings:
+            shm.close()
+            shm.unlink()
+
+
+class PooledVideo(object):
+    """
+    Video source encoding through an EncoderPool.
+
+    Same interface as VideoProcessor and the same shared frame cache, but
+    the frames missing in the cache are encoded by a worker process.
+    """
+
+    adaptive = True
+
+    def __init__(self, filename, pool, size=(500, 380), quality=95, cache=FRAME_CACHE, jpeg=None):
+        """
+        Constructor for PooledVideo object.
+
+        :param filename: The name of the video file to open.
+        :param pool: EncoderPool doing the work.
+        :param size: (width, height) the frames are resized to, None to keep
+                     the source resolution.
+        :param quality: JPEG quality (0-100) used to encode the frames.
+        :param cache: Shared FrameCache for the encoded frames.
+        :param jpeg: JPEGEncoder whose settings the workers use, OpenCV
+                     with the default settings if None.
+        """
+        self.filename = filename
+        self.path = os.path.abspath(filename)
+        self.source = source_key(filename)
+        self.pool = pool
+        self.size = size
+        self.quality = quality
+        self.cache = cache
+        self.jpeg = jpeg or make_encoder()
+        source_size = pool.probe(self.source)
+        if source_size is None:
+            logger.error(f"Cannot open {self.filename} file")
+            raise IOError
+        self.source_size = source_size
+        self.index = load_index(self.filename)
+        self.frame_num = 0
+        self.ready = True
+
+    def next_frame(self):
+        """
+        Return the JPEG bytes of the next frame, or None at the end of the video.
+        """
+        index = self.frame_num + 1
+        spec = self.jpeg.spec
+        key = (self.source, index, self.size, self.quality, spec)
+        data = self.cache.get_or_compute(key, lambda: self.pool.encode(self.source, index, self.size, self.quality, spec))
+        if data is None:
+            return None
+        self.frame_num = index
+        return data
+
+    def seek(self, frame):
+        """
+        Continue the video at a frame, next_frame returns it next.
+
+        :param frame: Frame number, from 0, see FrameIndex.frame_at.
+        """
+        self.frame_num = min(max(frame, 0), self.index.frame_count)
+
+    def skip(self, count):
+        """
+        Skip count frames without encoding them, used when the sender is late.
+        """
+        self.frame_num += count
+
+    def set_encoding(self, size, quality):
+        """
+        Change the size and quality of the next frames, for rate control.
+
+        :param size: (width, height) the frames are resized to, None to keep
+                     the source resolution.
+        :param quality: JPEG quality (0-100).
+        """
+        self.size = size
+        self.quality = quality
+
+    def get_size(self):
+        """
+        Return the (width, height) of the encoded frames.
+        """
+        return self.size or self.source_size
+
+    def get_frame_number(self):
+
+        return self.frame_num
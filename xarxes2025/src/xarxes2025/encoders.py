@@ -0,0 +1,189 @@
+import io
+
+from loguru import logger
+
+
+# JPEG encoder backends for the live encoded videos. They all take a BGR
+# frame as decoded by OpenCV and return a complete JFIF stream, so the
+# client can't tell them apart:
+#
+#   opencv     cv2.imencode (libjpeg-turbo bundled with OpenCV)
+#   pillow     PIL.Image.save, needs a BGR to RGB conversion first
+#   turbojpeg  PyTurboJPEG, libjpeg-turbo called directly (optional)
+#
+# Chroma subsampling: 444 keeps all the colour, 422 halves it
+# horizontally, 420 in both directions (the libjpeg default, the smallest).
+
+ENCODERS = ("opencv", "pillow", "turbojpeg")
+SUBSAMPLINGS = ("444", "422", "420")
+DEFAULT_ENCODER = "opencv"
+DEFAULT_SUBSAMPLING = "420"
+
+
+class JPEGEncoder(object):
+    """
+    JPEG encoding settings and the backend applying them.
+
+    Encoders are cheap to create and hold no state between frames, so one
+    can be shared by every session with the same settings. Their spec
+    is part of the frame cache key and is what goes to the encode workers.
+    """
+
+    name = None
+
+    def __init__(self, subsampling=DEFAULT_SUBSAMPLING, optimize=False, progressive=False):
+        """
+        Constructor for JPEGEncoder object.
+
+        :param subsampling: Chroma subsampling, "444", "422" or "420".
+        :param optimize: Compute optimal Huffman tables, smaller frames
+                         for some more CPU.
+        :param progressive: Progressive JPEG, the client decodes it all the same.
+        """
+        if subsampling not in SUBSAMPLINGS:
+            logger.error(f"Unknown chroma subsampling {subsampling}")
+            raise ValueError(subsampling)
+        self.subsampling = subsampling
+        self.optimize = optimize
+        self.progressive = progressive
+
+    @property
+    def spec(self):
+        """ (name, subsampling, optimize, progressive), see make_encoder """
+
+        return (self.name, self.subsampling, self.optimize, self.progressive)
+
+    def encode(self, frame, quality):
+        """
+        Encode a frame.
+
+        :param frame: BGR image, a numpy array as returned by cv2.
+        :param quality: JPEG quality (0-100).
+        :returns: JPEG bytes. Raises IOError if the frame can't be encoded.
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        flags = "".join((" optimize" if self.optimize else "", " progressive" if self.progressive else ""))
+        return f"{self.name} {self.subsampling}{flags}"
+
+
+class OpenCVEncoder(JPEGEncoder):
+
+    name = "opencv"
+
+    def __init__(self, subsampling=DEFAULT_SUBSAMPLING, optimize=False, progressive=False):
+        import cv2
+
+        super().__init__(subsampling, optimize, progressive)
+        factor = getattr(cv2, f"IMWRITE_JPEG_SAMPLING_FACTOR_{subsampling}")
+        self.cv2 = cv2
+        self.params = [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, factor,
+                       cv2.IMWRITE_JPEG_OPTIMIZE, int(optimize),
+                       cv2.IMWRITE_JPEG_PROGRESSIVE, int(progressive)]
+
+    def encode(self, frame, quality):
+        ret, encoded_frame = self.cv2.imencode('.jpg', frame, [self.cv2.IMWRITE_JPEG_QUALITY, quality] + self.params)
+        if not ret:
+            raise IOError
+        return encoded_frame.tobytes()
+
+
+class PillowEncoder(JPEGEncoder):
+
+    name = "pillow"
+
+    # Pillow numbers the subsamplings
+    SUBSAMPLING = {"444": 0, "422": 1, "420": 2}
+
+    def __init__(self, subsampling=DEFAULT_SUBSAMPLING, optimize=False, progressive=False):
+        import cv2
+        from PIL import Image
+
+        super().__init__(subsampling, optimize, progressive)
+        self.cv2 = cv2
+        self.Image = Image
+
+    def encode(self, frame, quality):
+        image = self.Image.fromarray(self.cv2.cvtColor(frame, self.cv2.COLOR_BGR2RGB))
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=quality, subsampling=self.SUBSAMPLING[self.subsampling],
+                   optimize=self.optimize, progressive=self.progressive)
+        return output.getvalue()
+
+
+class TurboJPEGEncoder(JPEGEncoder):
+
+    name = "turbojpeg"
+
+    def __init__(self, subsampling=DEFAULT_SUBSAMPLING, optimize=False, progressive=False):
+        # Raises ImportError without PyTurboJPEG, or OSError without the library
+        import turbojpeg
+
+        super().__init__(subsampling, optimize, progressive)
+        self.turbo = turbojpeg.TurboJPEG()
+        self.jpeg_subsample = getattr(turbojpeg, f"TJSAMP_{subsampling}")
+        self.pixel_format = turbojpeg.TJPF_BGR
+        self.flags = (turbojpeg.TJFLAG_PROGRESSIVE if progressive else 0)
+        if optimize and not progressive:
+            # Progressive frames always get optimal tables. Builds without the
+            # flag can't compute them, the encoder says so in its spec
+            if hasattr(turbojpeg, "TJFLAG_OPTIMIZE"):
+                self.flags |= turbojpeg.TJFLAG_OPTIMIZE
+            else:
+                logger.warning("This PyTurboJPEG has no TJFLAG_OPTIMIZE, turbojpeg frames are not optimized")
+                self.optimize = False
+
+    def encode(self, frame, quality):
+        return self.turbo.encode(frame, quality=quality, pixel_format=self.pixel_format,
+                                 jpeg_subsample=self.jpeg_subsample, flags=self.flags)
+
+
+BACKENDS = {
+    "opencv": OpenCVEncoder,
+    "pillow": PillowEncoder,
+    "turbojpeg": TurboJPEGEncoder,
+}
+
+# spec -> JPEGEncoder, encoders are shared
+ENCODER_CACHE = {}
+
+
+def make_encoder(name=DEFAULT_ENCODER, subsampling=DEFAULT_SUBSAMPLING, optimize=False, progressive=False):
+    """
+    Return the encoder for some settings, shared with whoever asked for the same.
+
+    :param name: Backend, one of ENCODERS.
+    :param subsampling: Chroma subsampling, one of SUBSAMPLINGS.
+    :param optimize: Optimal Huffman tables.
+    :param progressive: Progressive JPEG.
+    :returns: The JPEGEncoder. Raises ValueError for unknown settings and
+              ImportError if the backend is not installed.
+    """
+    spec = (name, subsampling, optimize, progressive)
+    encoder = ENCODER_CACHE.get(spec)
+    if encoder is None:
+        backend = BACKENDS.get(name)
+        if backend is None:
+            logger.error(f"Unknown JPEG encoder {name}")
+            raise ValueError(name)
+        try:
+            encoder = ENCODER_CACHE[spec] = backend(subsampling, optimize, progressive)
+        except (ImportError, OSError) as e:
+            logger.error(f"JPEG encoder {name} is not available: {e}")
+            raise
+    return encoder
+
+
+def available_encoders():
+
+    """ Names of the backends that can be used here """
+
+    names = []
+    for name in ENCODERS:
+        try:
+            BACKENDS[name]()
+        except (ImportError, OSError):
+            continue
+        names.append(name)
+    return names
@@ -0,0 +1,238 @@
+import collections
+import random
+import struct
+
+from xarxes2025.udpdatagram import RTP_FIELDS, UDPDatagram
+
+
+# Forward error correction of the RTP video stream, a simplified ULPFEC
+# (RFC 5109) with a single protection level:
+#
+#   The media packets of a frame are split in groups of K consecutive
+#   sequence numbers, and after each group the server sends a parity packet:
+#   the XOR of their RTP payloads (padded to the longest), marker/PT bytes,
+#   timestamps and payload lengths. A receiver that got the parity and all
+#   the packets of a group but one rebuilds the missing one, without asking
+#   for it again. Two losses in a group, or the loss of the parity, can't
+#   be recovered.
+#
+# Groups never span two frames, so a frame never waits for the next one to
+# be repaired: a frame of N packets gets ceil(N / K) parity packets, the
+# overhead is 1/K of the packets plus at most one per frame.
+#
+# Parity packets share the SSRC and the timestamp of the stream and have
+# their own payload type and sequence numbers, the loss statistics and the
+# RTCP reports only count the media packets.
+
+# RTP payload type of the parity packets (dynamic range)
+FEC_PT = 127
+
+# Parity header after the RTP header: base sequence number and number of
+# the protected packets, marker/PT, timestamp and length recovery fields
+FEC_HEADER = struct.Struct("!HBBIH")
+
+# Largest group of media packets behind a parity packet
+MAX_GROUP = 64
+
+# Media packets kept by the receiver to repair a group
+MEDIA_WINDOW = 1024
+
+# Parity packets kept while their group misses more than one packet, in
+# case the others arrive late
+PENDING_PARITIES = 64
+
+
+def is_parity(data):
+
+    """ True if the RTP datagram is a parity packet """
+
+    return len(data) > 1 and data[1] & 0x7F == FEC_PT
+
+
+class FECEncoder(object):
+    """
+    Adds the parity packets to the packets of a stream.
+
+    The media packets must leave FEC_HEADER.size bytes below the MTU for
+    the parity packet, the longest one plus its header, to fit it.
+    """
+
+    def __init__(self, k, ssrc):
+        """
+        Constructor for FECEncoder object.
+
+        :param k: Media packets per parity packet, 1 to MAX_GROUP.
+        :param ssrc: SSRC of the stream.
+        """
+        if not 1 <= k <= MAX_GROUP:
+            raise ValueError(f"FEC groups of {k} packets, must be 1 to {MAX_GROUP}")
+        self.k = k
+        self.ssrc = ssrc
+        self.seqnum = random.getrandbits(16)
+        self.parity_packets = 0
+        self.parity_bytes = 0
+
+    def protect(self, packets, timestamp):
+        """
+        Packets of a frame with a parity packet after each group of k.
+
+        :param packets: (header, payload) media packets of a frame, the
+                        header beginning with the RTP header.
+        :param timestamp: RTP timestamp of the frame.
+        :returns: List of (header, payload) packets, media and parity.
+        """
+        k = self.k
+        protected = []
+        for start in range(0, len(packets), k):
+            group = packets[start:start + k]
+            protected += group
+            protected.append(self.parity(group, timestamp))
+        return protected
+
+    def parity(self, group, timestamp):
+
+        """ Parity (header, payload) packet of a group of media packets """
+
+        size = UDPDatagram.HEADER_SIZE
+        payloads = [bytes(header[size:]) + bytes(payload) for header, payload in group]
+        length = max(len(payload) for payload in payloads)
+        marker_pt = ts_recovery = length_recovery = 0
+        value = 0
+        for (header, _), payload in zip(group, payloads):
+            byte, _, packet_ts, _ = RTP_FIELDS.unpack_from(header, 1)
+            marker_pt ^= byte
+            ts_recovery ^= packet_ts
+            length_recovery ^= len(payload)
+            value ^= int.from_bytes(payload, "big") << (8 * (length - len(payload)))
+
+        header = bytearray(size)
+        header[0] = 2 << 6
+        RTP_FIELDS.pack_into(header, 1, FEC_PT, self.seqnum, timestamp, self.ssrc)
+        base = RTP_FIELDS.unpack_from(group[0][0], 1)[1]
+        body = FEC_HEADER.pack(base, len(group), marker_pt, ts_recovery, length_recovery) \
+            + value.to_bytes(length, "big")
+        self.seqnum = (self.seqnum + 1) & 0xFFFF
+        self.parity_packets += 1
+        self.parity_bytes += size + len(body)
+        return (bytes(header), body)
+
+
+class ParityPacket(object):
+
+    """ Parity packet received, with the group it protects """
+
+    def __init__(self, data):
+        self.ssrc = RTP_FIELDS.unpack_from(data, 1)[3]
+        (self.base, self.count, self.marker_pt, self.ts_recovery,
+         self.length_recovery) = FEC_HEADER.unpack_from(data, UDPDatagram.HEADER_SIZE)
+        self.payload = data[UDPDatagram.HEADER_SIZE + FEC_HEADER.size:]
+
+    def covers(self, seqnum):
+        return (seqnum - self.base) & 0xFFFF < self.count
+
+    def seqnums(self):
+        return [(self.base + n) & 0xFFFF for n in range(self.count)]
+
+
+class FECDecoder(object):
+    """
+    Rebuilds the media packets lost in the groups missing a single one.
+
+    Not thread safe, used by the thread receiving the stream. Every media
+    packet goes through add_media() and every parity packet through
+    add_parity(); both return the RTP datagrams they rebuilt, to be handled
+    like the ones received. The packets lost are counted by the loss
+    statistics, recovered tells how many of them were rebuilt.
+    """
+
+    def __init__(self):
+        # Datagrams of the last MEDIA_WINDOW media packets by sequence number
+        self.media = {}
+        self.order = collections.deque()
+
+        # Parities of the groups missing more than one packet
+        self.pending = collections.deque()
+
+        # Counters
+        self.parities = 0
+        self.recovered = 0
+
+    def add_media(self, seqnum, data):
+
+        """ Keep a media packet, return the datagrams of the pending groups it completes to one loss """
+
+        if seqnum in self.media:
+            return []
+        self.media[seqnum] = data
+        self.order.append(seqnum)
+        if len(self.order) > MEDIA_WINDOW:
+            self.media.pop(self.order.popleft(), None)
+
+        recovered = []
+        for parity in [parity for parity in self.pending if parity.covers(seqnum)]:
+            packet = self.repair(parity)
+            if packet is not None:
+                recovered.append(packet)
+        return recovered
+
+    def add_parity(self, data):
+
+        """ Take a parity packet, return the datagram of the packet it rebuilds, if any """
+
+        if len(data) < UDPDatagram.HEADER_SIZE + FEC_HEADER.size:
+            return []
+        self.parities += 1
+        parity = ParityPacket(data)
+        packet = self.repair(parity)
+        return [packet] if packet is not None else []
+
+    def repair(self, parity):
+        """
+        Rebuild the packet missing in the group of a parity.
+
+        :returns: The datagram of the missing packet, or None when none is
+                  missing (the parity is dropped) or more than one is (it
+                  waits in the pending parities for more packets).
+        """
+        missing = [seqnum for seqnum in parity.seqnums() if seqnum not in self.media]
+        if len(missing) != 1:
+            if parity in self.pending:
+                if not missing:
+                    self.pending.remove(parity)
+            elif missing:
+                self.pending.append(parity)
+                if len(self.pending) > PENDING_PARITIES:
+                    self.pending.popleft()
+            return None
+        if parity in self.pending:
+            self.pending.remove(parity)
+
+        size = UDPDatagram.HEADER_SIZE
+        length = len(parity.payload)
+        marker_pt = parity.marker_pt
+        timestamp = parity.ts_recovery
+        payload_length = parity.length_recovery
+        value = int.from_bytes(parity.payload, "big")
+        for seqnum in parity.seqnums():
+            data = self.media.get(seqnum)
+            if data is None:
+                continue
+            payload = data[size:]
+            if len(payload) > length:
+                return None
+            byte, _, packet_ts, _ = RTP_FIELDS.unpack_from(data, 1)
+            marker_pt ^= byte
+            timestamp ^= packet_ts
+            payload_length ^= len(payload)
+            value ^= int.from_bytes(payload, "big") << (8 * (length - len(payload)))
+        if payload_length > length:
+            return None
+
+        header = bytearray(size)
+        header[0] = 2 << 6
+        RTP_FIELDS.pack_into(header, 1, marker_pt, missing[0], timestamp, parity.ssrc)
+        data = bytes(header) + value.to_bytes(length, "big")[:payload_length]
+        self.media[missing[0]] = data
+        self.order.append(missing[0])
+        self.recovered += 1
+        return data
@@ -0,0 +1,147 @@
+import os
+import threading
+from collections import OrderedDict
+
+from loguru import logger
+
+
+class FrameCache(object):
+    """
+    Process-wide cache of encoded frames shared by all the sessions.
+
+    Entries are keyed by (source, frame index, resolution, quality) and are
+    evicted in LRU order once the total size of the cached frames goes over
+    the memory budget. Concurrent misses on the same key are collapsed so
+    that only one session decodes and encodes a frame, the rest wait for it.
+    """
+
+    def __init__(self, budget=256 * 1024 * 1024):
+        """
+        Constructor for FrameCache object.
+
+        :param budget: Maximum number of bytes of encoded frames to keep.
+        """
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        # Counters to size the budget
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def set_budget(self, budget):
+        """ Change the memory budget, evicting entries if needed """
+
+        with self.lock:
+            self.budget = budget
+            self._evict()
+        logger.debug(f"Frame cache budget set to {budget} bytes")
+
+    def get(self, key):
+        """ Return the cached frame for key or None, updating counters """
+
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """ Store an encoded frame, evicting the least recently used ones """
+
+        with self.lock:
+            self._store(key, data)
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached frame for key, or call compute() to produce it.
+
+        If another thread is already computing the same key, wait for it
+        instead of encoding the frame twice. A None result (end of video)
+        is returned but never cached.
+
+        :param key: Cache key (source, frame index, resolution, quality).
+        :param compute: Callable returning the encoded bytes or None.
+        :returns: The encoded frame bytes or None.
+        """
+        while True:
+            with self.lock:
+                data = self.entries.get(key)
+                if data is not None:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return data
+                waiter = self.pending.get(key)
+                if waiter is None:
+                    self.misses += 1
+                    waiter = self.pending[key] = threading.Event()
+                    break
+            # Someone else is encoding it, wait and look again
+            waiter.wait()
+
+        try:
+            data = compute()
+            if data is not None:
+                self.put(key, data)
+            return data
+        finally:
+            with self.lock:
+                del self.pending[key]
+            waiter.set()
+
+    def clear(self):
+        """ Drop every cached frame """
+
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Return a dict with the cache counters """
+
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "budget": self.budget,
+            }
+
+    def _store(self, key, data):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        if len(data) > self.budget:
+            return
+        self.entries[key] = data
+        self.size += len(data)
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.budget and self.entries:
+            _, data = self.entries.popitem(last=False)
+            self.size -= len(data)
+            self.evictions += 1
+
+
+def source_key(filename):
+    """
+    Identity of a video file in the cache keys: its absolute path, mtime and size.
+
+    A file replaced on disk gets a new identity, its old frames are not
+    served any more and age out of the cache.
+    """
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+
+# Shared by every VideoProcessor of the process
+FRAME_CACHE = FrameCache()
@@ -0,0 +1,268 @@
+import os
+import struct
+import threading
+from bisect import bisect_right
+
+from loguru import logger
+
+
+# Frame index of a video file, built once and written next to it:
+#
+#   header    magic, version, frame count, fps * 1000 and the size and
+#             mtime (ns) of the video it was built from
+#   entries   one per frame in presentation order: timestamp
+#             (microseconds) and a keyframe flag
+#
+# The index is rebuilt when the video changes. Building it reads the
+# compressed packets only, no frame is decoded.
+
+MAGIC = b"XIX1"
+VERSION = 1
+HEADER = struct.Struct("!4sHHIIQQ")
+INDEX_ENTRY = struct.Struct("!QB")
+EXTENSION = ".xix"
+
+# Frames grabbed forward instead of seeking when there is no keyframe in
+# between, whatever the index says (a bad index must not make seeks slow)
+MAX_GRAB = 300
+
+
+def index_path(filename):
+
+    """ Name of the frame index of a video file """
+
+    return filename + EXTENSION
+
+
+class FrameIndex(object):
+    """
+    Timestamps and keyframes of the frames of a video.
+
+    Frames are numbered from 0 in presentation order. A frame is decoded
+    from the last keyframe at or before it, so reaching any frame costs at
+    most one seek plus a GOP of decoding.
+    """
+
+    def __init__(self, timestamps, keyframes, fps):
+        """
+        Constructor for FrameIndex object.
+
+        :param timestamps: Presentation time of each frame, in microseconds.
+        :param keyframes: Sorted numbers of the keyframes.
+        :param fps: Frame rate of the video.
+        """
+        self.timestamps = timestamps
+        self.keyframes = keyframes
+        self.fps = fps
+
+    @classmethod
+    def uniform(cls, frame_count, fps):
+        """ Index of a video whose packets can't be read: constant rate, every frame a keyframe """
+
+        fps = fps or 25
+        return cls([int(n * 1000000 / fps) for n in range(frame_count)], list(range(frame_count)), fps)
+
+    @property
+    def frame_count(self):
+        return len(self.timestamps)
+
+    @property
+    def duration(self):
+        """ Seconds of video, up to the end of the last frame """
+
+        if not self.timestamps:
+            return 0.0
+        return self.timestamps[-1] / 1000000 + 1 / self.fps
+
+    def frame_at(self, seconds):
+        """ Number of the frame shown at a time of the video """
+
+        return max(bisect_right(self.timestamps, int(seconds * 1000000)) - 1, 0)
+
+    def time_of(self, frame):
+        """ Presentation time of a frame, in seconds """
+
+        if not self.timestamps:
+            return 0.0
+        return self.timestamps[min(max(frame, 0), len(self.timestamps) - 1)] / 1000000
+
+    def keyframe_before(self, frame):
+        """ Last keyframe at or before a frame """
+
+        position = bisect_right(self.keyframes, frame)
+        return self.keyframes[position - 1] if position else 0
+
+    def keyframe_between(self, start, end):
+        """ True if there is a keyframe after frame start and up to frame end """
+
+        return self.keyframe_before(end) > start
+
+    def save(self, path, stat):
+        """
+        Write the index, atomically.
+
+        :param path: Index file.
+        :param stat: os.stat of the video, to detect it changed.
+        """
+        keyframes = set(self.keyframes)
+        with open(path + ".tmp", "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, 0, len(self.timestamps), int(self.fps * 1000),
+                                stat.st_size, stat.st_mtime_ns))
+            f.write(b"".join(INDEX_ENTRY.pack(timestamp, n in keyframes)
+                             for n, timestamp in enumerate(self.timestamps)))
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path, stat):
+        """
+        Read an index.
+
+        :param path: Index file.
+        :param stat: os.stat of the video.
+        :returns: The FrameIndex, or None if the file is not an index of
+                  this version of the video.
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < HEADER.size:
+            return None
+        magic, version, _, frame_count, fps, size, mtime = HEADER.unpack_from(data)
+        if (magic != MAGIC or version != VERSION or (size, mtime) != (stat.st_size, stat.st_mtime_ns)
+                or len(data) != HEADER.size + frame_count * INDEX_ENTRY.size):
+            return None
+        timestamps = []
+        keyframes = []
+        for n, (timestamp, key) in enumerate(INDEX_ENTRY.iter_unpack(data[HEADER.size:])):
+            timestamps.append(timestamp)
+            if key:
+                keyframes.append(n)
+        return cls(timestamps, keyframes, fps / 1000)
+
+
+def build_index(filename):
+    """
+    Scan the compressed packets of a video for their timestamps and keyframes.
+
+    :param filename: Video file.
+    :returns: The FrameIndex.
+    """
+    import cv2
+
+    cap = cv2.VideoCapture(filename, cv2.CAP_FFMPEG, [cv2.CAP_PROP_FORMAT, -1])
+    if not cap.isOpened():
+        logger.error(f"Cannot open {filename} file")
+        raise IOError
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25
+
+    packets = []
+    while True:
+        ret, _ = cap.read()
+        if not ret:
+            break
+        packets.append((int(cap.get(cv2.CAP_PROP_POS_MSEC) * 1000), bool(cap.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME))))
+    cap.release()
+
+    if not any(key for _, key in packets):
+        logger.warning(f"No keyframe information in {filename}, seeks won't use the index")
+        return FrameIndex.uniform(len(packets), fps)
+
+    # Packets come in decoding order, frames are numbered in presentation order
+    if len(packets) > 1 and packets[-1][0] > 0:
+        packets.sort(key=lambda packet: packet[0])
+    else:
+        packets = [(int(n * 1000000 / fps), key) for n, (_, key) in enumerate(packets)]
+    timestamps = [timestamp for timestamp, _ in packets]
+    keyframes = [n for n, (_, key) in enumerate(packets) if key]
+    return FrameIndex(timestamps, keyframes, fps)
+
+
+# Path -> (mtime, FrameIndex) of the indexes loaded by this process, and
+# path -> lock held while the index of that file is read or built
+INDEXES = {}
+INDEX_LOCKS = {}
+INDEXES_LOCK = threading.Lock()
+
+
+def load_index(filename):
+    """
+    Return the frame index of a video, building and saving it the first time.
+
+    Building reads the whole file: it holds a lock of that file only, the
+    sessions opening other videos don't wait for it (and the asyncio
+    engine calls this from its executor, see RTSPSession.run_blocking).
+
+    :param filename: Video file.
+    :returns: The FrameIndex. If the packets can't be scanned, a uniform
+              index from the frame count and rate.
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    with INDEXES_LOCK:
+        cached = INDEXES.get(path)
+        if cached is not None and cached[0] == stat.st_mtime_ns:
+            return cached[1]
+        lock = INDEX_LOCKS.setdefault(path, threading.Lock())
+
+    with lock:
+        # Loaded by another session while this one waited
+        with INDEXES_LOCK:
+            cached = INDEXES.get(path)
+        if cached is not None and cached[0] == stat.st_mtime_ns:
+            return cached[1]
+
+        index = None
+        try:
+            index = FrameIndex.load(index_path(path), stat)
+        except OSError:
+            pass
+        if index is None:
+            try:
+                index = build_index(path)
+            except Exception as e:
+                logger.warning(f"Cannot index {filename}: {e}")
+                import cv2
+                cap = cv2.VideoCapture(path)
+                index = FrameIndex.uniform(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), cap.get(cv2.CAP_PROP_FPS))
+                cap.release()
+            else:
+                try:
+                    index.save(index_path(path), stat)
+                    logger.info(f"Indexed {index.frame_count} frames, {len(index.keyframes)} keyframes of {filename}")
+                except OSError as e:
+                    logger.warning(f"Cannot write the frame index of {filename}: {e}")
+        with INDEXES_LOCK:
+            INDEXES[path] = (stat.st_mtime_ns, index)
+        return index
+
+
+def seek_capture(cap, position, target, index):
+    """
+    Move a VideoCapture so its next read returns frame target.
+
+    The capture seeks to the keyframe before the target, where decoding
+    can restart, and grabs (decodes, not converts) the frames from there
+    to the target. When no keyframe lies between the current position and
+    the target, decoding forward from where the capture is costs less, so
+    it only grabs.
+
+    :param cap: The VideoCapture.
+    :param position: Frame its next read returns now.
+    :param target: Frame the next read must return.
+    :param index: FrameIndex of the video.
+    """
+    import cv2
+
+    if position == target:
+        return
+    if position < target and target - position <= MAX_GRAB and not index.keyframe_between(position, target):
+        for _ in range(target - position):
+            cap.grab()
+        return
+
+    # A GOP longer than MAX_GRAB is not believed, the backend seeks alone
+    keyframe = index.keyframe_before(target)
+    if target - keyframe > MAX_GRAB:
+        keyframe = target
+    cap.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+    for _ in range(target - keyframe):
+        cap.grab()
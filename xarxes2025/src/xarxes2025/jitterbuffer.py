@@ -0,0 +1,141 @@
+import heapq
+import itertools
+import threading
+
+from xarxes2025.rtpjpeg import CLOCK_RATE
+
+
+class JitterBuffer(object):
+    """
+    Buffer between the network and the screen.
+
+    Frames are ordered by RTP timestamp and each one is given a playout time
+    from its timestamp: the media clock is anchored to the local monotonic
+    clock on the frame that arrived with the least delay, plus a fixed
+    playout delay. Frames are released when their playout time comes, so
+    bursts don't play fast and gaps don't stall the clock. A frame that
+    arrives after its playout time is dropped as late.
+    """
+
+    # Frames later than this restart the clock instead of being dropped,
+    # the server stopped sending for a while (pause, stall)
+    RESYNC_THRESHOLD = 1.0
+
+    def __init__(self, playout_delay=0.1, clock_rate=CLOCK_RATE, max_depth=100):
+        """
+        Constructor for JitterBuffer object.
+
+        :param playout_delay: Seconds a frame is held after its ideal arrival.
+        :param clock_rate: RTP timestamp units per second.
+        :param max_depth: Maximum frames held, the oldest is dropped beyond.
+        """
+        self.playout_delay = playout_delay
+        self.clock_rate = clock_rate
+        self.max_depth = max_depth
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.reset()
+
+    def reset(self):
+        """ Forget the frames and the clock anchor, e.g. after a teardown """
+
+        self.resync()
+        with self.lock:
+            self.frames_played = 0
+            self.late_drops = 0
+            self.overflow_drops = 0
+            self.skipped = 0
+
+    def resync(self):
+        """ Drop the held frames and re-anchor the clock on the next frame, e.g. on PLAY """
+
+        with self.lock:
+            self.heap = []
+            self.last_timestamp = None
+            self.base = None
+            self.released = None
+
+    def unwrap(self, timestamp):
+
+        """ Extend a 32 bit RTP timestamp so it keeps growing across wrap arounds """
+
+        if self.last_timestamp is None:
+            extended = timestamp
+        else:
+            delta = (timestamp - self.last_timestamp) & 0xFFFFFFFF
+            if delta >= 0x80000000:
+                delta -= 0x100000000
+            extended = self.last_extended + delta
+        if self.last_timestamp is None or extended > self.last_extended:
+            self.last_timestamp = timestamp
+            self.last_extended = extended
+        return extended
+
+    def push(self, timestamp, frame, now):
+        """
+        Add a complete frame.
+
+        :param timestamp: RTP timestamp of the frame.
+        :param frame: Frame data, returned as is by pop_due.
+        :param now: Arrival time, time.monotonic().
+        :returns: False if the frame was dropped as late.
+        """
+        with self.lock:
+            extended = self.unwrap(timestamp)
+            media_time = extended / self.clock_rate
+
+            # Anchor the media clock on the frame with the least transit time
+            if self.base is None or now - media_time < self.base:
+                self.base = now - media_time
+
+            playout = self.base + media_time + self.playout_delay
+            if now - playout > self.RESYNC_THRESHOLD and not self.heap:
+                self.base = now - media_time
+                playout = now + self.playout_delay
+            if now > playout or (self.released is not None and extended <= self.released):
+                self.late_drops += 1
+                return False
+
+            heapq.heappush(self.heap, (extended, next(self.counter), frame))
+            if len(self.heap) > self.max_depth:
+                heapq.heappop(self.heap)
+                self.overflow_drops += 1
+            return True
+
+    def pop_due(self, now):
+        """
+        Release the frames whose playout time has come.
+
+        :param now: Current time, time.monotonic().
+        :returns: The newest due frame or None. Older due frames are
+                  skipped, they would be shown for no time at all.
+        """
+        frames = self.pop_all_due(now)
+        return frames[-1] if frames else None
+
+    def pop_all_due(self, now):
+        """
+        Release the frames whose playout time has come, all of them.
+
+        Delta frames must all be applied even if only the last one is shown.
+
+        :param now: Current time, time.monotonic().
+        :returns: List of the due frames in timestamp order, all but the
+                  last counted as skipped.
+        """
+        with self.lock:
+            frames = []
+            while self.heap and self.base + self.heap[0][0] / self.clock_rate + self.playout_delay <= now:
+                extended, _, due = heapq.heappop(self.heap)
+                frames.append(due)
+                self.released = extended
+            if frames:
+                self.frames_played += 1
+                self.skipped += len(frames) - 1
+            return frames
+
+    def depth(self):
+        """ Number of frames waiting for their playout time """
+
+        with self.lock:
+            return len(self.heap)
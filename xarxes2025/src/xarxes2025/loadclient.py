@@ -0,0 +1,460 @@
+import asyncio
+import itertools
+import random
+import time
+
+from loguru import logger
+from xarxes2025.delta import is_delta
+from xarxes2025.fec import FECDecoder, is_parity
+from xarxes2025.rtcp import RTCP_INTERVAL, ReceptionStats, build_receiver_report
+from xarxes2025.rtpjpeg import CLOCK_RATE, FrameReassembler
+from xarxes2025.rtsp import RTSPParser, RTSPResponse, parse_range, parse_transport
+from xarxes2025.udpdatagram import RTP_FIELDS, UDPDatagram
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Summary of a list of values, nearest-rank percentiles.
+
+    :param values: The samples.
+    :param points: Percentiles to report.
+    :returns: Dict with p<n> for each point and max, all None without samples.
+    """
+    summary = {f"p{point}": None for point in points}
+    summary["max"] = None
+    if not values:
+        return summary
+    ordered = sorted(values)
+    for point in points:
+        summary[f"p{point}"] = round(ordered[min(len(ordered) - 1, int(len(ordered) * point / 100))], 3)
+    summary["max"] = round(ordered[-1], 3)
+    return summary
+
+
+class ViewerStats(object):
+    """
+    What one headless viewer received.
+
+    Loss is the packets expected from the highest sequence number seen
+    minus the packets received, the residual loss leaves out the ones the
+    parity packets rebuilt (FEC). Inter-frame jitter is how much the arrival
+    interval of two consecutive frames differs from the interval of their
+    RTP timestamps, in ms.
+    """
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.frames = 0
+        self.delta_frames = 0
+        self.parity_packets = 0
+        self.recovered = 0
+        self.setup_ms = None
+        self.first_frame_ms = None
+        self.jitter_ms = []
+        self.seek_ms = []
+        self.error = None
+
+        # First and highest sequence numbers, extended past 16 bits
+        self.base_seq = None
+        self.max_seq = None
+        self.last_frame = None
+
+    def on_packet(self, seqnum, size):
+        """ Account a packet """
+
+        if self.max_seq is None:
+            self.base_seq = self.max_seq = seqnum
+        else:
+            delta = (seqnum - self.max_seq) & 0xFFFF
+            if delta < 0x8000:
+                self.max_seq += delta
+        self.packets += 1
+        self.bytes += size
+
+    def on_parity(self, size):
+        """ Account a parity packet, it has no place in the media sequence numbers """
+
+        self.parity_packets += 1
+        self.bytes += size
+
+    @property
+    def lost(self):
+        if self.max_seq is None:
+            return 0
+        return max(self.max_seq - self.base_seq + 1 - self.packets, 0)
+
+    def on_frame(self, timestamp, arrival):
+        """ Account a complete frame and its inter-frame jitter """
+
+        if self.last_frame is not None:
+            last_timestamp, last_arrival = self.last_frame
+            expected = ((timestamp - last_timestamp) & 0xFFFFFFFF) / CLOCK_RATE
+            self.jitter_ms.append(abs((arrival - last_arrival) - expected) * 1000)
+        self.last_frame = (timestamp, arrival)
+        self.frames += 1
+
+    def snapshot(self):
+        """ Return a dict with the counters of the viewer """
+
+        lost = self.lost
+        total = self.packets + lost
+        unrecoverable = max(lost - self.recovered, 0)
+        return {
+            "frames": self.frames,
+            "delta_frames": self.delta_frames,
+            "packets": self.packets,
+            "parity_packets": self.parity_packets,
+            "bytes": self.bytes,
+            "lost": lost,
+            "loss_rate": round(lost / total, 4) if total else 0.0,
+            "fec_recovered": self.recovered,
+            "fec_unrecoverable": unrecoverable,
+            "residual_loss_rate": round(unrecoverable / total, 4) if total else 0.0,
+            "setup_ms": self.setup_ms,
+            "first_frame_ms": self.first_frame_ms,
+            "seeks": len(self.seek_ms),
+            "error": self.error,
+        }
+
+
+class RTPReceiver(asyncio.DatagramProtocol):
+
+    """ Datagram protocol of a headless viewer: stats and frame reassembly, no decoding """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.reassembler = FrameReassembler()
+        self.reception = ReceptionStats()
+        self.fec = FECDecoder()
+        self.first_frame = None
+
+        # Resolved by the first frame after a seek
+        self.seek_frame = None
+
+    def datagram_received(self, data, address):
+        if len(data) < UDPDatagram.HEADER_SIZE:
+            return
+        now = time.monotonic()
+        if is_parity(data):
+            self.stats.on_parity(len(data))
+            recovered = self.fec.add_parity(data)
+        else:
+            marker_pt, seqnum, timestamp, ssrc = RTP_FIELDS.unpack_from(data, 1)
+            self.stats.on_packet(seqnum, len(data))
+            self.reception.update(seqnum, timestamp, now, ssrc)
+            recovered = self.fec.add_media(seqnum, data)
+            self.reassemble(data, now)
+        for packet in recovered:
+            self.reassemble(packet, now)
+        self.stats.recovered = self.fec.recovered
+
+    def reassemble(self, data, now):
+
+        """ Add a packet, received or rebuilt, to its frame """
+
+        marker_pt, _, timestamp, _ = RTP_FIELDS.unpack_from(data, 1)
+        frame = self.reassembler.add(timestamp, data[UDPDatagram.HEADER_SIZE:], marker_pt >> 7)
+        if frame is not None:
+            self.stats.on_frame(timestamp, now)
+            if is_delta(frame):
+                self.stats.delta_frames += 1
+            if self.first_frame is not None and not self.first_frame.done():
+                self.first_frame.set_result(now)
+            if self.seek_frame is not None and not self.seek_frame.done():
+                self.seek_frame.set_result(now)
+
+
+class HeadlessClient(object):
+    """
+    RTSP client without UI, for load tests.
+
+    Runs the same SETUP, PLAY, PAUSE, TEARDOWN sequence as the Tk client
+    on the event loop, so one process can simulate many viewers. Frames
+    are reassembled but not decoded.
+    """
+
+    def __init__(self, host, port, filename, stats=None, timeout=5, encoding=None, fec=None):
+        """
+        Constructor for HeadlessClient object.
+
+        :param host: RTSP server address.
+        :param port: RTSP server port.
+        :param filename: Video to SETUP, e.g. rick.webm or channel/rick.webm.
+        :param stats: ViewerStats to fill, a new one by default.
+        :param timeout: Seconds to wait for each response.
+        :param encoding: X-Encoding header of the SETUP, e.g.
+                         "subsampling=444; quality=80", None for the
+                         server's settings.
+        :param fec: Media packets per parity packet to ask for in the
+                    SETUP, 0 for none, None for the server's.
+        """
+        self.host = host
+        self.port = port
+        self.filename = filename
+        self.encoding = encoding
+        self.fec = fec
+        self.stats = stats or ViewerStats()
+        self.timeout = timeout
+        self.cseq = itertools.count(1)
+        self.session_id = None
+        self.state = "INIT"
+        self.responses = {}
+        self.parser = RTSPParser()
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.udp_transport = None
+        self.receiver = None
+        self.report_task = None
+
+        # Seconds of video, from the Range of the PLAY responses
+        self.duration = None
+
+    async def read_responses(self):
+
+        """ Read the control connection and resolve the requests waiting for their CSeq """
+
+        while True:
+            data = await self.reader.read(4096)
+            if not data:
+                break
+            for message in self.parser.feed(data):
+                if not isinstance(message, RTSPResponse):
+                    continue
+                waiter = self.responses.pop(message.cseq, None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(message)
+        for waiter in self.responses.values():
+            if not waiter.done():
+                waiter.set_exception(ConnectionError("RTSP connection closed"))
+
+    async def request(self, method, headers=None):
+        """
+        Send a request and wait for its response.
+
+        :param method: SETUP, PLAY, PAUSE or TEARDOWN.
+        :param headers: Extra headers.
+        :returns: The RTSPResponse. Raises IOError if it is not 200.
+        """
+        cseq = str(next(self.cseq))
+        lines = [f"{method} {self.filename} RTSP/1.0", f"CSeq: {cseq}"]
+        if self.session_id:
+            lines.append(f"Session: {self.session_id}")
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        waiter = self.responses[cseq] = asyncio.get_running_loop().create_future()
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+        response = await asyncio.wait_for(waiter, self.timeout)
+        if response.status != 200:
+            logger.error(f"{method} {self.filename} failed: {response.status} {response.reason}")
+            raise IOError(f"{method} {response.status} {response.reason}")
+        return response
+
+    async def setup(self):
+
+        """ Open the UDP endpoint and the control connection, then SETUP """
+
+        loop = asyncio.get_running_loop()
+        self.receiver = RTPReceiver(self.stats)
+        self.udp_transport, _ = await loop.create_datagram_endpoint(
+            lambda: self.receiver, local_addr=("0.0.0.0", 0))
+        udp_port = self.udp_transport.get_extra_info("sockname")[1]
+
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.read_task = loop.create_task(self.read_responses())
+
+        start = time.monotonic()
+        headers = {"Transport": f"RTP/UDP; client_port= {udp_port}"}
+        if self.fec is not None:
+            headers["Transport"] += f"; fec={self.fec}"
+        if self.encoding:
+            headers["X-Encoding"] = self.encoding
+        response = await self.request("SETUP", headers)
+        self.stats.setup_ms = round((time.monotonic() - start) * 1000, 3)
+        self.session_id = (response.header("Session") or "").split(";")[0] or None
+        self.state = "READY"
+
+        # Receiver reports go from the RTP port, the server matches them by SSRC
+        server_port = parse_transport(response.header("Transport", "")).get("server_port", "")
+        if "-" in server_port:
+            rtcp_address = (self.host, int(server_port.split("-")[1]))
+            self.report_task = loop.create_task(self.send_reports(rtcp_address))
+
+    async def send_reports(self, address):
+
+        """ Send an RTCP receiver report about the stream every RTCP_INTERVAL """
+
+        ssrc = id(self) & 0xFFFFFFFF
+        while True:
+            await asyncio.sleep(RTCP_INTERVAL)
+            block = self.receiver.reception.report_block(time.monotonic())
+            if block is not None:
+                self.udp_transport.sendto(build_receiver_report(ssrc, [block]), address)
+
+    async def play(self):
+
+        """ PLAY, the first one also measures the time to the first complete frame """
+
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+
+        # A pause is not jitter
+        self.stats.last_frame = None
+        if self.stats.first_frame_ms is None:
+            self.receiver.first_frame = loop.create_future()
+        response = await self.request("PLAY", {"Range": "npt=now-"})
+        self.read_range(response)
+        self.state = "PLAYING"
+        if self.receiver.first_frame is not None:
+            try:
+                first = await asyncio.wait_for(self.receiver.first_frame, self.timeout)
+                self.stats.first_frame_ms = round((first - start) * 1000, 3)
+            except asyncio.TimeoutError:
+                pass
+            self.receiver.first_frame = None
+
+    def read_range(self, response):
+
+        """ Take the duration of the video from the Range of a PLAY response """
+
+        try:
+            _, end = parse_range(response.header("Range", ""))
+        except ValueError:
+            return
+        if end is not None:
+            self.duration = end
+
+    async def seek(self, position):
+        """
+        PLAY from another position and measure the time to its first complete frame.
+
+        :param position: Seconds of video to continue from.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        response = await self.request("PLAY", {"Range": f"npt={position:.3f}-"})
+        self.stats.last_frame = None
+        for part in response.header("RTP-Info", "").split(";"):
+            name, _, value = part.strip().partition("=")
+            if name == "rtptime":
+                self.receiver.reassembler.resync(int(value))
+                self.receiver.seek_frame = loop.create_future()
+                try:
+                    arrival = await asyncio.wait_for(self.receiver.seek_frame, self.timeout)
+                    self.stats.seek_ms.append(round((arrival - start) * 1000, 3))
+                except asyncio.TimeoutError:
+                    pass
+                self.receiver.seek_frame = None
+
+    async def watch(self, duration, seeks=0):
+
+        """ Play for duration seconds, seeking to random positions at regular intervals """
+
+        if not self.duration:
+            seeks = 0
+        for _ in range(seeks):
+            await asyncio.sleep(duration / (seeks + 1))
+            await self.seek(random.uniform(0, self.duration * 0.95))
+        await asyncio.sleep(duration / (seeks + 1))
+
+    async def pause(self):
+        await self.request("PAUSE")
+        self.state = "READY"
+
+    async def teardown(self):
+        await self.request("TEARDOWN")
+        self.state = "INIT"
+
+    def close(self):
+        if self.report_task is not None:
+            self.report_task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+
+    async def run(self, duration, pause=0, seeks=0):
+        """
+        Watch the video for duration seconds and tear down.
+
+        :param duration: Seconds of playback.
+        :param pause: Seconds of pause in the middle of the playback, 0 for none.
+        :param seeks: Seeks to random positions during the playback.
+        """
+        try:
+            await self.setup()
+            await self.play()
+            if pause:
+                await self.watch(duration / 2, seeks // 2)
+                await self.pause()
+                await asyncio.sleep(pause)
+                await self.play()
+                await self.watch(duration / 2, seeks - seeks // 2)
+            else:
+                await self.watch(duration, seeks)
+            await self.teardown()
+        except Exception as e:
+            self.stats.error = str(e) or type(e).__name__
+            logger.debug(f"Viewer of {self.filename} failed: {self.stats.error}")
+        finally:
+            self.close()
+
+
+async def run_viewers(host, port, filename, viewers, duration, ramp_up=0, pause=0, seeks=0, encoding=None,
+                      fec=None):
+
+    """ Start the viewers, spread over ramp_up seconds, and wait for all of them """
+
+    clients = []
+    tasks = []
+    for n in range(viewers):
+        client = HeadlessClient(host, port, filename, encoding=encoding, fec=fec)
+        clients.append(client)
+        tasks.append(asyncio.get_running_loop().create_task(client.run(duration, pause, seeks)))
+        if ramp_up and n < viewers - 1:
+            await asyncio.sleep(ramp_up / viewers)
+    await asyncio.gather(*tasks)
+    return clients
+
+
+def run_bench(host, port, filename, viewers, duration, ramp_up=0, pause=0, seeks=0, encoding=None, fec=None):
+    """
+    Load test a server with headless viewers in this process.
+
+    :param host: RTSP server address.
+    :param port: RTSP server port.
+    :param filename: Video every viewer watches.
+    :param viewers: Number of simulated viewers.
+    :param duration: Seconds each viewer plays.
+    :param ramp_up: Seconds over which the viewers are started.
+    :param pause: Seconds of pause in the middle of each playback.
+    :param seeks: Seeks to random positions by each viewer.
+    :param encoding: X-Encoding header of the SETUPs, None for the server's settings.
+    :param fec: Media packets per parity packet asked for in the SETUPs, None for the server's.
+    :returns: Dict with the aggregate results, ready for json.dumps.
+    """
+    start = time.monotonic()
+    clients = asyncio.run(run_viewers(host, port, filename, viewers, duration, ramp_up, pause, seeks, encoding, fec))
+    elapsed = time.monotonic() - start
+
+    stats = [client.stats for client in clients]
+    frames = sum(s.frames for s in stats)
+    received = sum(s.bytes for s in stats)
+    return {
+        "viewers": viewers,
+        "filename": filename,
+        "duration_s": duration,
+        "ramp_up_s": ramp_up,
+        "elapsed_s": round(elapsed, 3),
+        "failed": sum(1 for s in stats if s.error),
+        "frames_per_s": round(frames / elapsed, 3),
+        "mbit_per_s": round(received * 8 / elapsed / 1e6, 3),
+        "loss_rate": percentiles([s.snapshot()["loss_rate"] for s in stats]),
+        "residual_loss_rate": percentiles([s.snapshot()["residual_loss_rate"] for s in stats]),
+        "fec_recovered": sum(s.recovered for s in stats),
+        "setup_latency_ms": percentiles([s.setup_ms for s in stats if s.setup_ms is not None]),
+        "first_frame_ms": percentiles([s.first_frame_ms for s in stats if s.first_frame_ms is not None]),
+        "jitter_ms": percentiles(list(itertools.chain.from_iterable(s.jitter_ms for s in stats))),
+        "seek_ms": percentiles(list(itertools.chain.from_iterable(s.seek_ms for s in stats))),
+        "sessions": [s.snapshot() for s in stats],
+    }
@@ -0,0 +1,289 @@
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from loguru import logger
+
+
+# Latency buckets of the stage histograms, in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def escape_label(value):
+
+    """ Label value escaped for the text exposition format: backslash, quote and newline """
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+
+    """ Prometheus label set, e.g. {stage="imencode"} """
+
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels.items()) + "}"
+
+
+class NullTimer(object):
+
+    """ Timer used while metrics are disabled, does nothing """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer(object):
+
+    """ Context manager observing its duration in a histogram """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Metric(object):
+
+    """ Base of the metric types: name, help, labels and the registry enabling them """
+
+    kind = None
+
+    def __init__(self, registry, name, help, labels=None):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.lock = threading.Lock()
+
+    def samples(self):
+        """ Return the (name, labels, value) samples of the metric """
+
+        raise NotImplementedError
+
+
+class Counter(Metric):
+
+    """ Value that only goes up """
+
+    kind = "counter"
+
+    def __init__(self, registry, name, help, labels=None):
+        super().__init__(registry, name, help, labels)
+        self.value = 0
+
+    def inc(self, amount=1):
+        if self.registry.enabled:
+            with self.lock:
+                self.value += amount
+
+    def samples(self):
+        return [(self.name, self.labels, self.value)]
+
+
+class Gauge(Metric):
+
+    """ Value that goes up and down, or is read from a function at scrape time """
+
+    kind = "gauge"
+
+    def __init__(self, registry, name, help, labels=None, function=None):
+        super().__init__(registry, name, help, labels)
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        if self.registry.enabled:
+            self.value = value
+
+    def inc(self, amount=1):
+        if self.registry.enabled:
+            with self.lock:
+                self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def samples(self):
+        return [(self.name, self.labels, self.function() if self.function else self.value)]
+
+
+class Histogram(Metric):
+
+    """ Distribution of observed values in cumulative buckets """
+
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, labels=None, buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        if self.registry.enabled:
+            index = bisect_left(self.buckets, value)
+            with self.lock:
+                self.counts[index] += 1
+                self.sum += value
+
+    def time(self):
+        """ Context manager observing the time spent in its block, a no-op while disabled """
+
+        return Timer(self) if self.registry.enabled else NULL_TIMER
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            labels = dict(self.labels, le="+Inf" if bound == float("inf") else repr(bound))
+            samples.append((self.name + "_bucket", labels, cumulative))
+        samples.append((self.name + "_sum", self.labels, total))
+        samples.append((self.name + "_count", self.labels, cumulative))
+        return samples
+
+
+class MetricsRegistry(object):
+    """
+    Metrics of the server process, exposed in Prometheus text format.
+
+    Metrics are created once at import time by the modules they measure.
+    Until enable() is called every update is a single attribute check and
+    timers are a shared no-op, so the hot paths pay (almost) nothing when
+    no --metrics-port is given. Collectors are functions returning extra
+    samples at scrape time, e.g. one per session.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.metrics = []
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=None):
+        return self.register(Counter(self, name, help, labels))
+
+    def gauge(self, name, help, labels=None, function=None):
+        return self.register(Gauge(self, name, help, labels, function))
+
+    def histogram(self, name, help, labels=None, buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(self, name, help, labels, buckets))
+
+    def add_collector(self, kind, name, help, collect):
+        """
+        Add samples computed at scrape time.
+
+        :param kind: counter or gauge.
+        :param name: Metric name.
+        :param help: Help text.
+        :param collect: Function returning a list of (labels, value).
+        """
+        with self.lock:
+            self.collectors.append((kind, name, help, collect))
+
+    def exposition(self):
+        """ Return every metric in Prometheus text format """
+
+        families = {}
+        with self.lock:
+            metrics = list(self.metrics)
+            collectors = list(self.collectors)
+        for metric in metrics:
+            family = families.setdefault(metric.name, (metric.kind, metric.help, []))
+            family[2].extend(metric.samples())
+        for kind, name, help, collect in collectors:
+            family = families.setdefault(name, (kind, help, []))
+            try:
+                family[2].extend((name, labels, value) for labels, value in collect())
+            except Exception as e:
+                logger.error(f"Metrics collector {name} failed: {e}")
+
+        lines = []
+        for name, (kind, help, samples) in families.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample, labels, value in samples:
+                lines.append(f"{sample}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+# Stage name -> histogram of the time spent in it
+STAGE_TIMERS = {}
+
+
+def stage_timer(stage):
+    """
+    Histogram of the time spent in a hot path stage, shared by the modules timing it.
+
+    :param stage: Stage name, e.g. imencode.
+    :returns: The Histogram, labelled with the stage.
+    """
+    histogram = STAGE_TIMERS.get(stage)
+    if histogram is None:
+        histogram = STAGE_TIMERS[stage] = METRICS.histogram(
+            "xarxes_stage_seconds", "Time spent in each stage of the server hot path", {"stage": stage})
+    return histogram
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    """ Serves the registry on GET /metrics """
+
+    registry = METRICS
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.trace(f"Metrics scrape from {self.client_address[0]}: {format % args}")
+
+
+def start_metrics_server(port, host="127.0.0.1", registry=METRICS):
+    """
+    Enable the metrics and serve them over HTTP from a daemon thread.
+
+    :param port: TCP port of the endpoint.
+    :param host: Address to listen on, local only by default.
+    :returns: The HTTP server, shutdown() stops it.
+    """
+    registry.enable()
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+    logger.info(f"Metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,306 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from loguru import logger
+
+
+# Network emulation of the RTP stream of each client, applied by the server
+# right before sending, like Linux netem on the way out:
+#
+#   loss        Bernoulli, or Gilbert-Elliott bursts with a mean length
+#   rate        token bucket link rate, packets wait for their tokens and
+#               are dropped beyond the queue limit
+#   corruption  a byte of the payload flipped
+#   duplication the packet sent twice
+#   delay       fixed plus uniform jitter, and an extra delay for the
+#               reordered packets so they arrive after later ones
+#
+# Every path (a session, or a viewer of a channel) draws from its own
+# random generator, seeded from the emulator seed and the order in which
+# the paths are created: the same seed and the same sessions give the same
+# losses, whatever the other sessions do. RTCP is not impaired.
+
+# Extra delay of a reordered packet (s), the next packets of the frame overtake it
+REORDER_DELAY = 0.01
+
+# Longest wait for link rate tokens (s), later packets are dropped
+QUEUE_LIMIT = 0.2
+
+
+class NetworkPath(object):
+    """
+    Impairment state of the packets going to one destination.
+
+    Created by NetworkEmulator.path(). Not thread safe, a path is used by
+    the thread sending its stream.
+    """
+
+    def __init__(self, emulator, seed):
+        self.emulator = emulator
+        self.random = random.Random(seed)
+
+        # Gilbert-Elliott state, True in the bad (losing) state
+        self.bad = False
+
+        # Token bucket as a theoretical arrival time (GCRA): when the queue
+        # of the link is empty again
+        self.link_free = 0.0
+
+        self.counters = dict.fromkeys(("packets", "lost", "queue_drops", "corrupted", "duplicated",
+                                       "delayed", "reordered"), 0)
+
+    def lose(self):
+
+        """ True if the next packet is lost """
+
+        emulator = self.emulator
+        if emulator.burst_enter:
+            # The state changes before each packet, every packet is lost in the bad state
+            if self.bad:
+                self.bad = self.random.random() >= emulator.burst_leave
+            else:
+                self.bad = self.random.random() < emulator.burst_enter
+            return self.bad
+        return self.random.random() < emulator.loss
+
+    def shape(self, size, now):
+
+        """ Seconds a packet of size bytes waits for the link, None if the queue is full """
+
+        emulator = self.emulator
+        departure = max(now, self.link_free - emulator.link_burst / emulator.link_rate)
+        if departure - now > QUEUE_LIMIT:
+            return None
+        self.link_free = max(self.link_free, now) + size / emulator.link_rate
+        return departure - now
+
+    def corrupt(self, packet):
+
+        """ Copy of a packet with a random byte of its payload flipped """
+
+        header, payload = packet
+        if not len(payload):
+            return packet
+        data = bytearray(payload)
+        data[self.random.randrange(len(data))] ^= 0xFF
+        return (header, bytes(data))
+
+    def impair(self, packets, address, now=None):
+        """
+        Apply the emulated network to the packets of a frame.
+
+        :param packets: List of (header, payload) packets for address.
+        :param address: Destination, for the delayed packets.
+        :param now: time.monotonic(), the send time.
+        :returns: (packets to send now, bytes that went through the network,
+                  delayed ones included). The delayed packets are sent by the
+                  emulator's delay line.
+        """
+        emulator = self.emulator
+        rand = self.random.random
+        counters = self.counters
+        now = time.monotonic() if now is None else now
+        immediate = []
+        passed = 0
+        for packet in packets:
+            counters["packets"] += 1
+            if emulator.loss and self.lose():
+                counters["lost"] += 1
+                continue
+            size = len(packet[0]) + len(packet[1])
+            delay = 0.0
+            if emulator.link_rate:
+                wait = self.shape(size, now)
+                if wait is None:
+                    counters["queue_drops"] += 1
+                    continue
+                delay += wait
+            if emulator.corrupt and rand() < emulator.corrupt:
+                packet = self.corrupt(packet)
+                counters["corrupted"] += 1
+            copies = 1
+            if emulator.duplicate and rand() < emulator.duplicate:
+                copies = 2
+                counters["duplicated"] += 1
+            if emulator.delay or emulator.jitter:
+                delay += max(emulator.delay + (2 * rand() - 1) * emulator.jitter, 0.0)
+            if emulator.reorder and rand() < emulator.reorder:
+                delay += REORDER_DELAY
+                counters["reordered"] += 1
+
+            passed += size * copies
+            if delay > 0:
+                counters["delayed"] += 1
+                for _ in range(copies):
+                    emulator.schedule(now + delay, packet, address)
+            else:
+                immediate.extend([packet] * copies)
+        return immediate, passed
+
+    def snapshot(self):
+
+        """ Return a dict with the counters of the path """
+
+        return dict(self.counters)
+
+
+class NetworkEmulator(object):
+    """
+    Emulated network between the server and its clients.
+
+    Holds the settings shared by all the paths and the delay line: a
+    thread sending the delayed packets when their time comes, through
+    the output function of the server engine.
+    """
+
+    def __init__(self, output, loss_rate=0, loss_burst=1.0, corrupt=0, duplicate=0, delay=0, jitter=0,
+                 reorder=0, link_rate=0, link_burst=64, seed=None):
+        """
+        Constructor for NetworkEmulator object.
+
+        :param output: Called as output(packets, address) from the delay
+                       line thread to send delayed packets, must be thread safe.
+        :param loss_rate: Packets lost (%).
+        :param loss_burst: Mean length of the loss bursts in packets, the
+                           losses follow a Gilbert-Elliott model above 1
+                           and are independent (Bernoulli) at 1.
+        :param corrupt: Packets with a byte of their payload flipped (%).
+        :param duplicate: Packets sent twice (%).
+        :param delay: Delay of every packet (ms).
+        :param jitter: Uniform variation of the delay, +- ms.
+        :param reorder: Packets delayed REORDER_DELAY more than the others (%).
+        :param link_rate: Rate of the link in Mbit/s, 0 for no limit.
+        :param link_burst: Bytes (KB) sent at once at the start of a burst of the link.
+        :param seed: Seed of the random generators, chosen and logged if None.
+        """
+        if loss_rate and loss_burst < 1:
+            logger.error(f"Loss bursts of {loss_burst} packets, must be at least 1")
+            raise ValueError(loss_burst)
+        self.output = output
+        self.loss = loss_rate / 100
+        self.corrupt = corrupt / 100
+        self.duplicate = duplicate / 100
+        self.delay = delay / 1000
+        self.jitter = jitter / 1000
+        self.reorder = reorder / 100
+        self.link_rate = link_rate * 1e6 / 8
+        self.link_burst = link_burst * 1024
+
+        # Gilbert-Elliott transitions for the mean loss and burst length:
+        # bursts end with probability 1/burst, and start often enough for the
+        # stationary share of the bad state to be the loss rate
+        self.burst_enter = 0.0
+        self.burst_leave = 1.0
+        if loss_burst > 1 and 0 < self.loss < 1:
+            self.burst_leave = 1 / loss_burst
+            self.burst_enter = self.burst_leave * self.loss / (1 - self.loss)
+
+        self.seed = random.randrange(2 ** 32) if seed is None else seed
+        self.paths = itertools.count()
+
+        # Delay line: heap of (due time, order, packet, address)
+        self.heap = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.running = True
+
+        # Counters of the closed paths, the open ones are added in stats()
+        self.open_paths = set()
+        self.closed = {}
+        logger.info(f"Network emulator {self.settings()}, seed {self.seed}")
+
+    def settings(self):
+
+        """ Return a dict with the impairments, in probabilities, seconds and bytes """
+
+        return {
+            "loss": self.loss, "burst_enter": round(self.burst_enter, 4), "burst_leave": round(self.burst_leave, 4),
+            "corrupt": self.corrupt, "duplicate": self.duplicate, "delay": self.delay, "jitter": self.jitter,
+            "reorder": self.reorder, "link_rate": self.link_rate, "link_burst": self.link_burst,
+        }
+
+    def path(self):
+
+        """ New path, with the next seed in order of creation """
+
+        path = NetworkPath(self, f"{self.seed}/{next(self.paths)}")
+        self.open_paths.add(path)
+        return path
+
+    def close_path(self, path):
+
+        """ Add up the counters of a path that is not used any more """
+
+        if path in self.open_paths:
+            self.open_paths.discard(path)
+            for name, value in path.counters.items():
+                self.closed[name] = self.closed.get(name, 0) + value
+
+    def schedule(self, due, packet, address):
+
+        """ Send a packet at due, time.monotonic() """
+
+        with self.condition:
+            heapq.heappush(self.heap, (due, next(self.order), packet, address))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True, name="netem")
+                self.thread.start()
+            if self.heap[0][0] == due:
+                self.condition.notify()
+
+    def run(self):
+
+        """ Delay line thread: send the packets whose time came, in order, grouped by address """
+
+        while True:
+            with self.condition:
+                while self.running and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                if not self.running:
+                    return
+                now = time.monotonic()
+                due = {}
+                while self.heap and self.heap[0][0] <= now:
+                    _, _, packet, address = heapq.heappop(self.heap)
+                    due.setdefault(address, []).append(packet)
+            for address, packets in due.items():
+                try:
+                    self.output(packets, address)
+                except Exception as e:
+                    logger.debug(f"Delayed packets to {address} not sent: {e}")
+
+    def close(self):
+
+        """ Stop the delay line, the packets still in it are lost """
+
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def stats(self):
+
+        """ Return a dict with the counters of all the paths and the packets in the delay line """
+
+        total = dict(self.closed)
+        for path in list(self.open_paths):
+            for name, value in path.counters.items():
+                total[name] = total.get(name, 0) + value
+        total["in_delay_line"] = len(self.heap)
+        return total
+
+
+def make_emulator(output, loss_rate=0, loss_burst=1.0, corrupt=0, duplicate=0, delay=0, jitter=0,
+                  reorder=0, link_rate=0, link_burst=64, seed=None):
+    """
+    NetworkEmulator for the server options, None when they impair nothing.
+
+    See NetworkEmulator for the parameters.
+    """
+    if not any((loss_rate, corrupt, duplicate, delay, jitter, reorder, link_rate)):
+        return None
+    return NetworkEmulator(output, loss_rate, loss_burst, corrupt, duplicate, delay, jitter,
+                           reorder, link_rate, link_burst, seed)
@@ -0,0 +1,236 @@
+import mmap
+import os
+import struct
+
+from loguru import logger
+from xarxes2025.frameindex import FrameIndex
+
+
+# Packed video container, written once by `xarxes2025 pack`:
+#
+#   header    magic, version, frame count, width, height, fps * 1000,
+#             JPEG quality, the offset of the index and the size and
+#             mtime (ns) of the video it was packed from
+#   frames    the JPEG frames, concatenated
+#   index     one fixed width entry per frame: offset, length and
+#             timestamp (microseconds)
+#
+# Serving it needs no decoding or encoding at all, frames are memoryview
+# slices of the memory-mapped file. A container packed from another version
+# of the video is ignored and the video is served live until it is packed
+# again.
+
+MAGIC = b"XPK1"
+VERSION = 2
+HEADER = struct.Struct("!4sHHIHHIB7xQQQ")
+INDEX_ENTRY = struct.Struct("!QIQ")
+EXTENSION = ".xpk"
+
+
+def packed_path(filename):
+
+    """ Name of the packed container of a video file """
+
+    return filename + EXTENSION
+
+
+def pack_video(filename, output=None, size=(500, 380), quality=95, jpeg=None):
+    """
+    Transcode a video file once into a packed container.
+
+    :param filename: Video file to read.
+    :param output: Container to write, next to the video by default.
+    :param size: (width, height) of the frames, None for the source size.
+    :param quality: JPEG quality (0-100).
+    :param jpeg: JPEGEncoder, OpenCV with the default settings if None.
+    :returns: Number of frames written.
+    """
+    import cv2
+    from xarxes2025.encoders import make_encoder
+
+    jpeg = jpeg or make_encoder()
+
+    output = output or packed_path(filename)
+    # Taken before reading, a video changed while packing looks stale
+    stat = os.stat(filename)
+    cap = cv2.VideoCapture(filename)
+    if not cap.isOpened():
+        logger.error(f"Cannot open {filename} file")
+        raise IOError
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25
+    width, height = size or (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
+    index = []
+    with open(output + ".tmp", "wb") as f:
+        f.write(bytes(HEADER.size))
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if size:
+                frame = cv2.resize(frame, size)
+            try:
+                encoded_frame = jpeg.encode(frame, quality)
+            except Exception as e:
+                logger.error(f"Cannot encode frame {len(index) + 1} with {jpeg}: {e}")
+                raise IOError
+            timestamp = int(len(index) * 1000000 / fps)
+            index.append((f.tell(), len(encoded_frame), timestamp))
+            f.write(encoded_frame)
+
+        index_offset = f.tell()
+        for entry in index:
+            f.write(INDEX_ENTRY.pack(*entry))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, 0, len(index), width, height, int(fps * 1000), quality, index_offset,
+                            stat.st_size, stat.st_mtime_ns))
+    cap.release()
+
+    # Sessions never see a half written container
+    os.replace(output + ".tmp", output)
+    logger.info(f"Packed {len(index)} frames of {filename} into {output}")
+    return len(index)
+
+
+class PackedVideo(object):
+    """
+    Video source serving a packed container through mmap.
+
+    Same interface as VideoProcessor, but next_frame returns memoryview
+    slices of the mapped file, so frames go to the send path without any
+    copy and without OpenCV.
+    """
+
+    # Frames were encoded when packing, their size and quality are fixed
+    adaptive = False
+
+    def __init__(self, filename):
+        """
+        Constructor for PackedVideo object.
+
+        :param filename: Packed container to open.
+        """
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+        (magic, version, _, self.frame_count, width, height, fps, self.quality,
+         self.index_offset, _, _) = HEADER.unpack_from(self.view)
+        if magic != MAGIC or version != VERSION:
+            logger.error(f"{filename} is not a packed video")
+            raise IOError
+        self.size = (width, height)
+        self.fps = fps / 1000
+        self.frame_num = 0
+
+        # Every frame is a JPEG, any of them can be served right away
+        timestamps = [self.entry(n)[2] for n in range(1, self.frame_count + 1)]
+        self.index = FrameIndex(timestamps, list(range(self.frame_count)), self.fps or 25)
+        self.ready = True
+        logger.debug(f"PackedVideo opened {self.filename}, {self.frame_count} frames")
+
+    def entry(self, index):
+        """
+        Return (offset, length, timestamp in us) of frame number index (1-based).
+        """
+        return INDEX_ENTRY.unpack_from(self.view, self.index_offset + (index - 1) * INDEX_ENTRY.size)
+
+    def next_frame(self):
+        """
+        Return the next frame as a memoryview of the container, or None at the end.
+        """
+        index = self.frame_num + 1
+        if index > self.frame_count:
+            return None
+        offset, length, _ = self.entry(index)
+        self.frame_num = index
+        return self.view[offset:offset + length]
+
+    def seek(self, frame):
+        """
+        Continue the video at a frame, next_frame returns it next.
+
+        :param frame: Frame number, from 0, see FrameIndex.frame_at.
+        """
+        self.frame_num = min(max(frame, 0), self.index.frame_count)
+
+    def skip(self, count):
+        """
+        Skip count frames, used when the sender is late.
+        """
+        self.frame_num += count
+
+    def get_size(self):
+        """
+        Return the (width, height) of the frames.
+        """
+        return self.size
+
+    def get_frame_number(self):
+
+        return self.frame_num
+
+
+def current_pack(filename):
+    """
+    Return the packed container to serve filename from, None if there is none.
+
+    A container requested by name is served as it is. The container next to
+    a video is only served if it was packed from the video as it is now, same
+    size and mtime; without the video there is nothing to compare it with.
+    """
+    if filename.endswith(EXTENSION):
+        return filename if os.path.isfile(filename) else None
+    packed = packed_path(filename)
+    try:
+        with open(packed, "rb") as f:
+            data = f.read(HEADER.size)
+    except OSError:
+        return None
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return packed
+    if len(data) < HEADER.size:
+        return None
+    magic, version, *_, size, mtime = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or (size, mtime) != (stat.st_size, stat.st_mtime_ns):
+        return None
+    return packed
+
+
+def is_packed(filename):
+
+    """ True if filename is served from a packed container, without decoding """
+
+    return filename.endswith(EXTENSION) or current_pack(filename) is not None
+
+
+def open_video(filename, size=(500, 380), quality=95, encoder=None, jpeg=None, delta=None):
+    """
+    Open the packed container of filename if there is one, else the video itself.
+
+    :param filename: Video file requested in SETUP.
+    :param size: Frame size for live encoding, packed frames keep theirs.
+    :param quality: JPEG quality for live encoding.
+    :param encoder: EncoderPool for live encoding, None to encode in process.
+    :param jpeg: JPEGEncoder for live encoding, the default one if None.
+    :param delta: DeltaEncoder for live encoding in process, the packed
+                  and pooled videos always send full frames.
+    :returns: PackedVideo, PooledVideo or VideoProcessor.
+    """
+    packed = current_pack(filename)
+    if packed is not None:
+        return PackedVideo(packed)
+    if os.path.isfile(packed_path(filename)):
+        logger.warning(f"{packed_path(filename)} was packed from another version of {filename}, "
+                       f"encoding it live until it is packed again")
+
+    if encoder is not None:
+        from xarxes2025.encodepool import PooledVideo
+        return PooledVideo(filename, encoder, size, quality, jpeg=jpeg)
+
+    # Only live encoding needs OpenCV
+    from xarxes2025.videoprocessor import VideoProcessor
+    return VideoProcessor(filename, size, quality, jpeg=jpeg, delta=delta)
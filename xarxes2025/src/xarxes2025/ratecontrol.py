@@ -0,0 +1,181 @@
+import math
+import threading
+
+from loguru import logger
+
+
+# Loss reported by the client above which the stream is degraded, and
+# below which it can improve again (as in loss based congestion control)
+LOSS_HIGH = 0.10
+LOSS_LOW = 0.02
+
+# Good reports in a row before stepping up, so the stream doesn't oscillate
+HOLD_REPORTS = 2
+
+# Quality steps of the ladder, then the resolution is lowered at the lowest quality
+QUALITY_STEP = 10
+SCALES = (1.0, 0.75, 0.5)
+
+# Seconds of sent bytes averaged to compare with the bitrate cap
+BITRATE_WINDOW = 1.0
+
+# Only step up when the measured bitrate leaves this headroom under the cap
+CAP_HEADROOM = 0.8
+
+# Rough bitrate saved by each step of the ladder, and the most steps taken
+# at once to get under the cap
+STEP_SAVING = 0.15
+MAX_CAP_STEPS = 3
+
+
+def scale_size(size, scale):
+    """
+    Scale a frame size, keeping whole 8 pixel blocks for the JPEG header.
+
+    :param size: (width, height).
+    :param scale: Factor, 1.0 keeps the size.
+    :returns: The scaled (width, height).
+    """
+    if scale == 1.0:
+        return size
+    width, height = size
+    return (max(8, int(width * scale) // 8 * 8), max(8, int(height * scale) // 8 * 8))
+
+
+def build_ladder(min_quality, max_quality):
+    """
+    Encoding levels from the best to the lowest bitrate.
+
+    :param min_quality: Lowest JPEG quality.
+    :param max_quality: Highest JPEG quality, the level streams start at.
+    :returns: List of (quality, scale).
+    """
+    qualities = list(range(max_quality, min_quality, -QUALITY_STEP)) + [min_quality]
+    ladder = [(quality, SCALES[0]) for quality in qualities]
+    ladder += [(min_quality, scale) for scale in SCALES[1:]]
+    return ladder
+
+
+class RateController(object):
+    """
+    Per session JPEG quality and resolution from the receiver reports.
+
+    The session encodes at one level of a ladder going from the highest
+    quality at full size down to the lowest quality at half size. Each
+    RTCP receiver report above LOSS_HIGH steps down (two steps past twice
+    that loss), and HOLD_REPORTS reports in a row below LOSS_LOW step up
+    again. Frames keep flowing at the same frame rate, they just get
+    smaller, instead of losing whole frames to congestion. The bitrate
+    measured over the last second is also kept under the session cap.
+    """
+
+    def __init__(self, size, min_quality=30, max_quality=95, max_bitrate=0):
+        """
+        Constructor for RateController object.
+
+        :param size: (width, height) of the full size frames.
+        :param min_quality: Lowest JPEG quality.
+        :param max_quality: Highest JPEG quality.
+        :param max_bitrate: Cap of the session in bits per second, 0 for none.
+        """
+        self.size = size
+        self.max_bitrate = max_bitrate
+        self.ladder = build_ladder(min_quality, min(max(max_quality, min_quality), 100))
+        self.level = 0
+        self.good_reports = 0
+        self.lock = threading.Lock()
+
+        # Bytes sent in the current window and the bitrate of the last one
+        self.window_start = None
+        self.window_bytes = 0
+        self.bitrate = 0
+
+        # Level changes, for the stats
+        self.steps_down = 0
+        self.steps_up = 0
+
+    def current(self):
+        """ Return the (quality, scale) of the current level """
+
+        return self.ladder[self.level]
+
+    def step(self, delta, reason):
+
+        """ Move delta levels, negative is better. Returns True if the level changed """
+
+        level = min(max(self.level + delta, 0), len(self.ladder) - 1)
+        if level == self.level:
+            return False
+        if level > self.level:
+            self.steps_down += 1
+        else:
+            self.steps_up += 1
+        self.level = level
+        self.good_reports = 0
+        quality, scale = self.ladder[level]
+        logger.debug(f"Rate control: {reason}, quality {quality} scale {scale}")
+        return True
+
+    def on_report(self, fraction_lost):
+        """
+        Account a receiver report.
+
+        :param fraction_lost: Fraction of packets lost in the report interval.
+        :returns: True if the level changed.
+        """
+        with self.lock:
+            if fraction_lost > LOSS_HIGH:
+                steps = 2 if fraction_lost > 2 * LOSS_HIGH else 1
+                return self.step(steps, f"{fraction_lost:.0%} loss")
+            if fraction_lost >= LOSS_LOW:
+                self.good_reports = 0
+                return False
+            self.good_reports += 1
+            if self.good_reports < HOLD_REPORTS:
+                return False
+            if self.max_bitrate and self.bitrate > self.max_bitrate * CAP_HEADROOM:
+                return False
+            return self.step(-1, "no loss")
+
+    def on_sent(self, size, now):
+        """
+        Account the bytes of a frame sent and check the bitrate cap.
+
+        :param size: Bytes sent.
+        :param now: time.monotonic().
+        :returns: True if the level changed.
+        """
+        with self.lock:
+            if self.window_start is None:
+                self.window_start = now
+            self.window_bytes += size
+            elapsed = now - self.window_start
+            if elapsed < BITRATE_WINDOW:
+                return False
+            self.bitrate = self.window_bytes * 8 / elapsed
+            self.window_start = now
+            self.window_bytes = 0
+            if self.max_bitrate and self.bitrate > self.max_bitrate:
+                steps = min(math.ceil((self.bitrate / self.max_bitrate - 1) / STEP_SAVING), MAX_CAP_STEPS)
+                return self.step(steps, f"{self.bitrate / 1000:.0f} kbit/s over the cap")
+            return False
+
+    def reset_window(self):
+        """ Forget the bytes of the current window, e.g. after a pause """
+
+        with self.lock:
+            self.window_start = None
+            self.window_bytes = 0
+
+    def snapshot(self):
+        """ Return a dict with the level and its changes """
+
+        quality, scale = self.current()
+        width, height = scale_size(self.size, scale)
+        return {
+            "quality": quality,
+            "size": f"{width}x{height}",
+            "bitrate_kbps": round(self.bitrate / 1000, 1),
+            "steps_down": self.steps_down,
+            "steps_up": self.steps_up,
+        }
@@ -0,0 +1,328 @@
+import struct
+import threading
+import time
+
+from loguru import logger
+
+
+# RTCP packet types (RFC 3550)
+SR = 200
+RR = 201
+
+# Seconds between the reports of a session. RFC 3550 recommends 5 s, the
+# streams of the practice are short so the reports are more frequent.
+RTCP_INTERVAL = 1.0
+
+# Seconds between 1900 (NTP epoch) and 1970 (Unix epoch)
+NTP_EPOCH_OFFSET = 2208988800
+
+RTCP_HEADER = struct.Struct("!BBHI")
+SENDER_INFO = struct.Struct("!QIII")
+REPORT_BLOCK = struct.Struct("!IIIIII")
+
+# Sequence numbers further than this from the highest seen are a restart
+MAX_DROPOUT = 3000
+MAX_MISORDER = 100
+
+
+def ntp_time(now=None):
+
+    """ 64 bit NTP timestamp (32.32 fixed point) of a time.time() value """
+
+    now = time.time() if now is None else now
+    return int((now + NTP_EPOCH_OFFSET) * (1 << 32)) & 0xFFFFFFFFFFFFFFFF
+
+
+def ntp_middle(ntp):
+
+    """ Middle 32 bits of an NTP timestamp, the unit of LSR and DLSR (1/65536 s) """
+
+    return (ntp >> 16) & 0xFFFFFFFF
+
+
+class ReportBlock(object):
+    """
+    Reception report about one source, in SRs and RRs.
+    """
+
+    def __init__(self, ssrc, fraction_lost, cumulative_lost, highest_seq, jitter, lsr=0, dlsr=0):
+        """
+        Constructor for ReportBlock object.
+
+        :param ssrc: Source the report is about.
+        :param fraction_lost: Lost since the previous report, fixed point /256.
+        :param cumulative_lost: Packets lost since the beginning.
+        :param highest_seq: Extended highest sequence number received.
+        :param jitter: Interarrival jitter, in timestamp units.
+        :param lsr: Middle 32 bits of the last SR received, 0 if none.
+        :param dlsr: Delay since that SR, in 1/65536 s.
+        """
+        self.ssrc = ssrc
+        self.fraction_lost = fraction_lost
+        self.cumulative_lost = cumulative_lost
+        self.highest_seq = highest_seq
+        self.jitter = jitter
+        self.lsr = lsr
+        self.dlsr = dlsr
+
+    def pack(self):
+        # Cumulative loss is a signed 24 bit number
+        lost = max(min(self.cumulative_lost, 0x7FFFFF), -0x800000) & 0xFFFFFF
+        return REPORT_BLOCK.pack(self.ssrc, (self.fraction_lost & 0xFF) << 24 | lost, self.highest_seq & 0xFFFFFFFF,
+                                 self.jitter & 0xFFFFFFFF, self.lsr, self.dlsr)
+
+    @classmethod
+    def unpack_from(cls, data, offset):
+        ssrc, lost, highest_seq, jitter, lsr, dlsr = REPORT_BLOCK.unpack_from(data, offset)
+        cumulative_lost = lost & 0xFFFFFF
+        if cumulative_lost & 0x800000:
+            cumulative_lost -= 0x1000000
+        return cls(ssrc, lost >> 24, cumulative_lost, highest_seq, jitter, lsr, dlsr)
+
+    def round_trip(self, arrival_ntp):
+        """
+        Round trip time seen by the sender of the SR this block answers.
+
+        :param arrival_ntp: NTP timestamp of the arrival of the report.
+        :returns: Seconds, or None if the receiver had no SR yet.
+        """
+        if not self.lsr:
+            return None
+        rtt = (ntp_middle(arrival_ntp) - self.lsr - self.dlsr) & 0xFFFFFFFF
+        return rtt / 65536 if rtt < 0x80000000 else 0.0
+
+
+def build_sender_report(ssrc, ntp, rtp_timestamp, packets, octets, blocks=()):
+    """
+    Build an RTCP Sender Report.
+
+    :param ssrc: SSRC of the RTP stream.
+    :param ntp: Wallclock time of the report, see ntp_time.
+    :param rtp_timestamp: RTP timestamp of the same instant.
+    :param packets: RTP packets sent since the stream started.
+    :param octets: Payload octets sent since the stream started.
+    :param blocks: ReportBlocks, if the sender also receives.
+    :returns: The packet bytes.
+    """
+    body = SENDER_INFO.pack(ntp, rtp_timestamp & 0xFFFFFFFF, packets & 0xFFFFFFFF, octets & 0xFFFFFFFF)
+    body += b"".join(block.pack() for block in blocks)
+    length = (RTCP_HEADER.size + len(body)) // 4 - 1
+    return RTCP_HEADER.pack(2 << 6 | len(blocks), SR, length, ssrc) + body
+
+
+def build_receiver_report(ssrc, blocks):
+    """
+    Build an RTCP Receiver Report.
+
+    :param ssrc: SSRC of the receiver.
+    :param blocks: ReportBlocks about the sources it receives.
+    :returns: The packet bytes.
+    """
+    body = b"".join(block.pack() for block in blocks)
+    length = (RTCP_HEADER.size + len(body)) // 4 - 1
+    return RTCP_HEADER.pack(2 << 6 | len(blocks), RR, length, ssrc) + body
+
+
+def parse_rtcp(data):
+    """
+    Parse a (compound) RTCP packet.
+
+    :param data: Datagram received on an RTCP port.
+    :returns: List of (type, ssrc, sender_info, blocks) for the SRs and
+              RRs, sender_info being (ntp, rtp_timestamp, packets, octets)
+              or None. Other packet types are skipped.
+    """
+    reports = []
+    offset = 0
+    while offset + RTCP_HEADER.size <= len(data):
+        first, packet_type, length, ssrc = RTCP_HEADER.unpack_from(data, offset)
+        end = offset + (length + 1) * 4
+        if first >> 6 != 2 or end > len(data):
+            break
+        count = first & 0x1F
+        position = offset + RTCP_HEADER.size
+        sender_info = None
+        if packet_type == SR:
+            sender_info = SENDER_INFO.unpack_from(data, position)
+            position += SENDER_INFO.size
+        if packet_type in (SR, RR):
+            blocks = []
+            for _ in range(count):
+                if position + REPORT_BLOCK.size > end:
+                    break
+                blocks.append(ReportBlock.unpack_from(data, position))
+                position += REPORT_BLOCK.size
+            reports.append((packet_type, ssrc, sender_info, blocks))
+        offset = end
+    return reports
+
+
+class ReceptionStats(object):
+    """
+    What a receiver knows about one RTP source, as in RFC 3550 A.1, A.3 and A.8.
+
+    16 bit sequence numbers are extended with a count of their wrap
+    arounds, so loss is still right after the 65536th packet. Expected
+    packets are counted from the first sequence number to the highest one,
+    loss is expected minus received (duplicates can make it negative).
+    Jitter is the smoothed deviation of the packet transit times, in
+    timestamp units.
+    """
+
+    def __init__(self, clock_rate=90000):
+        """
+        Constructor for ReceptionStats object.
+
+        :param clock_rate: RTP timestamp units per second.
+        """
+        self.clock_rate = clock_rate
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Forget the source, e.g. after a teardown """
+
+        with self.lock:
+            self.ssrc = None
+            self.base_seq = None
+            self.max_seq = 0
+            self.cycles = 0
+            self.received = 0
+            self.expected_prior = 0
+            self.received_prior = 0
+            self.transit = None
+            self.jitter = 0.0
+
+            # Last SR of the source, for LSR/DLSR
+            self.last_sr = 0
+            self.last_sr_arrival = None
+
+    def update(self, seqnum, timestamp, arrival, ssrc=None):
+        """
+        Account a received packet.
+
+        :param seqnum: Its 16 bit sequence number.
+        :param timestamp: Its RTP timestamp.
+        :param arrival: Arrival time in seconds, time.monotonic().
+        :param ssrc: Its SSRC, a new one restarts the statistics.
+        """
+        if ssrc is not None and self.ssrc is not None and ssrc != self.ssrc:
+            self.reset()
+        with self.lock:
+            self.ssrc = ssrc
+            if self.base_seq is None:
+                self.base_seq = seqnum
+                self.max_seq = seqnum
+            else:
+                delta = (seqnum - self.max_seq) & 0xFFFF
+                if delta < MAX_DROPOUT:
+                    if seqnum < self.max_seq:
+                        self.cycles += 1 << 16
+                    self.max_seq = seqnum
+                elif delta <= 0xFFFF - MAX_MISORDER:
+                    # Big jump, the sender restarted its sequence
+                    self.base_seq = seqnum
+                    self.max_seq = seqnum
+                    self.cycles = 0
+                    self.received = 0
+                    self.expected_prior = 0
+                    self.received_prior = 0
+            self.received += 1
+
+            # Interarrival jitter, all the fragments of a frame share a
+            # timestamp so they add the send time of the burst
+            transit = arrival * self.clock_rate - timestamp
+            if self.transit is not None:
+                self.jitter += (abs(transit - self.transit) - self.jitter) / 16
+            self.transit = transit
+
+    def on_sender_report(self, ntp, arrival):
+        """ Remember the last SR of the source, echoed in LSR/DLSR """
+
+        with self.lock:
+            self.last_sr = ntp_middle(ntp)
+            self.last_sr_arrival = arrival
+
+    @property
+    def extended_max(self):
+        return self.cycles + self.max_seq
+
+    @property
+    def expected(self):
+        if self.base_seq is None:
+            return 0
+        return self.extended_max - self.base_seq + 1
+
+    @property
+    def lost(self):
+        return self.expected - self.received
+
+    def jitter_ms(self):
+        return self.jitter * 1000 / self.clock_rate
+
+    def report_block(self, now):
+        """
+        Reception report block for an RR, starting a new report interval.
+
+        :param now: Current time, time.monotonic().
+        :returns: ReportBlock, or None before the first packet.
+        """
+        with self.lock:
+            if self.base_seq is None:
+                return None
+            expected = self.expected
+            expected_interval = expected - self.expected_prior
+            received_interval = self.received - self.received_prior
+            self.expected_prior = expected
+            self.received_prior = self.received
+            lost_interval = expected_interval - received_interval
+            fraction = (lost_interval << 8) // expected_interval if expected_interval > 0 and lost_interval > 0 else 0
+
+            dlsr = 0
+            if self.last_sr_arrival is not None:
+                dlsr = int((now - self.last_sr_arrival) * 65536) & 0xFFFFFFFF
+            return ReportBlock(self.ssrc or 0, fraction, expected - self.received, self.extended_max,
+                               int(self.jitter), self.last_sr, dlsr)
+
+
+class RTCPDispatcher(object):
+    """
+    Server side RTCP: hands the receiver reports to the sessions.
+
+    Sessions register the SSRC of their stream. Each report block about a
+    registered SSRC is given to its session with the round trip time and
+    the address it came from (a live channel shares its SSRC among its
+    viewers), the engines only feed the datagrams received on their RTCP port.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.reports = 0
+        self.errors = 0
+
+    def register(self, ssrc, session):
+        with self.lock:
+            self.sessions[ssrc] = session
+
+    def unregister(self, ssrc):
+        with self.lock:
+            self.sessions.pop(ssrc, None)
+
+    def handle(self, data, address):
+        """ Process an RTCP datagram received from address """
+
+        arrival = ntp_time()
+        try:
+            reports = parse_rtcp(data)
+        except struct.error:
+            self.errors += 1
+            logger.debug(f"Malformed RTCP packet from {address}")
+            return
+        for _, _, _, blocks in reports:
+            for block in blocks:
+                with self.lock:
+                    session = self.sessions.get(block.ssrc)
+                if session is not None:
+                    self.reports += 1
+                    session.on_receiver_report(block, block.round_trip(arrival), address)
@@ -0,0 +1,160 @@
+import struct
+
+from loguru import logger
+
+
+# Fragmentation of JPEG frames into RTP packets, loosely following RFC 2435.
+#
+# Every RTP payload starts with an 8 byte JPEG header:
+#
+#   0                   1                   2                   3
+#   0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1 2 3 4 5 6 7 8 9 0 1
+#  +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+#  | Type-specific |              Fragment Offset                  |
+#  +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+#  |      Type     |       Q       |     Width     |     Height    |
+#  +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
+#
+# Unlike RFC 2435 the fragments carry the complete JFIF stream (tables
+# included), so the receiver only has to concatenate them. All fragments
+# of a frame share the RTP timestamp and the last one has the marker bit.
+
+JPEG_HEADER = struct.Struct("!IBBBB")
+JPEG_HEADER_SIZE = JPEG_HEADER.size
+JPEG_TYPE = 1
+
+# IPv4 + UDP + RTP headers in front of the JPEG header
+PACKET_OVERHEAD = 20 + 8 + 12
+
+# 90 kHz media clock for video (RFC 3551)
+CLOCK_RATE = 90000
+
+# The fragment offset field is 24 bits, frames over 16 MB can't be sent
+OFFSET_MASK = 0xFFFFFF
+
+
+def max_fragment_size(mtu):
+
+    """ Bytes of JPEG data that fit in one packet without IP fragmentation """
+
+    return mtu - PACKET_OVERHEAD - JPEG_HEADER_SIZE
+
+
+def pack_jpeg_header(offset, width, height, quality, type_specific=0):
+
+    """ Build the 8 byte JPEG payload header of a fragment """
+
+    if offset > OFFSET_MASK:
+        logger.error(f"Fragment offset {offset} does not fit in 24 bits")
+        raise ValueError(offset)
+    # Width and height are in 8 pixel blocks, 0 when they don't fit
+    w = width // 8 if width and width < 2048 else 0
+    h = height // 8 if height and height < 2048 else 0
+    return JPEG_HEADER.pack((type_specific << 24) | offset, JPEG_TYPE, min(quality, 255), w, h)
+
+
+def unpack_jpeg_header(payload):
+
+    """ Return (type_specific, offset, type, q, width, height) of a fragment """
+
+    first, jpeg_type, q, w, h = JPEG_HEADER.unpack_from(payload)
+    return first >> 24, first & OFFSET_MASK, jpeg_type, q, w * 8, h * 8
+
+
+def timestamp_newer(a, b):
+
+    """ True if RTP timestamp a is after b, with 32 bit wrap around """
+
+    return a != b and ((a - b) & 0xFFFFFFFF) < 0x80000000
+
+
+class FrameReassembler(object):
+    """
+    Rebuild frames from their RTP fragments.
+
+    Fragments are grouped by RTP timestamp and placed by their fragment
+    offset, so they can arrive in any order. A frame is complete once the
+    fragment with the marker bit has arrived and there are no holes. Frames
+    still incomplete when a newer one completes, or older than the last
+    delivered frame, are dropped.
+    """
+
+    def __init__(self, max_pending=4):
+        """
+        Constructor for FrameReassembler object.
+
+        :param max_pending: Maximum number of frames being reassembled at
+                            the same time.
+        """
+        self.max_pending = max_pending
+        self.pending = {}
+        self.last_timestamp = None
+
+        # After a seek, only the frames from this timestamp are expected
+        self.resync_from = None
+
+        self.frames_completed = 0
+        self.frames_dropped = 0
+
+    def add(self, timestamp, payload, marker):
+        """
+        Add a fragment.
+
+        :param timestamp: RTP timestamp of the packet.
+        :param payload: RTP payload (JPEG header and data).
+        :param marker: RTP marker bit of the packet.
+        :returns: The complete frame bytes or None.
+        """
+        if self.resync_from is not None:
+            if (timestamp - self.resync_from) & 0xFFFFFFFF >= CLOCK_RATE:
+                # Frame of the position before the seek, still in flight
+                return None
+        elif self.last_timestamp is not None and not timestamp_newer(timestamp, self.last_timestamp):
+            # Fragment of a frame already delivered or given up
+            return None
+
+        _, offset, _, _, _, _ = unpack_jpeg_header(payload)
+        data = payload[JPEG_HEADER_SIZE:]
+
+        frame = self.pending.get(timestamp)
+        if frame is None:
+            frame = self.pending[timestamp] = {"chunks": {}, "size": None, "received": 0}
+            self._limit_pending()
+        if offset not in frame["chunks"]:
+            frame["chunks"][offset] = data
+            frame["received"] += len(data)
+        if marker:
+            frame["size"] = offset + len(data)
+
+        if frame["size"] is None or frame["received"] < frame["size"]:
+            return None
+
+        # Complete: drop the older frames that are still missing fragments
+        del self.pending[timestamp]
+        for ts in [ts for ts in self.pending if timestamp_newer(timestamp, ts)]:
+            del self.pending[ts]
+            self.frames_dropped += 1
+        self.last_timestamp = timestamp
+        self.resync_from = None
+        self.frames_completed += 1
+        return b"".join(frame["chunks"][offset] for offset in sorted(frame["chunks"]))
+
+    def resync(self, timestamp):
+        """
+        Expect the frames of a new position after a seek.
+
+        Timestamps jump, backwards too, so the frames of the second after
+        timestamp (the rtptime of the PLAY response) are accepted until one
+        completes, and the ones from before the seek are ignored.
+
+        :param timestamp: RTP timestamp of the first frame after the seek.
+        """
+        self.pending.clear()
+        self.resync_from = timestamp
+
+    def _limit_pending(self):
+        while len(self.pending) > self.max_pending:
+            oldest = min(self.pending, key=lambda ts: (ts - (self.last_timestamp or 0)) & 0xFFFFFFFF)
+            del self.pending[oldest]
+            self.frames_dropped += 1
+            logger.debug(f"Dropped incomplete frame {oldest}")
@@ -0,0 +1,278 @@
+from loguru import logger
+
+
+# Longest request head (request line and headers) accepted
+MAX_HEAD_SIZE = 64 * 1024
+
+# Longest request body (Content-Length) accepted, RTSP bodies are small
+# parameter lists and SDP descriptions
+MAX_BODY_SIZE = 64 * 1024
+
+HEAD_END = b"\r\n\r\n"
+
+
+class BadRequest(IOError):
+    """
+    Raised by RTSPParser.feed for a request it can't frame.
+
+    The server answers it with status and closes the connection, the
+    bytes that follow can't be framed either.
+    """
+
+    def __init__(self, status, cseq="0", reason="malformed"):
+        super().__init__(f"RTSP request {reason}, {status}")
+        self.status = status
+        self.cseq = cseq
+
+
+class RequestTooLarge(BadRequest):
+    """
+    Raised by RTSPParser.feed for a request over its limits: 400 for the
+    head, 413 for the body.
+    """
+
+    def __init__(self, status, cseq="0"):
+        super().__init__(status, cseq, "too large")
+
+
+class RTSPRequest(object):
+    """
+    RTSP request as framed by RTSPParser.
+
+    Header names are case insensitive, they are stored lowercased.
+    """
+
+    def __init__(self, method, uri, version, headers, body=b""):
+        """
+        Constructor for RTSPRequest object.
+
+        :param method: Request method (SETUP, PLAY...), None if the request
+                       line is malformed.
+        :param uri: Request URI, the video file.
+        :param version: Protocol version, RTSP/1.0.
+        :param headers: Dict of lowercased header names to values.
+        :param body: Content-Length bytes following the headers.
+        """
+        self.method = method
+        self.uri = uri
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    def header(self, name, default=None):
+        """ Value of a header, default if missing """
+
+        return self.headers.get(name.lower(), default)
+
+    @property
+    def cseq(self):
+        return self.headers.get("cseq", "0")
+
+    def __repr__(self):
+        return f"RTSPRequest({self.method} {self.uri} CSeq {self.cseq})"
+
+
+class RTSPResponse(object):
+    """
+    RTSP response as framed by RTSPParser, on the client side.
+    """
+
+    def __init__(self, version, status, reason, headers, body=b""):
+        """
+        Constructor for RTSPResponse object.
+
+        :param version: Protocol version, RTSP/1.0.
+        :param status: Status code, an int.
+        :param reason: Reason phrase, e.g. "OK".
+        :param headers: Dict of lowercased header names to values.
+        :param body: Content-Length bytes following the headers.
+        """
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def header(self, name, default=None):
+        """ Value of a header, default if missing """
+
+        return self.headers.get(name.lower(), default)
+
+    @property
+    def cseq(self):
+        return self.headers.get("cseq", "0")
+
+    def __repr__(self):
+        return f"RTSPResponse({self.status} {self.reason} CSeq {self.cseq})"
+
+
+def parse_transport(value):
+    """
+    Split a Transport header in its parameters.
+
+    :param value: Header value, e.g. "RTP/UDP; client_port= 25000; multicast".
+    :returns: Dict of parameter names to values, "" for flags.
+    """
+    params = {}
+    for part in value.split(";"):
+        name, _, param = part.partition("=")
+        if name.strip():
+            params[name.strip()] = param.strip()
+    return params
+
+
+def parse_npt_time(value):
+
+    """ Seconds of an npt time: 12.5, 75 or 0:01:15.5 """
+
+    seconds = 0.0
+    for part in value.split(":"):
+        seconds = seconds * 60 + float(part)
+    if seconds < 0:
+        raise ValueError(value)
+    return seconds
+
+
+def parse_range(value):
+    """
+    Parse a Range header in npt format.
+
+    :param value: Header value, e.g. "npt=12.5-", "npt=0:01:00-0:02:00" or "npt=now-".
+    :returns: (start, end) in seconds, start None for now and end None
+              for the end of the video. Raises ValueError if malformed.
+    """
+    unit, _, times = value.strip().partition("=")
+    if unit.strip() != "npt":
+        raise ValueError(value)
+    start, sep, end = times.strip().partition("-")
+    if not sep:
+        raise ValueError(value)
+    start = None if start.strip() in ("", "now") else parse_npt_time(start.strip())
+    end = parse_npt_time(end.strip()) if end.strip() else None
+    if start is not None and end is not None and end <= start:
+        raise ValueError(value)
+    return start, end
+
+
+class RTSPParser(object):
+    """
+    Incremental RTSP framing of the bytes received on a control connection.
+
+    Bytes are fed as they come from the socket, however they were
+    segmented. A request is complete at the empty line after its headers,
+    plus Content-Length bytes of body if any. feed() returns the complete
+    requests in order, so pipelined requests received in one read are all
+    handled, and a request split across reads waits for its end. Headers
+    are parsed once, into a dict. Responses are framed the same way, they
+    are returned as RTSPResponse.
+    """
+
+    def __init__(self, max_head_size=MAX_HEAD_SIZE, max_body_size=MAX_BODY_SIZE):
+        """
+        Constructor for RTSPParser object.
+
+        :param max_head_size: Longest request head accepted, RequestTooLarge beyond.
+        :param max_body_size: Longest Content-Length accepted, RequestTooLarge beyond.
+                              A Content-Length that is not a length raises BadRequest.
+        """
+        self.buffer = bytearray()
+        self.max_head_size = max_head_size
+        self.max_body_size = max_body_size
+
+        # Request whose headers are parsed, waiting for its body
+        self.pending = None
+        self.body_length = 0
+
+        # Where to resume looking for the end of the head
+        self.scanned = 0
+
+    def feed(self, data):
+        """
+        Add received bytes.
+
+        :param data: Bytes read from the connection.
+        :returns: List of the RTSPRequests (or RTSPResponses) completed,
+                  possibly empty.
+        """
+        self.buffer += data
+        buffer = self.buffer
+        requests = []
+        pos = 0
+        while True:
+            if self.pending is not None:
+                if len(buffer) - pos < self.body_length:
+                    break
+                self.pending.body = bytes(buffer[pos:pos + self.body_length])
+                pos += self.body_length
+                requests.append(self.pending)
+                self.pending = None
+                continue
+
+            # Blank lines between requests are ignored
+            while buffer.startswith(b"\r\n", pos):
+                pos += 2
+                self.scanned = 0
+
+            # Without its end yet, the head may be followed by the first bytes of HEAD_END
+            end = buffer.find(HEAD_END, max(pos, self.scanned - 3))
+            head_size = end - pos if end >= 0 else len(buffer) - pos - (len(HEAD_END) - 1)
+            if head_size > self.max_head_size:
+                logger.error(f"RTSP request head longer than {self.max_head_size} bytes")
+                raise RequestTooLarge(400)
+            if end < 0:
+                self.scanned = len(buffer)
+                break
+
+            request = self.parse_head(buffer[pos:end].decode("utf-8", "replace"))
+            pos = end + len(HEAD_END)
+            self.scanned = 0
+
+            # Without a valid length the end of the body, and so the next request, is unknown
+            try:
+                length = int(request.header("Content-Length", 0))
+            except ValueError:
+                length = -1
+            if length < 0:
+                logger.error(f"RTSP request with Content-Length {request.header('Content-Length')!r}")
+                raise BadRequest(400, request.cseq)
+            if length > self.max_body_size:
+                logger.error(f"RTSP request body of {length} bytes, longer than {self.max_body_size}")
+                raise RequestTooLarge(413, request.cseq)
+            if length > 0:
+                self.pending = request
+                self.body_length = length
+            else:
+                requests.append(request)
+
+        # Consumed bytes are dropped once per read
+        if pos:
+            del buffer[:pos]
+            self.scanned = max(self.scanned - pos, 0)
+        return requests
+
+    def parse_head(self, head):
+
+        """ Parse the start line and headers of a request or a response """
+
+        lines = head.split("\r\n")
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+
+        # Status line: RTSP/1.0 200 OK
+        if lines[0].startswith("RTSP/"):
+            version, _, status = lines[0].partition(" ")
+            code, _, reason = status.strip().partition(" ")
+            try:
+                return RTSPResponse(version, int(code), reason, headers)
+            except ValueError:
+                return RTSPResponse(version, 0, status, headers)
+
+        parts = lines[0].split()
+        if len(parts) == 3:
+            method, uri, version = parts
+        else:
+            method, uri, version = None, None, None
+        return RTSPRequest(method, uri, version, headers)
@@ -0,0 +1,317 @@
+import collections
+import itertools
+import queue
+import selectors
+import socket
+import threading
+import time
+
+from loguru import logger
+from xarxes2025.rtsp import RTSPParser, RTSPResponse
+
+
+# Seconds to wait for a response before sending the request again
+DEFAULT_TIMEOUT = 5.0
+
+# Times a request is sent again after a timeout before it fails
+DEFAULT_RETRIES = 1
+
+# SETUP is not sent again: the server answers a second SETUP of the
+# session with 400 if the first one arrived
+RETRY_METHODS = ("PLAY", "PAUSE", "TEARDOWN")
+
+# Seconds to open the connection
+CONNECT_TIMEOUT = 5.0
+
+
+class ControlRequest(object):
+
+    """ Request waiting to be sent or for its response """
+
+    def __init__(self, method, uri, headers, callback, timeout, retries):
+        self.method = method
+        self.uri = uri
+        self.headers = headers
+        self.callback = callback
+        self.timeout = timeout
+        self.retries = retries if method in RETRY_METHODS else 0
+        self.cseq = None
+        self.deadline = None
+        self.sent_at = None
+
+    def encode(self, cseq):
+
+        """ Bytes of the request with a new CSeq """
+
+        self.cseq = str(cseq)
+        lines = [f"{self.method} {self.uri} RTSP/1.0", f"CSeq: {self.cseq}"]
+        lines += [f"{name}: {value}" for name, value in self.headers.items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+
+class RTSPControl(object):
+    """
+    RTSP control connection of the client, served by its own thread.
+
+    Requests are queued from the Tk thread and the control thread sends
+    them and reads the responses with a selector, so a slow server never
+    blocks the UI nor the rendering of the frames. Several requests can
+    wait for their response at once, they are matched by CSeq. A request
+    without a response after its timeout is sent again with a new CSeq, up
+    to its retries, and then fails; a late response to an old CSeq is
+    ignored.
+
+    The callbacks don't run on the control thread: dispatch(), called
+    from the Tk playout loop, runs the ones whose request completed, so
+    they can update the UI.
+    """
+
+    def __init__(self, host, port, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, on_closed=None):
+        """
+        Constructor for RTSPControl object, connects from the control thread.
+
+        :param host: RTSP server address.
+        :param port: RTSP server port.
+        :param timeout: Default seconds to wait for a response.
+        :param retries: Default times a request is sent again after a timeout.
+        :param on_closed: Called by dispatch() with the reason when the
+                          connection can't be opened or is lost.
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.on_closed = on_closed
+
+        self.cseq = itertools.count(1)
+        self.sock = None
+        self.connected = False
+        self.running = True
+
+        # Requests queued by request(), waiting for their response by CSeq,
+        # and bytes not sent yet
+        self.outgoing = collections.deque()
+        self.waiting = {}
+        self.send_buffer = bytearray()
+
+        # Callbacks of the completed requests, for dispatch()
+        self.completed = queue.SimpleQueue()
+
+        # Counters
+        self.timeouts = 0
+        self.retried = 0
+        self.late = 0
+
+        # request() and close() wake the selector through this pair
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.wake_reader, selectors.EVENT_READ)
+
+        self.thread = threading.Thread(target=self.run, daemon=True, name="rtsp-control")
+        self.thread.start()
+
+    def request(self, method, uri, headers, callback, timeout=None, retries=None):
+        """
+        Queue a request, from any thread.
+
+        :param method: SETUP, PLAY, PAUSE, TEARDOWN or GET_PARAMETER.
+        :param uri: Request URI, the video file.
+        :param headers: Dict of the headers besides CSeq.
+        :param callback: Called by dispatch() with (response, error): the
+                         RTSPResponse and None, or None and the reason it
+                         failed.
+        :param timeout: Seconds to wait for the response, the default if None.
+        :param retries: Times to send it again after a timeout, the default if None.
+        """
+        if not self.thread.is_alive():
+            self.complete(callback, None, "connection closed")
+            return
+        self.outgoing.append(ControlRequest(method, uri, headers, callback,
+                                            self.timeout if timeout is None else timeout,
+                                            self.retries if retries is None else retries))
+        self.wake()
+
+    def in_flight(self):
+
+        """ Number of requests not completed yet """
+
+        return len(self.outgoing) + len(self.waiting)
+
+    def dispatch(self):
+
+        """ Run the callbacks of the completed requests, on the calling thread """
+
+        while True:
+            try:
+                callback, args = self.completed.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.error(f"RTSP callback failed: {e}")
+
+    def close(self, wait=0):
+        """
+        Close the connection.
+
+        :param wait: Seconds to let the requests in flight complete first,
+                     their callbacks are not run.
+        """
+        deadline = time.monotonic() + wait
+        while self.in_flight() and self.connected and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.running = False
+        self.wake()
+        self.thread.join(1)
+
+    def wake(self):
+        try:
+            self.wake_writer.send(b"\0")
+        except OSError:
+            pass
+
+    def complete(self, callback, *args):
+        self.completed.put((callback, args))
+
+    def connect(self):
+
+        """ Open the connection, from the control thread """
+
+        try:
+            self.sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+        except OSError as e:
+            logger.error(f"Cannot connect to {self.host}:{self.port}: {e}")
+            if self.on_closed is not None:
+                self.complete(self.on_closed, f"cannot connect: {e}")
+            return False
+        self.sock.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.connected = True
+        logger.info(f"Connected to {self.host}:{self.port}")
+        return True
+
+    def run(self):
+
+        """ Control thread: send the queued requests, read the responses and expire the late ones """
+
+        self.parser = RTSPParser()
+        if self.connect():
+            try:
+                while self.running and self.connected:
+                    for key, events in self.selector.select(self.next_timeout()):
+                        if key.fileobj is self.wake_reader:
+                            self.drain_wake()
+                        elif events & selectors.EVENT_READ:
+                            self.read()
+                        if self.connected and events & selectors.EVENT_WRITE:
+                            self.flush()
+                    self.send_queued()
+                    self.expire(time.monotonic())
+            except OSError as e:
+                self.lost(str(e))
+        self.fail_all("connection closed")
+        if self.sock is not None:
+            self.selector.unregister(self.sock)
+            self.sock.close()
+        self.selector.close()
+        self.wake_reader.close()
+        self.wake_writer.close()
+
+    def next_timeout(self):
+
+        """ Seconds until the first response deadline, None without requests waiting """
+
+        if not self.waiting:
+            return None
+        return max(min(request.deadline for request in self.waiting.values()) - time.monotonic(), 0)
+
+    def drain_wake(self):
+        try:
+            while self.wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def send_queued(self):
+
+        """ Give the queued requests a CSeq and write them """
+
+        while self.outgoing:
+            self.send(self.outgoing.popleft())
+
+    def send(self, request):
+        self.send_buffer += request.encode(next(self.cseq))
+        request.sent_at = time.monotonic()
+        request.deadline = request.sent_at + request.timeout
+        self.waiting[request.cseq] = request
+        logger.debug(f"Sent {request.method} CSeq {request.cseq}, {len(self.waiting)} in flight")
+        self.flush()
+
+    def flush(self):
+
+        """ Write what the socket takes, waiting for it to be writable for the rest """
+
+        try:
+            sent = self.sock.send(self.send_buffer)
+            del self.send_buffer[:sent]
+        except BlockingIOError:
+            pass
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self.send_buffer else 0)
+        self.selector.modify(self.sock, events)
+
+    def read(self):
+
+        """ Read the responses and complete their requests """
+
+        data = self.sock.recv(4096)
+        if not data:
+            self.lost("closed by the server")
+            return
+        for message in self.parser.feed(data):
+            if not isinstance(message, RTSPResponse):
+                continue
+            request = self.waiting.pop(message.cseq, None)
+            if request is None:
+                self.late += 1
+                logger.debug(f"Response to unknown CSeq {message.cseq} ignored")
+                continue
+            logger.debug(f"{request.method} CSeq {request.cseq}: {message.status} {message.reason} "
+                         f"in {(time.monotonic() - request.sent_at) * 1000:.1f} ms")
+            self.complete(request.callback, message, None)
+
+    def expire(self, now):
+
+        """ Send again or fail the requests past their deadline """
+
+        for cseq, request in list(self.waiting.items()):
+            if request.deadline > now:
+                continue
+            del self.waiting[cseq]
+            self.timeouts += 1
+            if request.retries > 0:
+                request.retries -= 1
+                self.retried += 1
+                logger.warning(f"{request.method} CSeq {cseq} timed out, sending it again")
+                self.send(request)
+            else:
+                logger.error(f"{request.method} CSeq {cseq} timed out after {request.timeout} s")
+                self.complete(request.callback, None, "timeout")
+
+    def lost(self, reason):
+        if self.connected:
+            logger.error(f"RTSP connection lost: {reason}")
+            self.connected = False
+            if self.on_closed is not None:
+                self.complete(self.on_closed, reason)
+
+    def fail_all(self, reason):
+
+        """ Fail the requests queued or waiting """
+
+        requests = list(self.waiting.values()) + list(self.outgoing)
+        self.waiting.clear()
+        self.outgoing.clear()
+        for request in requests:
+            self.complete(request.callback, None, reason)
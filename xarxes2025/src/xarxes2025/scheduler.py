@@ -0,0 +1,250 @@
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+
+from loguru import logger
+from xarxes2025.metrics import METRICS, stage_timer
+
+
+SLEEP_TIME = stage_timer("pacing_sleep")
+LATENESS = METRICS.histogram("xarxes_pacing_lateness_seconds", "How late frames are sent after their presentation time")
+
+# Returned by FramePrefetch.take while the frame is still being produced
+NOT_READY = object()
+
+# Seconds before looking again at a frame that was not ready at its
+# deadline, if its producer did not wake the scheduler before
+PRODUCE_RETRY = 0.1
+
+
+class PacingStats(object):
+    """
+    Pacing lateness of the frames sent by one session.
+
+    Lateness is how long after its presentation time a frame was sent.
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.skipped = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def record(self, lateness):
+        """ Account one send that happened lateness seconds after its deadline """
+
+        lateness = max(lateness, 0.0)
+        LATENESS.observe(lateness)
+        self.frames += 1
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+
+    def snapshot(self):
+        """ Return a dict with the pacing counters, lateness in ms """
+
+        mean = self.total_lateness / self.frames if self.frames else 0.0
+        return {
+            "frames": self.frames,
+            "skipped": self.skipped,
+            "mean_lateness_ms": round(mean * 1000, 3),
+            "max_lateness_ms": round(self.max_lateness * 1000, 3),
+        }
+
+
+class FramePrefetch(object):
+    """
+    Next frame of a stream, produced ahead of its deadline by a thread pool.
+
+    The pacing thread only takes the frames and sends them: reading,
+    decoding and encoding run in the pool, the next frame starting as soon
+    as the previous one is taken, so the streams are produced in parallel
+    (and the encoder pool gets one request per stream at once) and a slow
+    frame delays its own stream only. There is never more than one frame
+    in production per stream, the video is not used by two threads at once.
+    """
+
+    def __init__(self, executor, produce, wake):
+        """
+        Constructor for FramePrefetch object.
+
+        :param executor: concurrent.futures executor producing the frames.
+        :param produce: Function returning the next frame of the stream.
+        :param wake: Called from the producer thread when a frame that was
+                     not ready at take() is, e.g. PacingScheduler.wake;
+                     None when the caller awaits the future itself.
+        """
+        self.executor = executor
+        self.produce = produce
+        self.wake = wake
+        self.future = None
+        self.waited = False
+
+    def start(self):
+        """ Start producing the next frame, unless it already is """
+
+        if self.future is None:
+            self.future = self.executor.submit(self.produce)
+            self.waited = False
+
+    def take(self):
+        """
+        Return the frame produced, starting it if it was not. The next one
+        starts with start(), once the caller is done with the video (it may
+        skip frames first).
+
+        :returns: The frame, or NOT_READY while it is being produced.
+                  Raises what produce raised.
+        """
+        self.start()
+        if not self.future.done():
+            if not self.waited:
+                self.waited = True
+                self.future.add_done_callback(lambda future: self.wake())
+            return NOT_READY
+        future, self.future = self.future, None
+        return future.result()
+
+    def discard(self):
+        """ Drop the frame produced, if done, to produce it again (after a seek) """
+
+        if self.future is not None and self.future.done():
+            self.future = None
+
+    def reset(self):
+        """ Drop the frame in production, waiting for it if it already started """
+
+        future, self.future = self.future, None
+        if future is not None and not future.cancel():
+            concurrent.futures.wait([future])
+
+
+class PacingScheduler(threading.Thread):
+    """
+    Single thread sending the frames of every session on time.
+
+    Sessions are kept in a heap ordered by the absolute deadline (monotonic
+    clock) of their next frame. When a deadline is due the scheduler calls
+    session.on_deadline(deadline, now), which sends the frame and returns
+    the deadline of the next one, or None to leave the schedule; frames are
+    produced beforehand by a FramePrefetch, not on this thread. Paused
+    sessions are simply not in the heap, so they cost nothing. All the
+    sessions due at the same time run in one tick.
+    """
+
+    def __init__(self, on_tick=None):
+        """
+        Constructor for PacingScheduler object.
+
+        :param on_tick: Called after each batch of due sessions has run,
+                        e.g. to flush the datagrams they queued.
+        """
+        super().__init__(daemon=True, name="pacing-scheduler")
+        self.heap = []
+        self.tokens = {}
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.on_tick = on_tick
+        self.running = True
+
+    def add(self, session, deadline=None):
+        """
+        Schedule a session, replacing its previous deadline if any.
+
+        :param session: Object with an on_deadline(deadline, now) method.
+        :param deadline: Monotonic time of its next frame, now by default.
+        """
+        if deadline is None:
+            deadline = time.monotonic()
+        with self.cond:
+            token = next(self.counter)
+            self.tokens[session] = token
+            heapq.heappush(self.heap, (deadline, token, session))
+            self.cond.notify()
+
+    def remove(self, session):
+        """ Unschedule a session, its heap entry is discarded lazily """
+
+        with self.cond:
+            self.tokens.pop(session, None)
+
+    def wake(self, session):
+        """ Make a scheduled session due now, e.g. when the frame it waits for is ready """
+
+        with self.cond:
+            if session in self.tokens:
+                token = next(self.counter)
+                self.tokens[session] = token
+                heapq.heappush(self.heap, (time.monotonic(), token, session))
+                self.cond.notify()
+
+    def is_scheduled(self, session):
+        with self.cond:
+            return session in self.tokens
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def run(self):
+
+        """ Wait for the earliest deadline and run the sessions that are due """
+
+        while True:
+            batch = self.wait_due()
+            if batch is None:
+                return
+            now, due = batch
+
+            results = []
+            for deadline, token, session in due:
+                try:
+                    next_deadline = session.on_deadline(deadline, now)
+                except Exception as e:
+                    logger.error(f"Error in UDP streaming: {e}")
+                    next_deadline = None
+                results.append((next_deadline, token, session))
+
+            if self.on_tick:
+                self.on_tick()
+
+            with self.cond:
+                for next_deadline, token, session in results:
+                    if self.tokens.get(session) != token:
+                        continue
+                    if next_deadline is None:
+                        del self.tokens[session]
+                    else:
+                        heapq.heappush(self.heap, (next_deadline, token, session))
+
+    def wait_due(self):
+
+        """ Block until some deadline is due and return (now, due entries), None when stopped """
+
+        with self.cond:
+            while True:
+                if not self.running:
+                    return None
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                deadline, token, session = self.heap[0]
+                if self.tokens.get(session) != token:
+                    # Removed or rescheduled meanwhile
+                    heapq.heappop(self.heap)
+                    continue
+                now = time.monotonic()
+                if deadline > now:
+                    with SLEEP_TIME.time():
+                        self.cond.wait(deadline - now)
+                    continue
+                break
+
+            due = []
+            while self.heap and self.heap[0][0] <= now:
+                entry = heapq.heappop(self.heap)
+                if self.tokens.get(entry[2]) == entry[1]:
+                    due.append(entry)
+            return now, due
@@ -0,0 +1,253 @@
+import array
+import collections
+import ctypes
+import ctypes.util
+import os
+import socket
+import struct
+import sys
+import threading
+
+from loguru import logger
+from xarxes2025.metrics import METRICS, stage_timer
+from xarxes2025.udpdatagram import send_packet
+
+
+# C layouts of the sendmmsg arguments, used to check that the word arrays
+# built by BatchSender.send_batch match this platform
+
+class IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(IOVec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+WORD_SIZE = 8
+
+# Destination addresses whose struct sockaddr_in is kept, least recently
+# used first out: more than the sessions of a server, fewer than a flood
+# of spoofed ones could make
+MAX_SOCKADDRS = 4096
+
+SEND_TIME = stage_timer("sendto")
+DATAGRAMS = METRICS.counter("xarxes_datagrams_sent_total", "RTP datagrams sent")
+SYSCALLS = METRICS.counter("xarxes_send_syscalls_total", "Send syscalls made for the RTP datagrams")
+
+
+def load_sendmmsg():
+
+    """ Return libc's sendmmsg through ctypes, or None when not available (not Linux) """
+
+    # The message vectors are built as arrays of 64 bit words
+    if (not sys.platform.startswith("linux") or sys.implementation.name != "cpython"
+            or sys.byteorder != "little" or ctypes.sizeof(MMsgHdr) != 8 * WORD_SIZE
+            or ctypes.sizeof(IOVec) != 2 * WORD_SIZE):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+def sockaddr_in(address):
+
+    """ Build a struct sockaddr_in for an (ip, port) tuple """
+
+    ip, port = address
+    data = struct.pack("=H", socket.AF_INET) + struct.pack("!H", port) + socket.inet_aton(ip) + bytes(8)
+    return ctypes.create_string_buffer(data, len(data))
+
+
+class BatchSender(object):
+    """
+    UDP socket shared by all the sessions, sending datagrams in batches.
+
+    Sessions queue the packets of their frame and the pacing scheduler calls
+    flush() once all the sessions due in the same tick have run. On Linux a
+    flush needs one sendmmsg() syscall per batch_size datagrams: the
+    datagrams of a batch are copied one after the other into an arena, a
+    bytearray reused from batch to batch whose address ctypes gives through
+    from_buffer. Elsewhere, or for buffers that can't be copied, it falls
+    back to one sendmsg/sendto per datagram.
+    """
+
+    def __init__(self, host, batch_size=64, multicast_ttl=1):
+        """
+        Constructor for BatchSender object.
+
+        :param host: Local address to bind the socket to.
+        :param batch_size: Maximum datagrams per sendmmsg call (UIO_MAXIOV
+                           is 1024).
+        :param multicast_ttl: TTL of the datagrams sent to multicast groups.
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, 0))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+        self.batch_size = batch_size
+        self.pending = []
+        self.lock = threading.Lock()
+        self.sockaddrs = collections.OrderedDict()
+        self.sendmmsg = load_sendmmsg()
+
+        # The pacing scheduler and the delay line of the network emulator
+        # both flush: one sends at a time, with the arena and the counters
+        self.send_lock = threading.Lock()
+        self.arena = bytearray(batch_size * 2048)
+
+        # Counters to compare against one syscall per datagram
+        self.datagrams = 0
+        self.syscalls = 0
+        self.errors = 0
+
+        logger.debug(f"BatchSender using {'sendmmsg' if self.sendmmsg else 'sendmsg'} on {self.sock.getsockname()}")
+
+    def queue(self, packets, address):
+        """ Queue (header, payload) packets for address until the next flush """
+
+        if packets:
+            with self.lock:
+                self.pending.extend((packet, address) for packet in packets)
+
+    def flush(self):
+        """ Send every queued datagram """
+
+        with self.send_lock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if not pending:
+                return
+
+            syscalls = self.syscalls
+            with SEND_TIME.time():
+                self.send_pending(pending)
+            DATAGRAMS.inc(len(pending))
+            SYSCALLS.inc(self.syscalls - syscalls)
+
+    def send_pending(self, pending):
+
+        """ Send a list of (packet, address), by batches when sendmmsg is available """
+
+        if self.sendmmsg is None:
+            self.send_each(pending)
+            return
+
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start:start + self.batch_size]
+            try:
+                self.send_batch(batch)
+            except (TypeError, ValueError) as e:
+                # A buffer that can't be copied into the arena
+                logger.debug(f"sendmmsg batch not built: {e}")
+                self.send_each(batch)
+
+    def send_each(self, pending):
+
+        """ Send a list of (packet, address) with a syscall per datagram """
+
+        for packet, address in pending:
+            try:
+                send_packet(self.sock, packet, address)
+            except OSError as e:
+                self.errors += 1
+                logger.debug(f"Send to {address} failed: {e}")
+            self.syscalls += 1
+        self.datagrams += len(pending)
+
+    def sockaddr(self, address):
+
+        """ struct sockaddr_in of an address, from the MAX_SOCKADDRS most recently used """
+
+        sockaddrs = self.sockaddrs
+        name = sockaddrs.get(address)
+        if name is None:
+            name = sockaddrs[address] = sockaddr_in(address)
+            if len(sockaddrs) > MAX_SOCKADDRS:
+                sockaddrs.popitem(last=False)
+        else:
+            sockaddrs.move_to_end(address)
+        return name
+
+    def send_batch(self, batch):
+
+        """ Send up to batch_size datagrams with sendmmsg, through the arena """
+
+        count = len(batch)
+        size = sum(len(part) for packet, _ in batch for part in packet)
+        if len(self.arena) < size:
+            self.arena = bytearray(max(size, 2 * len(self.arena)))
+        arena = memoryview(self.arena)
+
+        # Each datagram is copied after the previous one, struct iovec is
+        # {base, len}: two words per datagram. The ctypes array and the
+        # memoryview hold exports of the arena, it can't move meanwhile.
+        exported = (ctypes.c_char * size).from_buffer(self.arena)
+        arena_base = ctypes.addressof(exported)
+        iov_words = []
+        position = 0
+        for packet, _ in batch:
+            start = position
+            for part in packet:
+                end = position + len(part)
+                arena[position:end] = part
+                position = end
+            iov_words += (arena_base + start, position - start)
+        iovecs = array.array("Q", iov_words)
+        iov_base = iovecs.buffer_info()[0]
+
+        # struct mmsghdr is {name, namelen, iov, iovlen, control, controllen,
+        # flags, msg_len}, one word each on 64 bit Linux
+        # The names are held until the call, whatever the cache drops
+        msg_words = []
+        names = []
+        for index, (_, address) in enumerate(batch):
+            name = self.sockaddr(address)
+            names.append(name)
+            msg_words += (ctypes.addressof(name), len(name), iov_base + index * 2 * WORD_SIZE, 1, 0, 0, 0, 0)
+        messages = array.array("Q", msg_words)
+
+        fd = self.sock.fileno()
+        base = messages.buffer_info()[0]
+        sent = 0
+        while sent < count:
+            result = self.sendmmsg(fd, base + sent * 8 * WORD_SIZE, count - sent, 0)
+            self.syscalls += 1
+            if result < 0:
+                # The failing datagram is skipped, the rest are retried
+                errno = ctypes.get_errno()
+                self.errors += 1
+                logger.debug(f"sendmmsg failed: {os.strerror(errno)}")
+                result = 1
+            sent += result
+        self.datagrams += count
+
+    def stats(self):
+        """ Return a dict with the datagram and syscall counters """
+
+        return {
+            "datagrams": self.datagrams,
+            "syscalls": self.syscalls,
+            "errors": self.errors,
+            "mode": "sendmmsg" if self.sendmmsg else "sendmsg",
+        }
+
+    def close(self):
+        self.flush()
+        self.sock.close()
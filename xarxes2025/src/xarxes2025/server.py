@@ -1,139 +1,473 @@
+import concurrent.futures
+import functools
+import os
+import signal
 import socket
 import threading
-import time
 import random
+import time
 
 from loguru import logger
-from xarxes2025.udpdatagram import UDPDatagram
-from xarxes2025.videoprocessor import VideoProcessor
+from xarxes2025.admission import AdmissionControl
+from xarxes2025.channel import CHANNEL_PREFIX, ChannelRegistry
+from xarxes2025.delta import DeltaEncoder
+from xarxes2025.encodepool import EncoderPool
+from xarxes2025.encoders import make_encoder
+from xarxes2025.fec import FEC_HEADER, MAX_GROUP, FECEncoder
+from xarxes2025.framecache import FRAME_CACHE
+from xarxes2025.metrics import METRICS, stage_timer, start_metrics_server
+from xarxes2025.netem import make_emulator
+from xarxes2025.packedvideo import is_packed, open_video
+from xarxes2025.ratecontrol import RateController, scale_size
+from xarxes2025.rtcp import RTCP_INTERVAL, RTCPDispatcher, build_sender_report, ntp_time
+from xarxes2025.rtpjpeg import CLOCK_RATE
+from xarxes2025.rtsp import BadRequest, RTSPParser, parse_range, parse_transport
+from xarxes2025.scheduler import NOT_READY, PRODUCE_RETRY, FramePrefetch, PacingScheduler, PacingStats
+from xarxes2025.sender import BatchSender
+from xarxes2025.udpdatagram import RTPPacketizer, UDPDatagram
 
 # RTSP status codes to eith their messages
 RTSP_STATUS_MESSAGES = {
     200: "OK",
     400: "Bad Request",
     404: "File Not Found",
+    413: "Request Entity Too Large",
+    451: "Parameter Not Understood",
+    453: "Not Enough Bandwidth",
+    457: "Invalid Range",
+    461: "Unsupported Transport",
     500: "Internal Server Error",
-    501: "Not Implemented"
+    501: "Not Implemented",
+    503: "Service Unavailable"
 }
 
-def build_rtsp_response(status_code, cseq, session_id):
-
-    """ Build RTSP response messages """
+# Methods the sessions handle, for the Public header of OPTIONS
+RTSP_METHODS = "SETUP, PLAY, PAUSE, TEARDOWN, GET_PARAMETER, OPTIONS"
+
+# Seconds between two rounds of bandwidth measures and idle session reaping
+REAP_INTERVAL = 1.0
+
+PACKETIZE_TIME = stage_timer("packetize")
+
+def register_server_metrics(server):
+
+    """ Session gauges and per-session counters of a server engine, read at scrape time """
+
+    def by_state():
+        states = {"INIT": 0, "READY": 0, "PLAYING": 0}
+        for session in list(server.sessions):
+            states[session.state] = states.get(session.state, 0) + 1
+        return [({"state": state}, count) for state, count in states.items()]
+
+    def per_session(attribute):
+        return lambda: [({"session": session.sessionid}, getattr(session, attribute)) for session in list(server.sessions)]
+
+    def per_report(key):
+        return lambda: [({"session": session.sessionid}, session.receiver_report[key])
+                        for session in list(server.sessions)
+                        if session.receiver_report and session.receiver_report[key] is not None]
+
+    def per_rate(key):
+        return lambda: [({"session": session.sessionid}, session.rate.current()[key])
+                        for session in list(server.sessions) if session.rate is not None]
+
+    def per_channel(function):
+        return lambda: [({"channel": channel.name}, function(channel)) for channel in list(server.channels.channels.values())]
+
+    METRICS.add_collector("gauge", "xarxes_sessions", "Connected RTSP sessions by state", by_state)
+    METRICS.add_collector("counter", "xarxes_session_frames_sent_total", "Frames sent by each session",
+                          per_session("frames_sent"))
+    METRICS.add_collector("counter", "xarxes_session_bytes_sent_total", "RTP bytes sent by each session",
+                          per_session("bytes_sent"))
+    METRICS.add_collector("gauge", "xarxes_session_rtt_seconds", "Round trip time from the RTCP reports",
+                          per_report("rtt"))
+    METRICS.add_collector("gauge", "xarxes_session_jitter_seconds", "Interarrival jitter reported by each client",
+                          per_report("jitter"))
+    METRICS.add_collector("gauge", "xarxes_session_fraction_lost", "Fraction of packets lost in the last report interval",
+                          per_report("fraction_lost"))
+    METRICS.add_collector("gauge", "xarxes_session_jpeg_quality", "JPEG quality chosen by the rate control",
+                          per_rate(0))
+    METRICS.add_collector("gauge", "xarxes_session_scale", "Frame scale chosen by the rate control", per_rate(1))
+    METRICS.add_collector("gauge", "xarxes_admission_sessions", "Sessions admitted by SETUP",
+                          lambda: [({}, server.admission.stats()["sessions"])])
+    METRICS.add_collector("gauge", "xarxes_admission_decoders", "Live decoders held by sessions and channels",
+                          lambda: [({}, server.admission.stats()["decoders"])])
+    METRICS.add_collector("gauge", "xarxes_admission_bandwidth_bits", "Egress bandwidth reserved or measured",
+                          lambda: [({}, server.admission.bandwidth())])
+    METRICS.add_collector("counter", "xarxes_admission_rejected_total", "SETUPs refused by the admission control",
+                          lambda: [({"status": str(status)}, count) for status, count in server.admission.rejected.items()])
+    METRICS.add_collector("gauge", "xarxes_channel_viewers", "Viewers of each live channel",
+                          per_channel(lambda channel: len(channel.viewers)))
+    METRICS.add_collector("counter", "xarxes_channel_frames_sent_total", "Frames sent by each live channel",
+                          per_channel(lambda channel: channel.frames_sent))
+    for name in ("hits", "misses", "evictions"):
+        METRICS.add_collector("counter", f"xarxes_frame_cache_{name}_total", f"Frame cache {name}",
+                              lambda name=name: [({}, FRAME_CACHE.stats()[name])])
+    METRICS.add_collector("gauge", "xarxes_frame_cache_bytes", "Bytes of encoded frames in the frame cache",
+                          lambda: [({}, FRAME_CACHE.stats()["bytes"])])
+
+def reap_sessions(server, now, elapsed):
+    """
+    Housekeeping round of a server engine.
+
+    Measures the bandwidth of the playing sessions for the admission control,
+    expires the sessions idle for longer than the session timeout and
+    reports the stats of a worker to its supervisor.
+
+    :param server: Server engine.
+    :param now: time.monotonic().
+    :param elapsed: Seconds since the previous round.
+    """
+    sessions = list(server.sessions)
+    server.admission.measure(sessions, elapsed)
+    for session in sessions:
+        if session.is_idle(now):
+            session.expire()
+    if server.report is not None:
+        server.report(server_stats(server))
+
+
+def server_stats(server):
+
+    """ Return a dict with the sessions and limits of a server engine, reported by the workers """
+
+    sessions = list(server.sessions)
+    cache = FRAME_CACHE.stats()
+    return dict(server.admission.stats(),
+                connections=len(sessions),
+                streaming=sum(1 for session in sessions if session.is_streaming()),
+                frames_sent=sum(session.frames_sent for session in sessions),
+                cache_hits=cache["hits"],
+                cache_misses=cache["misses"])
+
+
+def build_rtsp_response(status_code, cseq, session_id, headers=None):
+
+    """ Build RTSP response messages, with optional extra headers """
 
     message = RTSP_STATUS_MESSAGES.get(status_code, "Unknown")
-    return (
+    response = (
         f"RTSP/1.0 {status_code} {message}\r\n"
         f"CSeq: {cseq}\r\n"
         f"Session: {session_id}\r\n"
     )
+    for name, value in (headers or {}).items():
+        response += f"{name}: {value}\r\n"
 
-class ClientSession(threading.Thread):
-    def __init__(self, client_socket, client_address, server_config):
-        super().__init__(daemon=True)
-        self.client_socket = client_socket
-        self.client_address = client_address
-        self.host, self.port, self.max_frames, self.frame_rate, self.loss_rate, self.error = server_config
+    # Empty line ending the response, pipelined responses are framed on it
+    return response + "\r\n"
+
+class RTSPSession(object):
 
-        # Unique session ID
+    """ RTSP state machine shared by the threaded and the asyncio server engines.
+
+    Subclasses provide the transport: how responses and datagrams are sent
+    and how the streaming loop is started, paused and stopped. """
+
+    def __init__(self, client_address, server):
+        self.client_address = client_address
+        self.server = server
+        self.host = server.host
+        self.port = server.port
+        self.max_frames = server.max_frames
+        self.frame_rate = server.frame_rate
+        self.loss_rate = server.loss_rate
+        self.error = server.error
+
+        # Unique session ID, with the worker number when the port is shared
+        # by several worker processes
         self.sessionid = f"XARXES{self.client_address[1]}"
+        if server.worker is not None:
+            self.sessionid += f"-{server.worker}"
 
         self.client_udp_port = None
-        self.udp_socket = None
         self.video = None
         self.state = "INIT"
 
-        # Thread control events
-        self.streaming = threading.Event()
-        self.paused_event = threading.Event()
+        # Live channel the session watches instead of its own playback
+        self.channel = None
 
-    def run(self):
+        # Builds the RTP packets, keeps the sequence number
+        self.packetizer = None
 
-        """ Main thread loop handling RTSP requests """
+        # Emulated network to the client, None without impairments, one
+        # path per SETUP closed by release()
+        self.network = None
 
-        try:
-            while True:
-                data = self.client_socket.recv(1024).decode()
-                if not data:
-                    break
+        # Frames and bytes sent and how late they were sent
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.pacing = PacingStats()
 
-                # Route to the appropiate handler
-                if data.startswith("SETUP"):
-                    self.handle_setup(data)
-                elif data.startswith("PLAY"):
-                    self.handle_play(data)
-                elif data.startswith("PAUSE"):
-                    self.handle_pause(data)
-                elif data.startswith("TEARDOWN"):
-                    self.handle_teardown(data)
+        # RTCP: random SSRC of the stream, counters of the sender reports,
+        # (timestamp, time) of the last frame and the client's last report
+        self.ssrc = random.getrandbits(32)
+        self.packets_sent = 0
+        self.octets_sent = 0
+        self.rtp_clock = None
+        self.last_report = 0.0
+        self.receiver_report = None
 
-        except Exception as e:
-            logger.error(f"Error handling client {self.client_address}: {e}")
+        # Quality and resolution from the client's feedback, None when the
+        # frames can't be re-encoded (packed videos, channels)
+        self.rate = None
+        self.rate_level = 0
 
-    def extract_udp_port(self, request_data):
+        # Unchanged frame suppression and tile deltas, if the server does them
+        self.delta = None
 
-        """ Extrcat client's UDP port from Setup request's transport header or return default """
+        # Parity packets of the stream, if the client or the server asked for them
+        self.fec = None
 
-        for line in request_data.split("\n"):
-            if "Transport" in line:
-                parts = line.split(";")
-                for part in parts:
-                    if "client_port" in part:
-                        return int(part.split("=")[1])
-        return 25000
+        # Frame to continue from, set by a PLAY Range and applied by the
+        # streaming loop before its next frame, and frame number to stop at
+        self.pending_seek = None
+        self.seek_lock = threading.Lock()
+        self.play_end = None
 
-    def start_streaming_udp(self):
+        # Held by the pacing scheduler while it sends a frame of the session,
+        # and by TEARDOWN and expiry while they drop the video and its state
+        self.stream_lock = threading.Lock()
 
-        """ Main video streaming loop running in a separate thread """
+        # Last RTSP request or RTCP report, sessions idle for longer than
+        # the session timeout are expired
+        self.last_activity = time.monotonic()
 
-        self.streaming.set()
-        frame_count = 0
-        try:
-            while self.should_continue_streaming(frame_count):
-                frame_data = self.get_next_frame()
+    def handle_request(self, request):
 
-                # When paused
-                if frame_data is None:
-                    continue
+        """ Route an RTSP request to the appropiate handler """
 
-                if self.process_frame(frame_data):
-                    frame_count += 1
-                time.sleep(1 / self.frame_rate)
+        self.last_activity = time.monotonic()
+        if request.method == "SETUP":
+            self.handle_setup(request)
+        elif request.method == "PLAY":
+            self.handle_play(request)
+        elif request.method == "PAUSE":
+            self.handle_pause(request)
+        elif request.method == "TEARDOWN":
+            self.handle_teardown(request)
+        elif request.method in ("GET_PARAMETER", "OPTIONS"):
+            self.handle_keepalive(request)
+        elif request.method is None:
+            self.send_response(build_rtsp_response(400, request.cseq, self.sessionid))
+        else:
+            self.send_response(build_rtsp_response(501, request.cseq, self.sessionid))
 
-        except Exception as e:
-            logger.error(f"Error in UDP streaming: {e}")
+    def refuse_request(self, error):
 
-    def should_continue_streaming(self, frame_count):
+        """ Answer a request the parser can't frame (over its limits, bad Content-Length),
+        the engine closes the connection after it """
 
-        """ Check if streaming should continue based on state frame count """
+        self.send_response(build_rtsp_response(error.status, error.cseq, self.sessionid))
 
-        return self.streaming.is_set() and not self.reached_max_frames(frame_count)
+    def handle_keepalive(self, request):
 
-    def get_next_frame(self):
+        """ Handle GET_PARAMETER and OPTIONS, sent by clients to keep an idle session from expiring """
 
-        """ Get next video frame """
+        headers = {"Public": RTSP_METHODS} if request.method == "OPTIONS" else None
+        self.send_response(build_rtsp_response(200, request.cseq, self.sessionid, headers))
 
-        if self.paused_event.is_set():
-            time.sleep(0.1)
-            return None
-        return self.video.next_frame()
+    def extract_udp_port(self, request):
+
+        """ Extrcat client's UDP port from Setup request's transport header or return default """
+
+        client_port = parse_transport(request.header("Transport", "")).get("client_port")
+        if client_port:
+            return int(client_port.split("-")[0])
+        return 25000
+
+    def wants_multicast(self, request):
+
+        """ Check if the SETUP request's transport header asks for multicast """
+
+        return "multicast" in parse_transport(request.header("Transport", ""))
+
+    def extract_encoding(self, request):
+        """
+        JPEG encoder and quality asked for by the SETUP request, the server's by default.
+
+        The X-Encoding header takes the Transport syntax, e.g.
+        "encoder=pillow; subsampling=444; quality=80; optimize; progressive".
+        Raises ValueError, or ImportError for a backend not installed.
+        """
+        params = parse_transport(request.header("X-Encoding", ""))
+        jpeg = self.server.jpeg
+        jpeg = make_encoder(params.get("encoder", jpeg.name), params.get("subsampling", jpeg.subsampling),
+                            "optimize" in params or jpeg.optimize, "progressive" in params or jpeg.progressive)
+        quality = int(params.get("quality", self.server.max_quality))
+        if not 0 <= quality <= 100:
+            raise ValueError(quality)
+        return jpeg, quality
+
+    def extract_fec(self, request):
+        """
+        Media packets per parity packet asked for by the SETUP request, the server's by default.
+
+        Taken from the fec parameter of the Transport header, e.g.
+        "RTP/UDP; client_port= 25000; fec=10", fec=0 for none. Raises
+        ValueError out of 0 to MAX_GROUP.
+        """
+        fec = parse_transport(request.header("Transport", "")).get("fec")
+        if fec is None:
+            return self.server.fec
+        fec = int(fec)
+        if not 0 <= fec <= MAX_GROUP:
+            raise ValueError(fec)
+        return fec
 
     def process_frame(self, frame_data):
 
-        """ Process and send a frame with optional packet loss simulation """
+        """ Split a frame in MTU sized RTP packets and send them, through the emulated network if any """
+
+        if not frame_data:
+            return False
+
+        timestamp = self.frame_timestamp(self.video.get_frame_number())
+        address = (self.client_address[0], self.client_udp_port)
+
+        # Create the RTP packets and send them to client
+        with PACKETIZE_TIME.time():
+            packets = self.packetizer.packetize(frame_data, timestamp)
+
+        # The sender report counts the simulated losses as sent, the network lost them,
+        # and only the media packets: the parity packets have their own sequence numbers
+        self.packets_sent += len(packets)
+        self.octets_sent += sum(len(header) + len(payload) for header, payload in packets) \
+            - len(packets) * UDPDatagram.HEADER_SIZE
+        if self.fec is not None:
+            packets = self.fec.protect(packets, timestamp)
+        network = self.network
+        if network is not None:
+            packets, size = network.impair(packets, address)
+        else:
+            size = sum(len(header) + len(payload) for header, payload in packets)
+        self.bytes_sent += size
+        self.send_packets(packets, address)
+
+        now = time.monotonic()
+        rate = self.rate
+        if rate is not None:
+            rate.on_sent(size, now)
+            self.apply_rate_control(rate)
+        self.rtp_clock = (timestamp, now)
+        if now - self.last_report >= RTCP_INTERVAL:
+            self.send_sender_report(now)
+        return True
+
+    def frame_timestamp(self, frame_number):
+
+        """ RTP timestamp of a frame number (from 1), at the stream's frame rate """
+
+        return (frame_number * CLOCK_RATE // self.frame_rate) & 0xFFFFFFFF
+
+    def next_video_frame(self):
+
+        """ Return the next frame of the video, after the seek of the last PLAY Range if any """
+
+        with self.seek_lock:
+            frame, self.pending_seek = self.pending_seek, None
+        if frame is not None:
+            self.video.seek(frame)
+        return self.video.next_frame()
+
+    def send_sender_report(self, now):
 
-        if frame_data and not self.should_drop_packet():
+        """ Send an RTCP Sender Report to the client's RTCP port (RTP port + 1) """
 
-            # Create UDP datagram and send to client
-            datagram = UDPDatagram(self.video.get_frame_number(), frame_data).get_datagram()
-            self.udp_socket.sendto(datagram, (self.client_address[0], self.client_udp_port))
-            return True
-        return False
+        timestamp, sent = self.rtp_clock
+        rtp_timestamp = timestamp + int((now - sent) * CLOCK_RATE)
+        report = build_sender_report(self.ssrc, ntp_time(), rtp_timestamp, self.packets_sent, self.octets_sent)
+        self.server.send_rtcp(report, (self.client_address[0], self.client_udp_port + 1))
+        self.last_report = now
+
+    def on_receiver_report(self, block, rtt, address):
+
+        """ RTCP dispatcher callback with a report block of the client about this stream, sent from address """
+
+        self.receiver_report = {
+            "fraction_lost": block.fraction_lost / 256,
+            "cumulative_lost": block.cumulative_lost,
+            "jitter": block.jitter / CLOCK_RATE,
+            "rtt": rtt,
+        }
+        logger.debug(f"Session {self.sessionid} receiver report {self.receiver_report}")
+        self.last_activity = time.monotonic()
+        rate = self.rate
+        if rate is not None:
+            rate.on_report(self.receiver_report["fraction_lost"])
 
-    def should_drop_packet(self):
+    def apply_rate_control(self, rate):
 
-        """ Simulate network packet loss based on configured rate """
+        """ Encode the next frames at the level chosen by the rate control, if it changed """
 
-        return random.randint(1, 100) <= self.loss_rate
+        if rate.level == self.rate_level:
+            return
+        self.rate_level = rate.level
+        quality, scale = rate.current()
+        size = self.server.resolution if scale == 1.0 else scale_size(rate.size, scale)
+        self.video.set_encoding(size, quality)
+        width, height = self.video.get_size()
+        self.packetizer.set_frame_info(width, height, quality)
+
+    def catch_up(self, deadline, now):
+
+        """ Record the pacing lateness of a send and skip the frames whose time already passed """
+
+        period = 1 / self.frame_rate
+        lateness = now - deadline
+        self.pacing.record(lateness)
+        if lateness >= period:
+            missed = int(lateness / period)
+            self.video.skip(missed)
+            self.pacing.skipped += missed
+            deadline += missed * period
+            logger.debug(f"Session {self.sessionid} {lateness * 1000:.1f} ms late, skipped {missed} frames")
+        return deadline
+
+    def send_frame(self, frame_data):
+
+        """ Send a frame, returns False when the stream is over (end of video or max frames) """
+
+        if frame_data is None:
+            return False
+        if self.process_frame(frame_data):
+            self.frames_sent += 1
+        if self.play_end is not None and self.video.get_frame_number() >= self.play_end:
+            return False
+        return not self.reached_max_frames(self.frames_sent)
+
+    def on_deadline(self, deadline, now):
+
+        """ Pacing scheduler callback: send the frame due at deadline, return the next deadline """
+
+        with self.stream_lock:
+            # Torn down after the scheduler took the deadline
+            if self.video is None:
+                return None
+            return self.send_due_frame(deadline, now)
+
+    def send_due_frame(self, deadline, now):
+
+        """ on_deadline with the stream lock held """
+
+        # A frame produced before a PLAY Range is of the old position
+        if self.pending_seek is not None:
+            self.prefetch.discard()
+        frame_data = self.prefetch.take()
+        if frame_data is NOT_READY:
+            # Still decoding or encoding: the producer wakes the scheduler when
+            # done, the lateness counts from the deadline it missed
+            if self.late_deadline is None:
+                self.late_deadline = deadline
+            return now + PRODUCE_RETRY
+        if self.late_deadline is not None:
+            deadline, self.late_deadline = self.late_deadline, None
+
+        deadline = self.catch_up(deadline, now)
+        if not self.send_frame(frame_data):
+            return None
+        self.prefetch.start()
+        return deadline + 1 / self.frame_rate
 
     def reached_max_frames(self, count):
 
@@ -141,133 +475,647 @@ class ClientSession(threading.Thread):
 
         return self.max_frames > 0 and count >= self.max_frames
 
-    def handle_setup(self, data):
+    def handle_setup(self, request):
 
         """ Handle Setup request to initialize streaming session """
 
-        cseq_value = self.get_cseq(data)
-        
+        cseq_value = request.cseq
+
         # VAlidate state
         if self.state != "INIT":
-            response = build_rtsp_response(400, cseq_value, self.sessionid)
-            self.client_socket.send(response.encode())
+            self.send_response(build_rtsp_response(400, cseq_value, self.sessionid))
             return
 
         # Extract filename from request
-        filename = data.split(" ")[1].strip() if len(data.split(" ")) >= 2 else "rick.webm"
+        filename = request.uri
 
-        # Get client's UDP port and create UDP socket
-        self.client_udp_port = self.extract_udp_port(data)
-        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Get client's UDP port
+        self.client_udp_port = self.extract_udp_port(request)
+
+        # Live channels are shared by all their viewers
+        multicast = self.wants_multicast(request)
+        if filename.startswith(CHANNEL_PREFIX) or multicast:
+            self.setup_channel(filename, multicast, cseq_value)
+            return
 
         try:
-            # Initialize video processor
-            self.video = VideoProcessor(filename)
+            jpeg, quality = self.extract_encoding(request)
         except Exception as e:
-            logger.error(f"Failed to load video: {e}")
-            response = build_rtsp_response(404, cseq_value, self.sessionid)
-            self.client_socket.send(response.encode())
+            logger.error(f"Bad X-Encoding header: {e}")
+            self.send_response(build_rtsp_response(451, cseq_value, self.sessionid))
+            return
+        try:
+            fec = self.extract_fec(request)
+        except ValueError as e:
+            logger.error(f"Bad FEC transport parameter: {e}")
+            self.send_response(build_rtsp_response(461, cseq_value, self.sessionid))
+            return
+
+        # Refuse the session rather than degrade the ones already playing
+        if not self.admit(cseq_value, decoder=not is_packed(filename)):
             return
 
+        if self.server.delta != "off":
+            self.delta = DeltaEncoder(self.server.delta, int(self.server.refresh_interval * self.frame_rate),
+                                      self.server.delta_threshold)
+
+        # Initialize video source, the packed container when there is one
+        self.run_blocking(
+            functools.partial(open_video, filename, self.server.resolution, quality, self.server.encoder, jpeg,
+                              self.delta),
+            functools.partial(self.video_opened, cseq_value, quality, fec))
+
+    def video_opened(self, cseq_value, quality, fec, video, error):
+
+        """ Second half of the SETUP, once the video is open or failed to """
+
+        if error is not None:
+            logger.error(f"Failed to load video: {error}")
+            self.server.admission.release(self)
+            self.send_response(build_rtsp_response(404, cseq_value, self.sessionid))
+            return
+        self.video = video
+
+        width, height = self.video.get_size()
+        # The parity packets are FEC_HEADER.size bytes longer than the media packets,
+        # the sequence numbers go on after a TEARDOWN
+        seqnum = self.packetizer.seqnum if self.packetizer is not None else 0
+        self.packetizer = RTPPacketizer(self.server.mtu - (FEC_HEADER.size if fec else 0), ssrc=self.ssrc,
+                                        seqnum=seqnum)
+        self.packetizer.set_frame_info(width, height, self.video.quality)
+        self.fec = FECEncoder(fec, self.ssrc) if fec else None
+        self.server.rtcp.register(self.ssrc, self)
+        if self.server.netem is not None:
+            self.network = self.server.netem.path()
+        if self.server.rate_control and self.video.adaptive:
+            self.rate = RateController((width, height), min(self.server.min_quality, quality), quality,
+                                       self.server.max_bitrate * 1000)
+            self.rate_level = 0
+
         # Update state and send succes response
         self.state = "READY"
-        self.paused_event.clear()
-        response = build_rtsp_response(200, cseq_value, self.sessionid)
-        self.client_socket.send(response.encode())
+        self.resume_streaming()
+        transport = (f"RTP/UDP;unicast;client_port={self.client_udp_port}-{self.client_udp_port + 1};"
+                     f"server_port={self.server.rtp_port}-{self.server.rtcp_port};ssrc={self.ssrc:08X}")
+        if fec:
+            transport += f";fec={fec}"
+        self.send_response(build_rtsp_response(200, cseq_value, self.session_header(), {"Transport": transport}))
+
+    def admit(self, cseq_value, decoder, bitrate=None):
+
+        """ Ask the admission control for a lease, answering the SETUP if refused """
+
+        status = self.server.admission.admit(self, decoder, bitrate)
+        if status is None:
+            return True
+        logger.warning(f"Session {self.sessionid} refused with {status}, {self.server.admission.stats()}")
+        self.send_response(build_rtsp_response(status, cseq_value, self.sessionid))
+        return False
+
+    def session_header(self):
+
+        """ Session header value of the SETUP response, with the timeout the session expires after """
+
+        timeout = self.server.session_timeout
+        return f"{self.sessionid};timeout={timeout}" if timeout else self.sessionid
 
-    def handle_play(self, data):
+    def setup_channel(self, filename, multicast, cseq_value):
+
+        """ Join the live channel of a video instead of starting a playback of its own """
+
+        name = filename[len(CHANNEL_PREFIX):] if filename.startswith(CHANNEL_PREFIX) else filename
+
+        # Viewers of a multicast channel add no egress, a new channel needs a decoder
+        bitrate = 0 if multicast and self.server.multicast_group is not None else None
+        if not self.admit(cseq_value, False, bitrate):
+            return
+        if (not self.server.channels.is_open(name, multicast) and not is_packed(name)
+                and not self.server.admission.decoder_available()):
+            self.server.admission.release(self)
+            self.server.admission.rejected[503] += 1
+            self.send_response(build_rtsp_response(503, cseq_value, self.sessionid))
+            return
+
+        self.run_blocking(functools.partial(self.server.channels.join, name, self, multicast),
+                          functools.partial(self.channel_joined, cseq_value))
+
+    def channel_joined(self, cseq_value, channel, error):
+
+        """ Second half of a channel SETUP, once the channel is open or failed to """
+
+        if error is not None:
+            logger.error(f"Failed to load video: {error}")
+            self.server.admission.release(self)
+            self.send_response(build_rtsp_response(404, cseq_value, self.sessionid))
+            return
+        self.channel = channel
+
+        self.state = "READY"
+        self.send_response(build_rtsp_response(
+            200, cseq_value, self.session_header(), {"Transport": self.channel.transport(self)}))
+
+    def leave_channel(self):
+
+        """ Leave the live channel, if the session is in one """
+
+        if self.channel is not None:
+            self.server.channels.leave(self.channel, self)
+            self.channel = None
+
+    def release(self):
+
+        """ Free what the session holds in the server: its channel, its RTCP registration and its lease """
+
+        self.leave_channel()
+        self.server.rtcp.unregister(self.ssrc)
+        self.server.admission.release(self)
+        if self.network is not None:
+            self.server.netem.close_path(self.network)
+            self.network = None
+
+    def is_idle(self, now):
+
+        """ True if the client sent no request nor report for longer than the session timeout """
+
+        timeout = self.server.session_timeout
+        return bool(timeout) and now - self.last_activity > timeout
+
+    def expire(self):
+
+        """ End the session from the server side: stop the stream and close the connection """
+
+        logger.info(f"Session {self.sessionid} expired, idle for {time.monotonic() - self.last_activity:.0f} s")
+        with self.stream_lock:
+            self.stop_streaming()
+            self.release()
+            self.state = "INIT"
+            self.video = None
+        self.close_connection()
+
+    def handle_play(self, request):
 
         """ Handle Play request to start or resume streaming """
 
-        cseq_value = self.get_cseq(data)
-        self.paused_event.clear()
+        cseq_value = request.cseq
+        if self.channel is not None:
+            self.channel.play(self, (self.client_address[0], self.client_udp_port))
+            self.send_response(build_rtsp_response(200, cseq_value, self.sessionid))
+            self.state = "PLAYING"
+            return
+
+        headers = None
+        if request.header("Range") is not None:
+            headers = self.seek(request)
+            if headers is None:
+                self.send_response(build_rtsp_response(457, cseq_value, self.sessionid))
+                return
+
+        self.resume_streaming()
+        if self.rate is not None:
+            self.rate.reset_window()
 
         # Send response and update state
-        response = build_rtsp_response(200, cseq_value, self.sessionid)
-        self.client_socket.send(response.encode())
+        self.send_response(build_rtsp_response(200, cseq_value, self.sessionid, headers))
         self.state = "PLAYING"
 
-        # Start streaming thread if not already running
-        if not self.streaming.is_set():
-            threading.Thread(target=self.start_streaming_udp, daemon=True).start()
+        # Start streaming if not already running
+        self.start_streaming()
+
+    def seek(self, request):
+        """
+        Apply the Range of a PLAY request.
 
-    def handle_pause(self, data):
+        The streaming loop continues at the frame shown at the start of the
+        range, decoded from the keyframe before it (see FrameIndex).
+
+        :param request: The PLAY request.
+        :returns: Range and RTP-Info headers of the response, None if the
+                  range is invalid.
+        """
+        if self.video is None:
+            return None
+        index = self.video.index
+        try:
+            start, end = parse_range(request.header("Range"))
+        except ValueError:
+            logger.debug(f"Session {self.sessionid} invalid range {request.header('Range')}")
+            return None
+        if start is not None and start >= index.duration:
+            return None
+
+        if start is None:
+            frame = self.video.get_frame_number()
+        else:
+            frame = index.frame_at(start)
+            with self.seek_lock:
+                self.pending_seek = frame
+            logger.debug(f"Session {self.sessionid} seek to frame {frame}, {index.time_of(frame):.3f} s")
+        self.play_end = index.frame_at(end) + 1 if end is not None else None
+
+        # The first frame sent has frame number frame + 1
+        return {
+            "Range": f"npt={index.time_of(frame):.3f}-{end if end is not None else index.duration:.3f}",
+            "RTP-Info": f"url={request.uri};rtptime={self.frame_timestamp(frame + 1)}",
+        }
+
+    def handle_pause(self, request):
 
         """ Handle Pause request to temporarily stop streaming """
 
-        cseq_value = self.get_cseq(data)
-        self.paused_event.set()
+        cseq_value = request.cseq
+        if self.channel is not None:
+            self.channel.pause(self)
+        else:
+            self.pause_streaming()
 
         # Send response and update state
-        response = build_rtsp_response(200, cseq_value, self.sessionid)
-        self.client_socket.send(response.encode())
+        self.send_response(build_rtsp_response(200, cseq_value, self.sessionid))
         self.state = "READY"
 
-    def handle_teardown(self, data):
+    def handle_teardown(self, request):
 
         """ Handle Teardown request to end session """
 
-        cseq_value = self.get_cseq(data)
+        cseq_value = request.cseq
 
         # Send response
-        response = build_rtsp_response(200, cseq_value, self.sessionid)
+        self.send_response(build_rtsp_response(200, cseq_value, self.sessionid))
+
+        # Clean up resources and reset state, not while the pacing
+        # scheduler is sending a frame of the session
+        with self.stream_lock:
+            self.stop_streaming()
+            self.release()
+
+            self.state = "INIT"
+            self.video = None
+            rate = self.rate.snapshot() if self.rate is not None else None
+            self.rate = None
+            delta = self.delta.snapshot() if self.delta is not None else None
+            self.delta = None
+            fec = self.fec
+            fec = {"k": fec.k, "parity_packets": fec.parity_packets, "parity_bytes": fec.parity_bytes} if fec else None
+            self.fec = None
+        logger.info(f"Session {self.sessionid} teardown, pacing {self.pacing.snapshot()}, "
+                    f"receiver report {self.receiver_report}, rate control {rate}, delta frames {delta}, "
+                    f"fec {fec}, frame cache {FRAME_CACHE.stats()}")
+
+    def run_blocking(self, work, done):
+        """
+        Run the blocking part of a request, opening a video, and then finish it.
+
+        Called in line here; the asyncio engine runs work in its executor
+        and holds the next requests of the connection until done.
+
+        :param work: Function doing the blocking part.
+        :param done: Called with (result, None) or (None, exception).
+        """
+        try:
+            result = work()
+        except Exception as e:
+            done(None, e)
+            return
+        done(result, None)
+
+    # Transport hooks implemented by each engine
+    def send_response(self, response):
+        raise NotImplementedError
+
+    def send_packets(self, packets, address):
+        raise NotImplementedError
+
+    def start_streaming(self):
+        raise NotImplementedError
+
+    def pause_streaming(self):
+        raise NotImplementedError
+
+    def resume_streaming(self):
+        raise NotImplementedError
+
+    def stop_streaming(self):
+        raise NotImplementedError
+
+    def is_streaming(self):
+        raise NotImplementedError
+
+    def close_connection(self):
+        raise NotImplementedError
+
+
+class ClientSession(RTSPSession, threading.Thread):
+    def __init__(self, client_socket, client_address, server):
+        threading.Thread.__init__(self, daemon=True)
+        RTSPSession.__init__(self, client_address, server)
+        self.client_socket = client_socket
+
+        # Next frame, produced in the server's frame producers for the
+        # pacing scheduler, and the deadline it missed if it was late
+        self.prefetch = FramePrefetch(server.producers, self.next_video_frame,
+                                      lambda: server.scheduler.wake(self))
+        self.late_deadline = None
+
+    def run(self):
+
+        """ Main thread loop handling RTSP requests """
+
+        parser = RTSPParser()
+        self.server.sessions.add(self)
+        try:
+            while True:
+                data = self.client_socket.recv(4096)
+                if not data:
+                    break
+
+                # Route every complete request to the appropiate handler, in order
+                try:
+                    requests = parser.feed(data)
+                except BadRequest as e:
+                    self.refuse_request(e)
+                    self.close_connection()
+                    break
+                for request in requests:
+                    self.handle_request(request)
+
+        except Exception as e:
+            logger.error(f"Error handling client {self.client_address}: {e}")
+        finally:
+            with self.stream_lock:
+                self.stop_streaming()
+                self.release()
+                self.video = None
+            self.server.sessions.discard(self)
+
+    def send_response(self, response):
         self.client_socket.send(response.encode())
 
-        # Clean up resources
-        self.streaming.clear()
-        self.paused_event.clear()
-        if self.udp_socket:
-            self.udp_socket.close()
-            self.udp_socket = None
+    def send_packets(self, packets, address):
+        self.server.send_packets(packets, address)
 
-        # Reset state
-        self.state = "INIT"
-        self.video = None
+    def start_streaming(self):
+
+        # Frames are sent by the server pacing scheduler, not by a thread per session
+        if not self.server.scheduler.is_scheduled(self):
+            self.server.scheduler.add(self)
+
+    def pause_streaming(self):
+        self.server.scheduler.remove(self)
 
-    def get_cseq(self, data):
+    def resume_streaming(self):
+        pass
 
-        """ Extract CSeq number from RTSP request """
+    def stop_streaming(self):
+        self.server.scheduler.remove(self)
+        self.prefetch.reset()
+        self.late_deadline = None
+
+    def is_streaming(self):
+        return self.server.scheduler.is_scheduled(self)
+
+    def close_connection(self):
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
-        for line in data.split("\n"):
-            if line.startswith("CSeq"):
-                return line.split(":")[1].strip()
-        return "0"
 
+class ServerEngine(object):
 
-class Server(object):
-    def __init__(self, port, host, max_frames, frame_rate, loss_rate, error):
+    """ Configuration and shared state of the threaded and the asyncio server engines.
+
+    Both engines take the same options, stored here once; each one adds
+    its transport and serves until interrupted. """
+
+    def __init__(self, port, host, max_frames, frame_rate, loss_rate, error, cache_size=256,
+                 mtu=1400, resolution=(500, 380), encode_workers=0, multicast_group=None,
+                 multicast_port=5004, multicast_ttl=1, metrics_port=None, rate_control=True,
+                 min_quality=30, max_quality=95, max_bitrate=0, max_sessions=0, max_decoders=0,
+                 max_bandwidth=0, backlog=5, session_timeout=60, drain_timeout=10, jpeg_encoder="opencv",
+                 subsampling="420", jpeg_optimize=False, jpeg_progressive=False, delta="off",
+                 delta_threshold=2.0, refresh_interval=2.0, worker=None, report=None,
+                 loss_burst=1.0, delay=0, jitter=0, reorder=0, duplicate=0, link_rate=0, link_burst=64,
+                 netem_seed=None, fec=0):
         self.host = host
         self.port = port
         self.max_frames = max_frames
         self.frame_rate = frame_rate
         self.loss_rate = loss_rate
         self.error = error
+        self.mtu = mtu
+        self.resolution = resolution
+
+        # Media packets per parity packet of the sessions that don't ask, 0 for no FEC
+        self.fec = fec
+        self.multicast_group = multicast_group
+        self.multicast_port = multicast_port
+        self.multicast_ttl = multicast_ttl
+        self.rate_control = rate_control
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.max_bitrate = max_bitrate
+
+        # JPEG encoder of the live encoded videos, a session can ask for other settings in SETUP
+        self.jpeg = make_encoder(jpeg_encoder, subsampling, jpeg_optimize, jpeg_progressive)
+
+        # Unchanged frames and tile deltas of the sessions encoding in process
+        self.delta = delta
+        self.delta_threshold = delta_threshold
+        self.refresh_interval = refresh_interval
+
+        # Number of the worker process and callback taking its stats every
+        # second when run by the supervisor of --workers, see workers.py
+        self.worker = worker
+        self.report = report
+        self.backlog = backlog
+        self.session_timeout = session_timeout
+        self.drain_timeout = drain_timeout
+        self.sessions = set()
+
+        # Receiver reports of every session, handed to them by ssrc
+        self.rtcp = RTCPDispatcher()
+
+        # Emulated network on the way to the clients, None without impairments:
+        # loss_rate, error (corrupted packets), duplicate and reorder in %,
+        # delay and jitter in ms, link_rate in Mbit/s
+        self.netem = make_emulator(self.send_delayed, loss_rate, loss_burst, error, duplicate, delay, jitter,
+                                   reorder, link_rate, link_burst, netem_seed)
+
+        # Limits on sessions, decoders and egress (max_bandwidth in Mbit/s)
+        self.admission = AdmissionControl(max_sessions, max_decoders, int(max_bandwidth * 1e6), max_bitrate * 1000)
+
+        # Encoded frames shared by all the sessions (cache_size in MB)
+        FRAME_CACHE.set_budget(cache_size * 1024 * 1024)
+
+        # Worker processes doing the decoding and encoding, if any
+        self.encoder = EncoderPool(encode_workers) if encode_workers > 0 else None
+
+        # Threads producing the frames ahead of their deadlines, enough to
+        # keep every encoder worker busy
+        self.producer_threads = max(min(32, (os.cpu_count() or 1) + 4), 2 * encode_workers)
+
+        # Live channels, scheduled like one more session
+        self.channels = ChannelRegistry(self)
+
+        if metrics_port:
+            register_server_metrics(self)
+            start_metrics_server(metrics_port)
+
+    # Transport hooks implemented by each engine
+    def send_packets(self, packets, address):
+        raise NotImplementedError
+
+    def send_delayed(self, packets, address):
+        raise NotImplementedError
+
+    def send_rtcp(self, packet, address):
+        raise NotImplementedError
+
+    def start_channel(self, channel):
+        raise NotImplementedError
+
+    def stop_channel(self, channel):
+        raise NotImplementedError
+
+
+class Server(ServerEngine):
+
+    """ Server engine with a thread per RTSP connection and one pacing thread for every stream """
+
+    def __init__(self, **options):
+        ServerEngine.__init__(self, **options)
         self.running = True
 
+        # Threads reading and encoding the next frame of every stream ahead of its deadline
+        self.producers = concurrent.futures.ThreadPoolExecutor(max_workers=self.producer_threads,
+                                                               thread_name_prefix="frame-producer")
+
+        # One thread paces the frames of every session, their datagrams
+        # go out in batches through a single shared socket
+        self.sender = BatchSender(self.host, multicast_ttl=self.multicast_ttl)
+        self.scheduler = PacingScheduler(on_tick=self.sender.flush)
+        self.scheduler.start()
+        self.rtp_port = self.sender.sock.getsockname()[1]
+
+        # RTCP reports of every session, on their own socket
+        self.rtcp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rtcp_socket.bind((self.host, 0))
+        self.rtcp_port = self.rtcp_socket.getsockname()[1]
+        threading.Thread(target=self.receive_rtcp, daemon=True, name="rtcp").start()
+        threading.Thread(target=self.reap_sessions, daemon=True, name="reaper").start()
+
+        # SIGTERM drains like Ctrl-C
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+
         self.start_tcp_server()
 
+    def send_packets(self, packets, address):
+
+        """ Queue datagrams, sent in batch with the other sessions at the end of the scheduler tick """
+
+        self.sender.queue(packets, address)
+
+    def send_delayed(self, packets, address):
+
+        """ Send datagrams right away, from the delay line of the network emulator """
+
+        self.sender.queue(packets, address)
+        self.sender.flush()
+
+    def send_rtcp(self, packet, address):
+        try:
+            self.rtcp_socket.sendto(packet, address)
+        except OSError as e:
+            logger.debug(f"RTCP send to {address} failed: {e}")
+
+    def receive_rtcp(self):
+
+        """ RTCP thread, hands the receiver reports to the sessions """
+
+        while True:
+            try:
+                data, address = self.rtcp_socket.recvfrom(2048)
+            except OSError:
+                return
+            self.rtcp.handle(data, address)
+
+    def reap_sessions(self):
+
+        """ Housekeeping thread, see reap_sessions """
+
+        last = time.monotonic()
+        while self.running:
+            time.sleep(REAP_INTERVAL)
+            now = time.monotonic()
+            reap_sessions(self, now, now - last)
+            last = now
+
+    def drain(self):
+
+        """ Graceful shutdown: refuse new sessions and let the streaming ones go on for drain_timeout s """
+
+        self.admission.start_drain()
+        self.server_socket.close()
+        deadline = time.monotonic() + self.drain_timeout
+        try:
+            while time.monotonic() < deadline and any(session.is_streaming() for session in list(self.sessions)):
+                time.sleep(0.1)
+        except KeyboardInterrupt:
+            logger.warning("Drain interrupted by user")
+        for session in list(self.sessions):
+            session.close_connection()
+
+    def start_channel(self, channel):
+        if not self.scheduler.is_scheduled(channel):
+            self.scheduler.add(channel)
+
+    def stop_channel(self, channel):
+        self.scheduler.remove(channel)
+
     def start_tcp_server(self):
 
         """ Main server loop accepting client connections """
 
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        # Expired and drained sessions are closed by the server, leaving TIME_WAIT on the port
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        # Workers share the port, the kernel spreads the connections among them
+        if self.worker is not None:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+        self.server_socket.listen(self.backlog)
 
         try:
             while self.running:
                 # Accept new client connection
                 client_socket, client_address = self.server_socket.accept()
 
+                # Over the connection limit, close it without a thread
+                max_connections = self.admission.max_connections()
+                if max_connections and len(self.sessions) >= max_connections:
+                    logger.warning(f"Connection from {client_address} refused, {len(self.sessions)} open")
+                    client_socket.close()
+                    continue
+
                 # Create and start client session thread
-                session = ClientSession(
-                    client_socket,
-                    client_address,
-                    (self.host, self.port, self.max_frames, self.frame_rate, self.loss_rate, self.error)
-                )
+                session = ClientSession(client_socket, client_address, self)
                 session.start()
         except KeyboardInterrupt:
             logger.warning("Server interrupted by user")
+            self.drain()
         finally:
+            self.running = False
+            self.scheduler.stop()
+            self.producers.shutdown(wait=False, cancel_futures=True)
+            if self.netem is not None:
+                self.netem.close()
+                logger.info(f"Network emulator {self.netem.stats()}")
+            self.sender.close()
+            if self.encoder:
+                self.encoder.close()
             self.server_socket.close()
-            logger.info("Server shutdown")
+            self.rtcp_socket.close()
+            logger.info(f"Server shutdown, sender {self.sender.stats()}, admission {self.admission.stats()}, "
+                        f"frame cache {FRAME_CACHE.stats()}")
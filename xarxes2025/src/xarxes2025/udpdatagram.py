@@ -1,14 +1,25 @@
+import socket
+import struct
 from time import time
 
+from loguru import logger
+from xarxes2025.rtpjpeg import JPEG_HEADER_SIZE, OFFSET_MASK, max_fragment_size, pack_jpeg_header
+
+# RTP header fields after the first byte: marker/pt, seqnum, timestamp, SSRC
+RTP_FIELDS = struct.Struct("!BHII")
+FRAGMENT_OFFSET = struct.Struct("!I")
+
+# Scatter-gather send is not available on Windows
+HAVE_SENDMSG = hasattr(socket.socket, "sendmsg")
     
 class UDPDatagram:	
     HEADER_SIZE = 12
 	
-    def __init__(self, seqnum, payload):
-        self.encode(seqnum, payload)        
+    def __init__(self, seqnum, payload, timestamp=0, marker=0, ssrc=0):
+        self.encode(seqnum, payload, timestamp, marker, ssrc)        
         pass
         
-    def encode(self, seqnum, payload):
+    def encode(self, seqnum, payload, timestamp=0, marker=0, ssrc=0):
         """Encode the RTP packet with header fields and payload."""
         header = bytearray(self.HEADER_SIZE)
 
@@ -16,7 +27,6 @@ class UDPDatagram:
         padding = 0
         extension = 0
         cc = 0
-        marker = 0
         pt = 26 # MJPEG (we convert all frames to JPEG)
 
         # Fill the header bytearray with RTP header fields
@@ -25,19 +35,19 @@ class UDPDatagram:
         header[2] = (seqnum >> 8) & 255 #upper bits
         header[3] = seqnum & 255
 
-        # Bytes 4-7 are for the timestamp, in our case, the time() as an int. Its your task to
-        # fill this in.
-        header[4] = 0
-        header[5] = 0
-        header[6] = 0
-        header[7] = 0
-
-        # Bytes 8-11 are for the SSRC, in our case, 0. Its your task to
-        # fill this in.
-        header[8] = 0
-        header[9] = 0
-        header[10] = 0
-        header[11] = 0
+        # Bytes 4-7 are for the timestamp, the 90 kHz media time of the frame.
+        # All the fragments of a frame share it.
+        header[4] = (timestamp >> 24) & 255
+        header[5] = (timestamp >> 16) & 255
+        header[6] = (timestamp >> 8) & 255
+        header[7] = timestamp & 255
+
+        # Bytes 8-11 are for the SSRC, random for each session so the
+        # receiver can tell streams apart
+        header[8] = (ssrc >> 24) & 255
+        header[9] = (ssrc >> 16) & 255
+        header[10] = (ssrc >> 8) & 255
+        header[11] = ssrc & 255
         
         self.header = header
         
@@ -53,6 +63,10 @@ class UDPDatagram:
         """Return RTP version."""
         return int(self.header[0] >> 6)
 
+    def get_marker(self):
+        """Return marker bit, set on the last packet of a frame."""
+        return int(self.header[1] >> 7)
+
     def get_seqnum(self):
         """Return sequence (frame) number."""
         seqnum = self.header[2] << 8 | self.header[3]
@@ -63,10 +77,77 @@ class UDPDatagram:
         timestamp = self.header[4] << 24 | self.header[5] << 16 | self.header[6] << 8 | self.header[7]
         return int(timestamp)
 
+    def get_ssrc(self):
+        """Return the SSRC of the stream."""
+        return int(self.header[8] << 24 | self.header[9] << 16 | self.header[10] << 8 | self.header[11])
+
     def get_payload(self):
         """Return payload."""
         return self.payload
         
     def get_datagram(self):
         """Return RTP datagram."""
-        return self.header + self.payload
\ No newline at end of file
+        return self.header + self.payload
+
+
+class RTPPacketizer:
+    """
+    Builds the RTP packets of a JPEG stream without copying the frames.
+
+    The RTP and JPEG headers are precomputed once in a template. For every
+    frame the template is replicated into a single buffer and only the
+    seqnum, timestamp, SSRC, marker and fragment offset are patched with
+    struct.pack_into. Packets are (header, payload) memoryview pairs, the
+    payload being a slice of the frame, so they can be sent with
+    socket.sendmsg scatter-gather without concatenating them.
+    """
+    HEADER_SIZE = UDPDatagram.HEADER_SIZE + JPEG_HEADER_SIZE
+
+    def __init__(self, mtu, ssrc=0, seqnum=0, pt=26):
+        self.chunk = max_fragment_size(mtu)
+        self.ssrc = ssrc
+        self.seqnum = seqnum
+        self.pt = pt
+        self.template = bytearray(self.HEADER_SIZE)
+        self.template[0] = 2 << 6 # version 2, no padding, extension or CSRC
+        RTP_FIELDS.pack_into(self.template, 1, pt, 0, 0, ssrc)
+        self.set_frame_info(0, 0, 0)
+
+    def set_frame_info(self, width, height, quality):
+        """Store the frame size and quality in the JPEG header of the template."""
+        self.template[UDPDatagram.HEADER_SIZE:] = pack_jpeg_header(0, width, height, quality)
+
+    def packetize(self, frame, timestamp):
+        """Return the (header, payload) memoryview pairs of a frame, ValueError if over OFFSET_MASK bytes."""
+        view = memoryview(frame)
+        size = len(view)
+        if size > OFFSET_MASK:
+            logger.error(f"Frame of {size} bytes, the 24 bit fragment offsets can't place it")
+            raise ValueError(size)
+        chunk = self.chunk
+        count = max(1, -(-size // chunk))
+        headers = self.template * count
+        header_view = memoryview(headers)
+        hsize = self.HEADER_SIZE
+        pt = self.pt
+        ssrc = self.ssrc
+        seqnum = self.seqnum
+        packets = []
+        for i in range(count):
+            base = i * hsize
+            offset = i * chunk
+            marker = 0x80 if i == count - 1 else 0
+            RTP_FIELDS.pack_into(headers, base + 1, marker | pt, seqnum, timestamp, ssrc)
+            FRAGMENT_OFFSET.pack_into(headers, base + UDPDatagram.HEADER_SIZE, offset)
+            packets.append((header_view[base:base + hsize], view[offset:offset + chunk]))
+            seqnum = (seqnum + 1) & 0xFFFF
+        self.seqnum = seqnum
+        return packets
+
+
+def send_packet(sock, packet, address):
+    """Send a (header, payload) packet with scatter-gather I/O when available."""
+    if HAVE_SENDMSG:
+        sock.sendmsg(packet, (), 0, address)
+    else:
+        sock.sendto(b"".join(packet), address)
@@ -1,25 +1,59 @@
+import os
+
 import cv2
 from loguru import logger
 
+from xarxes2025.delta import DELTA, UNCHANGED, pack_delta
+from xarxes2025.encoders import make_encoder
+from xarxes2025.frameindex import load_index, seek_capture
+from xarxes2025.framecache import FRAME_CACHE, source_key
+from xarxes2025.metrics import stage_timer
+
+# Hot path stages, timed when metrics are enabled
+SEEK_TIME = stage_timer("cap_seek")
+READ_TIME = stage_timer("cap_read")
+RESIZE_TIME = stage_timer("resize")
+ENCODE_TIME = stage_timer("imencode")
 
 
 class VideoProcessor(object):
 
     ready = False
 
-    def __init__(self, filename):
+    # Frames are encoded live, at a size and quality that can change
+    adaptive = True
+
+    def __init__(self, filename, size=(500, 380), quality=95, cache=FRAME_CACHE, jpeg=None, delta=None):
         """
         Constructor for VideoProcessor object.
 
         :param filename: The name of the video file to open.
+        :param size: (width, height) the frames are resized to, None to keep
+                     the source resolution.
+        :param quality: JPEG quality (0-100) used to encode the frames.
+        :param cache: Shared FrameCache for the encoded frames.
+        :param jpeg: JPEGEncoder, OpenCV with the default settings if None.
+        :param delta: DeltaEncoder of the session to skip unchanged frames
+                      and send delta frames, None to always send full frames.
         """
         self.filename = filename
+        self.path = os.path.abspath(filename)
+        self.size = size
+        self.quality = quality
+        self.cache = cache
+        self.jpeg = jpeg or make_encoder()
+        self.delta = delta
         logger.debug(f"VideoProcessor created for {self.filename}")
         self.cap = cv2.VideoCapture(self.filename)
         if not self.cap.isOpened():
             logger.error(f"Cannot open {self.filename} file")
             raise IOError
+        self.source = source_key(filename)
         self.frame_num = 0
+        # Index of the frame the capture will return on the next read
+        self.cap_pos = 0
+        # Timestamps and keyframes, to seek
+        self.index = load_index(self.filename)
         self.ready = True
 
     def next_frame(self):
@@ -27,37 +61,141 @@ class VideoProcessor(object):
         Read the next frame from the video file, resize it, encode it as JPEG,
         and return the encoded bytes.
 
-        The function reads a frame from the video, resizes it to fit UDP size
-        limits, encodes it as a JPEG image, and returns the byte data. If the
+        The function reads a frame from the video, resizes it to the configured
+        size, encodes it as a JPEG image, and returns the byte data. If the
         video file cannot be read or the frame cannot be encoded, an error is
         logged and an IOError is raised.
 
+        Encoded frames are shared with the other sessions through the frame
+        cache, so only the first session reaching a frame pays for decoding
+        and encoding it.
+
         :returns: JPEG-encoded byte data of the next frame, or None if the end 
-                of the video is reached.
+                of the video is reached. With a DeltaEncoder, a delta frame
+                or b"" for a frame that didn't change.
+        """
+        index = self.frame_num + 1
+        if self.delta is not None:
+            data = self.next_delta_frame(index)
+        else:
+            key = (self.source, index, self.size, self.quality, self.jpeg.spec)
+            data = self.cache.get_or_compute(key, lambda: self.encode_frame(index))
+        if data is None:
+            return None
+
+        self.frame_num = index
+        return data
+
+    def next_delta_frame(self, index):
+        """
+        Decode frame number index (1-based) and compare it with what the client has.
+
+        Every delta session decodes its frames, the comparison needs them,
+        but full frames are still shared through the frame cache.
+
+        :param index: Number of the frame to send.
+        :returns: JPEG bytes, delta frame bytes, b"" if nothing changed or
+                  None past the end of the video.
+        """
+        frame = self.decode_frame(index)
+        if frame is None:
+            return None
+        kind, rects = self.delta.next(frame)
+        if kind == UNCHANGED:
+            return b""
+        if kind == DELTA:
+            height, width = frame.shape[:2]
+            patches = [(x, y, self.encode(frame[y:y + h, x:x + w], index)) for x, y, w, h in rects]
+            return pack_delta((width, height), patches)
+        key = (self.source, index, self.size, self.quality, self.jpeg.spec)
+        return self.cache.get_or_compute(key, lambda: self.encode(frame, index))
+
+    def encode_frame(self, index):
+        """
+        Decode frame number index (1-based) from the video file and encode it.
+
+        :param index: Number of the frame to encode.
+        :returns: JPEG-encoded byte data, or None past the end of the video.
+        """
+        frame = self.decode_frame(index)
+        if frame is None:
+            return None
+        return self.encode(frame, index)
+
+    def decode_frame(self, index):
+        """
+        Decode frame number index (1-based) from the video file, at the encoding size.
+
+        :param index: Number of the frame to decode.
+        :returns: BGR frame, or None past the end of the video.
         """
+        # Only seek when other sessions served the frames in between, or
+        # after a skip or a PLAY Range
+        if self.cap_pos != index - 1:
+            with SEEK_TIME.time():
+                seek_capture(self.cap, self.cap_pos, index - 1, self.index)
+
         # Get next frame from the videofile
-        ret, frame = self.cap.read()
+        with READ_TIME.time():
+            ret, frame = self.cap.read()
         if not ret:
             return None
-
-        self.frame_num += 1
+        self.cap_pos = index
         
-        # Resize for UDP size limits
-        # If using bigger frames, the UDP packets will have to be fragmented 
-        # and reassembled on the other side, that is out of the scope for 
-        # this course.
-        frame = cv2.resize(frame, (500, 380)) 
-    
-        ret, encoded_frame = cv2.imencode('.jpg', frame)
-        if not ret:
-            logger.error(f"Cannot encode frame {self.frame_num}")
-            raise IOError
+        # Frames are fragmented in MTU sized RTP packets, resizing is only
+        # needed to lower the bitrate.
+        if self.size:
+            with RESIZE_TIME.time():
+                frame = cv2.resize(frame, self.size) 
+        return frame
+
+    def encode(self, frame, index):
 
-        jpeg_bytes = encoded_frame.tobytes() # Get the bytes
+        """ Encode a decoded frame, or part of it, as JPEG """
 
-        data = jpeg_bytes
+        try:
+            with ENCODE_TIME.time():
+                data = self.jpeg.encode(frame, self.quality)
+        except Exception as e:
+            logger.error(f"Cannot encode frame {index} with {self.jpeg}: {e}")
+            raise IOError
         return data
         
+    def seek(self, frame):
+        """
+        Continue the video at a frame, next_frame returns it next.
+
+        :param frame: Frame number, from 0, see FrameIndex.frame_at.
+        """
+        self.frame_num = min(max(frame, 0), self.index.frame_count)
+
+    def skip(self, count):
+        """
+        Skip count frames without encoding them, used when the sender is late.
+
+        :param count: Number of frames to skip.
+        """
+        self.frame_num += count
+
+    def set_encoding(self, size, quality):
+        """
+        Change the size and quality of the next frames, for rate control.
+
+        :param size: (width, height) the frames are resized to, None to keep
+                     the source resolution.
+        :param quality: JPEG quality (0-100).
+        """
+        self.size = size
+        self.quality = quality
+
+    def get_size(self):
+        """
+        Return the (width, height) of the encoded frames.
+        """
+        if self.size:
+            return self.size
+        return (int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+
     def get_frame_number(self):
 
         return self.frame_num
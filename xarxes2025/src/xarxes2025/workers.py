@@ -0,0 +1,241 @@
+import math
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import time
+
+from loguru import logger
+
+
+# Multi-process server: N workers, each a complete server engine (its own
+# sessions, scheduler, RTP and RTCP sockets and frame cache), bind the RTSP
+# port with SO_REUSEPORT and the kernel spreads the connections among them.
+# A session lives in the worker that accepted its connection. The
+# supervisor restarts the workers that crash and logs their stats.
+
+# Seconds before restarting a crashed worker, doubled while it keeps
+# crashing, up to the maximum
+RESTART_DELAY = 1.0
+MAX_RESTART_DELAY = 30.0
+
+# A worker that ran this long before crashing is restarted right away
+STABLE_TIME = 30.0
+
+# Seconds between two logs of the stats of all the workers
+STATS_INTERVAL = 10.0
+
+# Multicast ports of the live channels of each worker
+WORKER_MULTICAST_PORTS = 100
+
+# Limits of the whole server, split among the workers
+SPLIT_COUNTS = ("max_sessions", "max_decoders", "cache_size")
+SPLIT_AMOUNTS = ("max_bandwidth",)
+
+
+def check_reuse_port():
+
+    """ Raise IOError if SO_REUSEPORT is not available on this platform """
+
+    if not hasattr(socket, "SO_REUSEPORT"):
+        logger.error("Multiple workers need SO_REUSEPORT, not available on this platform")
+        raise IOError("SO_REUSEPORT not available")
+
+
+def worker_options(options, worker, workers):
+    """
+    Server engine options of one worker.
+
+    The session, decoder and bandwidth limits and the frame cache are
+    split evenly among the workers, a connection only counts in the worker
+    that accepted it. Each worker gets its own multicast ports, metrics
+    port (metrics_port + worker) and network emulation seed (seed + worker).
+
+    :param options: Keyword arguments of the server engine.
+    :param worker: Number of the worker, from 0.
+    :param workers: Number of workers.
+    :returns: Keyword arguments of the worker's engine.
+    """
+    options = dict(options)
+    for name in SPLIT_COUNTS:
+        if options.get(name):
+            options[name] = math.ceil(options[name] / workers)
+    for name in SPLIT_AMOUNTS:
+        if options.get(name):
+            options[name] = options[name] / workers
+    options["multicast_port"] = options.get("multicast_port", 5004) + worker * WORKER_MULTICAST_PORTS
+    if options.get("metrics_port"):
+        options["metrics_port"] += worker
+    if options.get("netem_seed") is not None:
+        options["netem_seed"] += worker
+    return options
+
+
+def run_worker(engine, options, worker, reports):
+    """
+    Worker process: run a server engine until SIGTERM.
+
+    :param engine: "threads" or "asyncio".
+    :param options: Keyword arguments of the engine, see worker_options.
+    :param worker: Number of the worker.
+    :param reports: Queue where the engine's stats go every second.
+    """
+    # Out of the terminal's process group: Ctrl-C reaches the supervisor
+    # only, which drains the workers with SIGTERM
+    os.setpgrp()
+    if engine == "asyncio":
+        from xarxes2025.aioserver import AsyncServer as engine_class
+    else:
+        from xarxes2025.server import Server as engine_class
+    engine_class(worker=worker, report=lambda stats: reports.put((worker, stats)), **options)
+
+
+class Supervisor(object):
+    """
+    Starts the server workers, restarts the ones that crash and aggregates
+    their stats.
+
+    Ctrl-C or SIGTERM to the supervisor sends SIGTERM to every worker,
+    which drains its sessions like a single process server; a second one
+    stops them right away.
+    """
+
+    def __init__(self, engine, options, workers):
+        """
+        Constructor for Supervisor object.
+
+        :param engine: "threads" or "asyncio".
+        :param options: Keyword arguments of the server engine, the limits
+                        of the whole server.
+        :param workers: Number of worker processes.
+        """
+        check_reuse_port()
+        self.engine = engine
+        self.options = options
+        self.workers = workers
+        self.drain_timeout = options.get("drain_timeout", 10)
+
+        # Workers are forked: they inherit the logging setup of the CLI
+        self.context = multiprocessing.get_context("fork")
+        self.reports = self.context.Queue()
+
+        # Per worker: process, start time, restart delay, time of the next
+        # restart when it is down, last stats and restarts
+        self.processes = {}
+        self.started = {}
+        self.delays = {}
+        self.restart_at = {}
+        self.stats = {}
+        self.restarts = 0
+
+    def start_worker(self, worker):
+
+        """ Fork worker number worker """
+
+        process = self.context.Process(
+            target=run_worker, name=f"xarxes-worker-{worker}", daemon=False,
+            args=(self.engine, worker_options(self.options, worker, self.workers), worker, self.reports))
+        process.start()
+        self.processes[worker] = process
+        self.started[worker] = time.monotonic()
+        self.restart_at.pop(worker, None)
+        logger.info(f"Worker {worker} started, pid {process.pid}")
+
+    def check_workers(self, now):
+
+        """ Schedule the restart of the workers that exited, restart the ones whose delay passed """
+
+        for worker, process in self.processes.items():
+            if process.is_alive() or worker in self.restart_at:
+                continue
+            if now - self.started[worker] >= STABLE_TIME:
+                self.delays[worker] = 0
+            else:
+                self.delays[worker] = min(max(self.delays.get(worker, 0) * 2, RESTART_DELAY), MAX_RESTART_DELAY)
+            self.restart_at[worker] = now + self.delays[worker]
+            self.stats.pop(worker, None)
+            logger.error(f"Worker {worker} exited with code {process.exitcode}, "
+                         f"restarting in {self.delays[worker]:.0f} s")
+
+        for worker, deadline in list(self.restart_at.items()):
+            if now >= deadline:
+                self.restarts += 1
+                self.start_worker(worker)
+
+    def collect(self, timeout):
+
+        """ Keep the last stats of each worker, waiting up to timeout s for the first """
+
+        try:
+            while True:
+                worker, stats = self.reports.get(timeout=timeout)
+                if self.processes[worker].is_alive():
+                    self.stats[worker] = stats
+                timeout = 0
+        except queue.Empty:
+            pass
+
+    def aggregate(self):
+
+        """ Return a dict with the stats of the workers added up """
+
+        total = {"workers": sum(1 for process in self.processes.values() if process.is_alive()),
+                 "restarts": self.restarts}
+        for stats in self.stats.values():
+            for name, value in stats.items():
+                if isinstance(value, (int, float)):
+                    total[name] = total.get(name, 0) + value
+        if "bandwidth_mbps" in total:
+            total["bandwidth_mbps"] = round(total["bandwidth_mbps"], 3)
+        return total
+
+    def run(self):
+
+        """ Supervise the workers until Ctrl-C or SIGTERM """
+
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        for worker in range(self.workers):
+            self.start_worker(worker)
+        logger.info(f"Supervisor running {self.workers} {self.engine} workers on port {self.options['port']}")
+
+        last_log = time.monotonic()
+        try:
+            while True:
+                self.collect(0.5)
+                now = time.monotonic()
+                self.check_workers(now)
+                if now - last_log >= STATS_INTERVAL:
+                    logger.info(f"Workers {self.aggregate()}")
+                    last_log = now
+        except KeyboardInterrupt:
+            logger.warning("Server interrupted by user")
+        finally:
+            self.stop()
+
+    def stop(self):
+
+        """ Drain every worker with SIGTERM, a second interrupt or the drain timeout stops them """
+
+        self.signal_workers(signal.SIGTERM)
+        deadline = time.monotonic() + self.drain_timeout + 5
+        try:
+            while time.monotonic() < deadline and any(process.is_alive() for process in self.processes.values()):
+                self.collect(0.1)
+        except KeyboardInterrupt:
+            logger.warning("Drain interrupted by user")
+            self.signal_workers(signal.SIGTERM)
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline and any(process.is_alive() for process in self.processes.values()):
+                time.sleep(0.1)
+        for worker, process in self.processes.items():
+            if process.is_alive():
+                logger.warning(f"Worker {worker} did not stop, killing it")
+                process.kill()
+            process.join()
+        logger.info(f"Supervisor shutdown, workers {self.aggregate()}")
+
+    def signal_workers(self, signum):
+        for process in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
@@ -0,0 +1,168 @@
+"""
+Framing of the incremental RTSP parser: however the bytes are segmented,
+the requests come out whole and in order, and the ones it can't frame are
+refused with the status the server answers.
+"""
+import random
+
+import pytest
+
+from xarxes2025.rtsp import (MAX_BODY_SIZE, MAX_HEAD_SIZE, BadRequest, RequestTooLarge, RTSPParser,
+                             RTSPRequest, RTSPResponse)
+
+
+METHODS = ["SETUP", "PLAY", "PAUSE", "TEARDOWN", "OPTIONS", "GET_PARAMETER"]
+
+# Read sizes the limits are checked with: byte by byte, socket reads, all at once
+READ_SIZES = [1, 1024, 1 << 20]
+
+PIPELINED = (b"SETUP rick.webm RTSP/1.0\r\nCSeq: 1\r\nTransport: RTP/UDP; client_port= 25000\r\n\r\n"
+             b"PLAY rick.webm RTSP/1.0\r\ncseq: 2\r\nSession: XARXES1\r\nRange: npt=12.5-\r\n\r\n"
+             b"\r\n"
+             b"GET_PARAMETER rick.webm RTSP/1.0\r\nCSeq: 3\r\nSession: XARXES1\r\nContent-Length: 9\r\n\r\n"
+             b"position\n"
+             b"TEARDOWN rick.webm RTSP/1.0\r\nCSEQ: 4\r\nSession: XARXES1\r\n\r\n")
+
+EXPECTED = [
+    ("SETUP", "rick.webm", {"cseq": "1", "transport": "RTP/UDP; client_port= 25000"}, b""),
+    ("PLAY", "rick.webm", {"cseq": "2", "session": "XARXES1", "range": "npt=12.5-"}, b""),
+    ("GET_PARAMETER", "rick.webm", {"cseq": "3", "session": "XARXES1", "content-length": "9"}, b"position\n"),
+    ("TEARDOWN", "rick.webm", {"cseq": "4", "session": "XARXES1"}, b""),
+]
+
+HEAD = b"PLAY rick.webm RTSP/1.0\r\nCSeq: 7\r\n"
+
+
+def fields(requests):
+    return [(r.method, r.uri, r.headers, r.body) for r in requests]
+
+
+def feed_all(data, size):
+
+    """ Feed data in reads of size bytes to a new parser, return it and the requests it framed """
+
+    parser = RTSPParser()
+    requests = []
+    for pos in range(0, len(data), size):
+        requests += parser.feed(data[pos:pos + size])
+    return parser, requests
+
+
+def refused(data, size):
+
+    """ The BadRequest raised by feeding data in reads of size bytes, None if accepted """
+
+    try:
+        feed_all(data, size)
+    except BadRequest as e:
+        return e
+    return None
+
+
+def test_pipelined_requests_in_one_read():
+    parser, requests = feed_all(PIPELINED, len(PIPELINED))
+    assert fields(requests) == EXPECTED
+    assert all(isinstance(r, RTSPRequest) for r in requests)
+    assert not parser.buffer and parser.pending is None
+
+
+def test_split_at_every_byte():
+    for split in range(1, len(PIPELINED)):
+        parser = RTSPParser()
+        requests = parser.feed(PIPELINED[:split]) + parser.feed(PIPELINED[split:])
+        assert fields(requests) == EXPECTED, f"split at byte {split}"
+        assert not parser.buffer and parser.pending is None
+
+
+def test_byte_by_byte():
+    parser, requests = feed_all(PIPELINED, 1)
+    assert fields(requests) == EXPECTED
+    assert not parser.buffer
+
+
+def test_incomplete_request_waits_for_its_end():
+    parser = RTSPParser()
+    assert parser.feed(PIPELINED[:-2]) != []
+    assert parser.buffer
+    assert fields(parser.feed(PIPELINED[-2:])) == EXPECTED[-1:]
+
+
+def test_responses():
+    parser, messages = feed_all(b"RTSP/1.0 200 OK\r\nCSeq: 1\r\nSession: XARXES1;timeout=60\r\n\r\n"
+                                b"RTSP/1.0 454 Session Not Found\r\nCSeq: 2\r\n\r\n", 5)
+    assert all(isinstance(m, RTSPResponse) for m in messages)
+    assert [(m.status, m.reason, m.cseq) for m in messages] == [(200, "OK", "1"), (454, "Session Not Found", "2")]
+    assert messages[0].header("session") == "XARXES1;timeout=60"
+
+
+def test_random_segmentations():
+    rng = random.Random(1)
+    for n in range(200):
+        stream = []
+        expected = []
+        for cseq in range(rng.randint(1, 20)):
+            method = rng.choice(METHODS)
+            lines = [f"{method} rick.webm RTSP/1.0", f"{rng.choice(['CSeq', 'cseq', 'CSEQ'])}: {cseq}"]
+            headers = {"cseq": str(cseq)}
+            body = b""
+            if rng.random() < 0.2:
+                body = bytes(rng.randrange(256) for _ in range(rng.randint(1, 300)))
+                lines.append(f"Content-Length: {len(body)}")
+                headers["content-length"] = str(len(body))
+            data = ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+            stream.append(b"\r\n" + data if rng.random() < 0.1 else data)
+            expected.append((method, "rick.webm", headers, body))
+        data = b"".join(stream)
+
+        parser = RTSPParser()
+        requests = []
+        pos = 0
+        while pos < len(data):
+            size = rng.choice([1, 2, 3, rng.randint(1, 64), rng.randint(1, 2048)])
+            requests += parser.feed(data[pos:pos + size])
+            pos += size
+        assert fields(requests) == expected, f"round {n}"
+        assert not parser.buffer and parser.pending is None
+
+
+@pytest.mark.parametrize("size", READ_SIZES)
+def test_head_at_the_limit(size):
+    padding = MAX_HEAD_SIZE - len(HEAD) - len(b"X-Pad: ")
+    assert refused(HEAD + b"X-Pad: " + b"a" * padding + b"\r\n\r\n", size) is None
+
+
+@pytest.mark.parametrize("size", READ_SIZES)
+def test_head_over_the_limit_gives_400(size):
+    padding = MAX_HEAD_SIZE - len(HEAD) - len(b"X-Pad: ")
+    error = refused(HEAD + b"X-Pad: " + b"a" * (padding + 1) + b"\r\n\r\n", size)
+    assert isinstance(error, RequestTooLarge) and error.status == 400
+
+
+@pytest.mark.parametrize("size", READ_SIZES)
+def test_unterminated_head_gives_400(size):
+    error = refused(HEAD + b"X-Pad: " + b"a" * (2 * MAX_HEAD_SIZE), size)
+    assert isinstance(error, RequestTooLarge) and error.status == 400
+
+
+@pytest.mark.parametrize("size", READ_SIZES)
+def test_body_at_the_limit(size):
+    parser, requests = feed_all(HEAD + f"Content-Length: {MAX_BODY_SIZE}\r\n\r\n".encode() + bytes(MAX_BODY_SIZE),
+                                size)
+    assert len(requests) == 1 and len(requests[0].body) == MAX_BODY_SIZE
+
+
+@pytest.mark.parametrize("length", [MAX_BODY_SIZE + 1, 99999999999])
+@pytest.mark.parametrize("size", READ_SIZES)
+def test_body_over_the_limit_gives_413(length, size):
+    error = refused(HEAD + f"Content-Length: {length}\r\n\r\n".encode(), size)
+    assert isinstance(error, RequestTooLarge) and error.status == 413
+
+    # The response goes to the request's CSeq
+    assert error.cseq == "7"
+
+
+@pytest.mark.parametrize("length", ["abc", "-1", "", "1e3", "0x10"])
+def test_bad_content_length_gives_400(length):
+    error = refused(HEAD + f"Content-Length: {length}\r\n\r\nbody".encode(), 1024)
+    assert error is not None and not isinstance(error, RequestTooLarge)
+    assert error.status == 400 and error.cseq == "7"